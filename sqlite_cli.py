@@ -11,36 +11,44 @@ import sqlite3 as DB
 import sys
 import logging
 import re
-import readline
 import glob
+import itertools
+import time
+import cStringIO
+import collections
+import heapq
+import bisect
+import atexit
+import struct
+import array
 
-from cmd2 import Cmd
+# cmd2 takes longer to import than the rest of the shell, so it's only
+# loaded for the interactive shell (see interactive_shell_class).
+from cmd import Cmd
 
 
 # =============================================================================
 # readline config/setup/...
+# Only done for the interactive shell, batch runs don't need it.
 # =============================================================================
-# history file setup
-histfile = os.path.join(os.path.expanduser("~"), ".sqlite_cli.history")
-try:
-    readline.read_history_file(histfile)
-except IOError:
-    pass
-import atexit
-atexit.register(readline.write_history_file, histfile)
+def setup_readline():
+    import readline
+    # The history is kept in HISTORY_DB, the shell adds its recent entries
+    # (see SQLiteCli.preloop).
 
-# / should not be a delimiter for path completitions,
-# so we set our own delimiters.
-readline.set_completer_delims(' \t\n;')
+    # / should not be a delimiter for path completitions,
+    # so we set our own delimiters.
+    readline.set_completer_delims(' \t\n;')
 # =============================================================================
 
 
 # =============================================================================
 # System Core Settings = START ================================================
-# TODO: There is a len() overhead with this colors of 13 characters,
-# TODO: so every print with a fieldlength has to add 13 to get the expected width.
+# Colors are off if stdout is no terminal (pipes, files) or NO_COLOR is set.
+# The renderers add the color codes outside of the padded fields, see
+# _color_codes.
 # =============================================================================
-NOCOLOR = False
+NOCOLOR = not sys.stdout.isatty() or 'NO_COLOR' in os.environ
 if NOCOLOR:
     def BLACK(text):        return text
     def BLUE(text):         return text
@@ -90,12 +98,13 @@ LOG_LEVELS                  = {
     'DEBUG'     : logging.DEBUG,
     'UNSET'     : 0,
 }
-# patch python logger to be more colorful -------------------------------------
-logging.addLevelName( logging.DEBUG,   "\033[0;34m%-8s\033[0;0m" % logging.getLevelName(logging.DEBUG))
-logging.addLevelName( logging.INFO,    "\033[1;33m%-8s\033[0;0m" % logging.getLevelName(logging.INFO))
-logging.addLevelName( logging.WARNING, "\033[1;36m%-8s\033[0;0m" % logging.getLevelName(logging.WARNING))
-logging.addLevelName( logging.ERROR,   "\033[0;31m%-8s\033[0;0m" % logging.getLevelName(logging.ERROR))
-logging.addLevelName( logging.CRITICAL,"\033[0;35m%-8s\033[0;0m" % logging.getLevelName(logging.CRITICAL))
+# patch python logger to be more colorful (if it logs to a terminal) ----------
+if sys.stderr.isatty() and 'NO_COLOR' not in os.environ:
+    logging.addLevelName( logging.DEBUG,   "\033[0;34m%-8s\033[0;0m" % logging.getLevelName(logging.DEBUG))
+    logging.addLevelName( logging.INFO,    "\033[1;33m%-8s\033[0;0m" % logging.getLevelName(logging.INFO))
+    logging.addLevelName( logging.WARNING, "\033[1;36m%-8s\033[0;0m" % logging.getLevelName(logging.WARNING))
+    logging.addLevelName( logging.ERROR,   "\033[0;31m%-8s\033[0;0m" % logging.getLevelName(logging.ERROR))
+    logging.addLevelName( logging.CRITICAL,"\033[0;35m%-8s\033[0;0m" % logging.getLevelName(logging.CRITICAL))
 # setup logging ---------------------------------------------------------------
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)s %(message)s')
 log = logging.getLogger('sqlite_cli')
@@ -115,6 +124,8 @@ CSV                         = 'CSV'
 FILE                        = 'FILE'
 LINE                        = 'LINE'
 TABLE                       = 'TABLE'
+TSV                         = 'TSV'
+COLUMNAR                    = 'COLUMNAR'
 # --- Outputformat: General Tuning Parameter Names
 MAX_WIDTH                   = 'MAX_WIDTH'
 TRUNCATE_LINE               = 'TRUNCATE_LINE'
@@ -125,18 +136,41 @@ COLUMN_WIDTHS         = 'COLUMN_WIDTHS'
 COLUMN_IDX            = 'COLUMN_IDX'
 COLUMN_MAX_WIDTH      = 'COLUMN_MAX_WIDTH'
 COLUMN_MIN_WIDTH      = 'COLUMN_MIN_WIDTH'
+SAMPLE_ROWS           = 'SAMPLE_ROWS'
 # ENUMS - END -----------------------------------------------------------------
 # System Core Settings = END ==================================================
 # =============================================================================
 
-_max_width = 80
-_data  = os.popen('stty -a', 'r').read()
-_match = re.search('columns (\d+)', _data)
-if _match:
-    _max_width = _match.group(1)
+# Rows used to size the columns of output-mode TABLE before streaming the rest.
+DEFAULT_SAMPLE_ROWS = 200
+# Appended to cells cut at their column width.
+OVERFLOW_MARK       = '~'
+
+_terminal_size = None
+def terminal_size():
+    """ (lines, columns) of the terminal, (-1, -1) (unlimited) if stdout is no terminal. """
+    global _terminal_size
+    if _terminal_size is None:
+        _terminal_size = (-1, -1,)
+        if sys.stdout.isatty():
+            _terminal_size = (24, 80,)
+            try:
+                import fcntl, termios
+                lines, columns = struct.unpack('hhhh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '\0' * 8))[:2]
+                if lines > 0 and columns > 0:
+                    _terminal_size = (lines, columns,)
+            except (ImportError, IOError):
+                if os.environ.get('LINES', '').isdigit() and os.environ.get('COLUMNS', '').isdigit():
+                    _terminal_size = (int(os.environ['LINES']), int(os.environ['COLUMNS']),)
+    return _terminal_size
+
+def terminal_width():
+    """ Columns of the terminal, -1 (unlimited) if stdout is no terminal. """
+    return terminal_size()[1]
 
 FORMATS = {
-    TABLE   : { MAX_WIDTH     : _max_width,
+    TABLE   : { MAX_WIDTH     : None, # None: width of the terminal
+                SAMPLE_ROWS   : DEFAULT_SAMPLE_ROWS,
                 COLUMN_WIDTHS : {},   # {  2: { COLUMN_MAX_WIDTH: 20, COLUMN_MIN_WIDTH: 20, },
                                       #   10: { COLUMN_MAX_WIDTH: 10, TRUNCATE_LINE: True, },
                                       # }
@@ -146,20 +180,199 @@ FORMATS = {
                 },
     CSV     : { SEPARATOR     : ',',
                 },
+    TSV     : { SEPARATOR     : '\t',
+                },
+    COLUMNAR: { },
 }
 
 DATABASE_FILENAME_SUFFIXES  = ['db', 'sqlite',]
+# Bytes collected by the CSV/TSV exporter before they are written out.
+EXPORT_BUFFER_SIZE          = 1024 * 1024
+# Rows inserted per transaction by the load command.
+DEFAULT_LOAD_BATCH_SIZE     = 50000
+# Leading rows of a file used to infer the column types of a new table.
+LOAD_INFER_ROWS             = 1000
+# File endings read as JSON lines by the load command, all others are CSV.
+JSONL_FILENAME_SUFFIXES     = ['.jsonl', '.ndjson', '.json',]
+# Worker threads running background jobs (bg command).
+BG_WORKERS                  = 4
+# Rows of a background result kept in memory, the rest is spilled to disk.
+BG_SPILL_ROWS               = 100000
+# Pages copied per step by the backup command and the pause between two
+# steps, which lets other connections write in between.
+BACKUP_PAGES_PER_STEP       = 1024
+BACKUP_SLEEP_MS             = 10
+# Seconds between two polls of watch and tail, rows shown when tail starts.
+WATCH_INTERVAL              = 1.0
+TAIL_ROWS                   = 10
+# Rows per hashed range of checksum and diff, a mismatching range is split
+# into CHECKSUM_SPLIT ranges until it has at most CHECKSUM_LEAF_ROWS rows,
+# which are compared row by row.
+CHECKSUM_CHUNK_ROWS         = 50000
+CHECKSUM_SPLIT              = 16
+CHECKSUM_LEAF_ROWS          = 1000
+# Worker connections (per database) hashing ranges in parallel.
+CHECKSUM_WORKERS            = 4
+# Differing rows printed by diff, the others are only counted.
+DIFF_SHOWN_ROWS             = 50
+# Compiled patterns kept by the REGEXP functions, results kept per memoized
+# function (and connection) of the function registry.
+REGEX_CACHE_SIZE            = 256
+UDF_MEMO_SIZE               = 4096
+# Reader connections of the query server (serve), the writer is one more.
+SERVE_READERS               = 4
+# PRAGMAs the query server runs on the writer although they have no "= value",
+# and PRAGMAs with "(argument)" it runs on a reader, all others set a value.
+SERVE_WRITE_PRAGMAS         = ('optimize', 'wal_checkpoint', 'incremental_vacuum',)
+SERVE_READ_PRAGMAS          = ('table_info', 'table_xinfo', 'index_info', 'index_xinfo', 'index_list',
+                               'foreign_key_list', 'foreign_key_check', 'integrity_check', 'quick_check',
+                               'table_list',)
+# Maximum number of shards queried at the same time (use_many), None for one per CPU.
+SHARD_WORKERS               = None
+# Batches (of fetch_size rows) a shard fetches ahead of the merge.
+SHARD_QUEUE_BATCHES         = 4
+# Executed statements kept for the stats command.
+PROFILE_HISTORY_SIZE        = 1000
+# Memory budget (bytes, estimated) of the result cache.
+RESULT_CACHE_BUDGET         = 64 * 1024 * 1024
+# Prepared statements kept per connection by the sqlite3 module.
+DEFAULT_CACHED_STATEMENTS   = 100
+# array.array typecodes of columnar results (df), tried in this order. Columns
+# fitting none of them (text, blobs, NULLs, mixed types) are kept as lists.
+COLUMN_TYPECODES            = ('l', 'd',)
+# Largest integer an array('d') column holds exactly, columns with bigger
+# integers are kept as lists.
+FLOAT_EXACT_INT             = 2 ** 53
+# Rows shown by "df head" and values by "df value_counts".
+DF_HEAD_ROWS                = 10
+DF_VALUE_COUNTS             = 10
+# Pages of a result kept by the pager for paging back.
+PAGER_CACHED_PAGES          = 50
+# Rows pulled from the cursor per fetchmany() call while streaming results.
+DEFAULT_FETCH_SIZE          = 1000
+# SQLite VM instructions between two progress callbacks. The callback gives
+# python a chance to handle Ctrl-C while a long running statement is stepped.
+PROGRESS_HANDLER_OPCODES    = 10000
 SQL_GET_TABLE_NAMES         = "SELECT tbl_name as name from sqlite_master where type in ('table', 'view');"
-# SQL_KEYWORDS                = (
-#     'SELECT', 'FROM', 'UPDATE', 'SET', 'ON', 'ORDER BY', 'LIMIT', 'AS', 'DROP', 'PRAGMA',
-#     'JOIN', 'LEFT', 'RIGHT', 'NOT', 'IN',
-# )
+SQL_KEYWORDS                = (
+    'SELECT', 'FROM', 'WHERE', 'UPDATE', 'SET', 'ON', 'ORDER', 'GROUP', 'BY', 'HAVING', 'LIMIT',
+    'OFFSET', 'AS', 'DROP', 'PRAGMA', 'JOIN', 'LEFT', 'RIGHT', 'INNER', 'OUTER', 'CROSS', 'NOT',
+    'IN', 'AND', 'OR', 'IS', 'NULL', 'LIKE', 'GLOB', 'BETWEEN', 'EXISTS', 'CASE', 'WHEN',
+    'THEN', 'ELSE', 'END', 'DISTINCT', 'UNION', 'ALL', 'INTERSECT', 'EXCEPT', 'INSERT', 'INTO',
+    'VALUES', 'REPLACE', 'DELETE', 'CREATE', 'TABLE', 'VIEW', 'INDEX', 'UNIQUE', 'TRIGGER',
+    'PRIMARY', 'KEY', 'DEFAULT', 'WITH', 'RECURSIVE', 'EXPLAIN', 'QUERY', 'PLAN', 'ASC',
+    'DESC', 'BEGIN', 'COMMIT', 'ROLLBACK', 'VACUUM', 'ANALYZE', 'ATTACH', 'DETACH',
+)
+SQL_FUNCTIONS               = (
+    'abs', 'avg', 'coalesce', 'count', 'date', 'datetime', 'group_concat', 'hex', 'ifnull',
+    'instr', 'julianday', 'length', 'lower', 'ltrim', 'max', 'min', 'nullif', 'printf',
+    'quote', 'random', 'replace', 'round', 'rtrim', 'strftime', 'substr', 'sum', 'time',
+    'total', 'trim', 'typeof', 'upper', 'json_extract', 'json_array', 'json_object',
+)
+
+# Per database state of the shell is kept below STATE_DIR.
+STATE_DIR                   = os.path.join(os.path.expanduser('~'), '.sqlite_cli.d')
+# Schema caches are persisted here, one file per database path.
+SCHEMA_CACHE_DIR            = os.path.join(STATE_DIR, 'schema')
+# Stored queries (save/run), one file per database path.
+QUERY_STORE_DIR             = os.path.join(STATE_DIR, 'queries')
+# Commands and statements of the shell with their database, time and rows.
+# The readline history file of older versions is imported once.
+HISTORY_DB                  = os.path.join(STATE_DIR, 'history.db')
+LEGACY_HISTORY_FILE         = os.path.join(os.path.expanduser('~'), '.sqlite_cli.history')
+# Entries kept in HISTORY_DB, loaded into readline and shown by history.
+HISTORY_MAX_ENTRIES         = 100000
+HISTORY_READLINE_ENTRIES    = 1000
+HISTORY_SHOWN               = 25
+
+# Connection profiles: PRAGMAs applied (in this order) to every connection
+# opened by use, use_many and bg. Editable in the [profile NAME] sections of
+# the config files, see load_config.
+DEFAULT_PROFILE             = 'default'
+CONNECTION_PROFILES         = {
+    DEFAULT_PROFILE : collections.OrderedDict(),
+    'read-heavy'    : collections.OrderedDict([ ('mmap_size',    '268435456'),  # 256 MB
+                                                ('cache_size',   '-65536'),     # 64 MB
+                                                ('temp_store',   'MEMORY'),
+                                                ('query_only',   'ON'), ]),
+    'bulk-load'     : collections.OrderedDict([ ('journal_mode', 'WAL'),
+                                                ('synchronous',  'OFF'),
+                                                ('cache_size',   '-262144'),    # 256 MB
+                                                ('temp_store',   'MEMORY'), ]),
+    'safe'          : collections.OrderedDict([ ('journal_mode', 'WAL'),
+                                                ('synchronous',  'FULL'),
+                                                ('foreign_keys', 'ON'), ]),
+}
+# Stored in the database file, they are skipped by pragma_bench.
+PERSISTENT_PRAGMAS          = ('journal_mode',)
+# Timed executions per profile of the pragma_bench query.
+PRAGMA_BENCH_RUNS           = 5
 
 CONFIG_FILES = [ '/etc/sqlite_cli.cfg',
                  os.path.join(os.path.expanduser('~'), '.sqlite_cli.cfg'),
                  './.sqlite_cli.cfg',
                  './sqlite_cli.cfg',]
 
+def _pragma_statement(name, value):
+    """ PRAGMA statement setting name to value, ValueError if one of them is malformed. """
+    if not re.match(r'^\w+$', name) or not re.match(r'^-?[\w.]+$', value):
+        raise ValueError('Malformed PRAGMA %s = %s' % (name, value,))
+    return 'PRAGMA %s = %s' % (name, value,)
+
+def _to_text(value):
+    """ Text (unicode) representation of a cell value, blobs as x'HEX'. """
+    # Exact type checks, this runs for every cell of a rendered result.
+    kind = type(value)
+    if kind is unicode:
+        return value
+    if kind is str:
+        return value.decode('utf-8', 'replace')
+    if kind is buffer:
+        return u"x'%s'" % (str(value).encode('hex'),)
+    return unicode(value)
+
+def _write_lines(lines, stream=None):
+    """ Write lines with a single write, unicode encoded for stream. """
+    if not lines:
+        return
+    stream = stream or sys.stdout
+    stream.write((u'\n'.join(lines) + u'\n').encode(getattr(stream, 'encoding', None) or 'utf-8', 'replace'))
+
+def _quote_identifier(name):
+    return '"%s"' % (name.replace('"', '""'),)
+
+def _is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+def _infer_column_type(values):
+    """ SQLite column type for a sample of values read from a file. """
+    column_type = 'INTEGER'
+    for value in values:
+        if value is None or value == '':
+            continue
+        if isinstance(value, (bool, int, long,)):
+            continue
+        if isinstance(value, float):
+            column_type = 'REAL'
+            continue
+        if not isinstance(value, basestring) or LEADING_ZERO.match(value):
+            return 'TEXT'
+        try:
+            int(value)
+            continue
+        except ValueError:
+            pass
+        try:
+            float(value)
+            column_type = 'REAL'
+        except ValueError:
+            return 'TEXT'
+    return column_type
+
 # Color Theme Settings = START ================================================
 COLUMN_NAME_COLOR   = YELLOW
 FRAME_COLOR         = BLUE
@@ -167,274 +380,3719 @@ DATA_COLOR          = LIGHT_GRAY
 HIGHLIGHT           = WHITE
 # Color Theme Settings = END ==================================================
 
-class SQLiteCli(Cmd):
+def _color_codes(color):
+    """ (start, end) escape sequences color wraps a text in, empty without colors. """
+    return tuple(color('\0').split('\0'))
+
+def _state_filename(directory, db_name):
+    """ File in directory holding the state of database db_name. """
+    import hashlib
+    key = hashlib.sha1(os.path.abspath(db_name)).hexdigest()
+    return os.path.join(directory, '%s.json' % (key,))
+
+# Schema Cache = START ========================================================
+class SchemaCache(object):
+    """ Table and column names of a database.
+
+    Table names are read once, the columns of a table on first use.
+    Everything is dropped and re-read as soon as PRAGMA schema_version
+    changes. The cache is persisted in SCHEMA_CACHE_DIR keyed by the
+    database path, so the next start with an unchanged schema doesn't
+    query sqlite_master at all.
+    """
     def __init__(self):
-        Cmd.__init__(self)
-        # FIXME: dont use color on prompt because readline gets confused with this
-        # FIXME: and \001 + \002 dont work everywere
-        self.prompt             = '==> '
-        self.ruler              = DARK_GRAY("=")
-        self.doc_header         = RED('Documented commands (type help <topic>):')
-        self.undoc_header       = RED('Undocumented commands:')
-        self.name               = None
-        self.connection         = None
-        self.mode               = LINE
-        self.isolation_level    = None # autocommit
-        self.loglevel           = 'DEBUG'
-        self._set_loglevel()
+        self.connection = None
+        self.db_name    = None
+        self.version    = None
+        self.tables     = set()
+        self.columns    = {} # { TABLE_NAME: [COLUMN_NAME_0, COLUMN_NAME_1, COLUMN_NAME_N,], }
+        self._dirty     = False
 
-        self.cache_table_names  = []
-        self.cache_column_names = {} # { TABLE_NAME: [COLUMN_NAME_0, COLUMN_NAME_1, COLUMN_NAME_N,], }
+    def load(self, connection, db_name):
+        """ Switch to connection, from disk if the stored schema version still matches. """
+        self.save()
+        self.connection = connection
+        self.db_name    = db_name
+        self.version    = None
+        self.tables     = set()
+        self.columns    = {}
+        filename        = self._filename()
+        if filename is not None and os.path.isfile(filename):
+            import json
+            try:
+                with open(filename, 'rb') as stream:
+                    data = json.load(stream)
+                if data.get('schema_version') == self.schema_version():
+                    self.version = data['schema_version']
+                    self.tables  = set(data['tables'])
+                    self.columns = data['columns']
+                    log.debug('Schema cache loaded from %s.', filename)
+                    return
+            except (IOError, ValueError, KeyError), e:
+                log.debug('Ignoring schema cache %s: %s', filename, e)
+        self.refresh()
 
-    # =========================================================================
-    def do_load_config(self, filename):
-        log.error('load_config is not implemented!')
+    def refresh(self):
+        """ Re-read the table names, columns are loaded again on demand. """
+        if self.connection is None:
+            return
+        self.version = self.schema_version()
+        self.tables  = set([ row[0] for row in self.connection.execute(SQL_GET_TABLE_NAMES) ])
+        self.columns = {}
+        self._dirty  = True
 
-    @staticmethod
-    def help_load_config():
-        print
-        print HIGHLIGHT("<<< load_config [FILENAME]")
-        print "   Load configuration from FILENAME."
-        print
-        print "   Without FILENAME configfiles will be "
-        print "   searched and loaded (adaptive) from:"
-        for filename in CONFIG_FILES:
-            print "      o) %s" % (filename,)
-        print
+    def validate(self):
+        """ Refresh if the schema has changed. Returns True if so. """
+        if self.connection is None or self.schema_version() == self.version:
+            return False
+        log.debug('Schema changed, refreshing schema cache.')
+        self.refresh()
+        return True
 
-    @staticmethod
-    def complete_load_config(text, line, begidx, endidx):
-        text_new    = "%s*" % (line[len('load_config') + 1:].strip(),)
-        completions = glob.glob(text_new)
-        # print
-        # print "text          : ", text
-        # print "text_new      : ", text_new
-        # print "line          : ", line
-        # print "begidx|endidx : %s|%s" % (begidx, endidx,)
-        # print "completitions : ", completions
-        # print
-        return completions
+    def schema_version(self):
+        return self.connection.execute('PRAGMA schema_version').fetchone()[0]
 
-    # =========================================================================
-    def do_mode(self, line):
-        if line.upper() in FORMATS.keys():
-            self.mode = line.upper()
-        elif len(line) == 0:
-            print "Actual mode is %s." % (HIGHLIGHT(self.mode),)
-        else:
-            log.error('Mode "%s" is unknown!', line)
+    def table_names(self):
+        self.validate()
+        return sorted(self.tables)
 
-    @staticmethod
-    def help_mode():
-        print
-        print HIGHLIGHT(">>> mode [MODE]")
-        print "   Set output mode to MODE."
-        print "   Use "
-        print "      mode <TAB><TAB>"
-        print "   to see all available modes."
-        print
+    def column_names(self, table_name):
+        self.validate()
+        if table_name not in self.tables:
+            return []
+        if table_name not in self.columns:
+            cursor = self.connection.execute('PRAGMA table_info(%s)' % (_quote_identifier(table_name),))
+            self.columns[table_name] = [ row[1] for row in cursor ]
+            self._dirty = True
+        return self.columns[table_name]
 
-    def complete_mode(self, text, line, begidx, endidx):
-        return self._complete(text, FORMATS.keys())
+    def save(self):
+        filename = self._filename()
+        if not self._dirty or filename is None:
+            return
+        import json
+        try:
+            if not os.path.isdir(SCHEMA_CACHE_DIR):
+                os.makedirs(SCHEMA_CACHE_DIR)
+            with open(filename, 'wb') as stream:
+                json.dump({ 'db'             : os.path.abspath(self.db_name),
+                            'schema_version' : self.version,
+                            'tables'         : sorted(self.tables),
+                            'columns'        : self.columns, }, stream)
+            self._dirty = False
+        except (IOError, OSError), e:
+            log.debug("Can't save schema cache %s: %s", filename, e)
 
-    # =========================================================================
-    @staticmethod
-    def do_cfg_table_column(line):
-        params = line.split(' ')
-        if len(params) == 1:
-            print('Configuration for Outputformat %s:' % HIGHLIGHT('TABLE'))
-            print('Maximum Table Width: %s' % FORMATS[TABLE].get(MAX_WIDTH, 'unset'))
-            available_configs = FORMATS[TABLE].get(COLUMN_WIDTHS, {})
+    def _filename(self):
+        if self.db_name is None or self.db_name == ':memory:' or self.version is None:
+            return None
+        return _state_filename(SCHEMA_CACHE_DIR, self.db_name)
+# Schema Cache = END ==========================================================
 
-            if len(available_configs) > 0:
-                print('Column Configurations:')
-                for col_idx, data in available_configs.iteritems():
-                    print('\tCol Index: %16s, max_width: %16s, min_width: %16s, truncate line: %s' % (
-                             DATA_COLOR(col_idx),
-                             DATA_COLOR(data.get(COLUMN_MAX_WIDTH, 'unset')),
-                             DATA_COLOR(data.get(COLUMN_MIN_WIDTH, 'unset')),
-                             DATA_COLOR(data.get(TRUNCATE_LINE, 'unset')),)
-                    )
-        else:
-            if FORMATS[TABLE].get(COLUMN_WIDTHS, None) is None:
-                FORMATS[TABLE][COLUMN_WIDTHS] = {}
+class PrefixIndex(object):
+    """ Sorted word list answering prefix lookups with bisect in O(log n + matches). """
+    def __init__(self, words=()):
+        self._known = set(words)
+        self._words = sorted(self._known)
 
-            if params[0].upper() == 'DEL':
-                if len(params) >= 2:
-                    col_idx = FORMATS[TABLE][COLUMN_WIDTHS][params[1]]
-                    del(FORMATS[TABLE][COLUMN_WIDTHS][col_idx])
-            else:
-                if params[0] not in FORMATS[TABLE][COLUMN_WIDTHS]:
-                    FORMATS[TABLE][COLUMN_WIDTHS][params[0]] = {}
+    def add(self, words):
+        new = [ word for word in words if word not in self._known ]
+        if not new:
+            return
+        self._known.update(new)
+        # Timsort merges the appended run in linear time.
+        self._words.extend(new)
+        self._words.sort()
 
-                if len(params) >= 2:
-                    if params[1].isdigit():
-                        FORMATS[TABLE][COLUMN_WIDTHS][params[0]][COLUMN_MAX_WIDTH] = int(params[1])
-                    else:
-                        log.error('Parameter for COLUMN_MAX_WIDTH is not numeric!')
+    def complete(self, prefix):
+        if not prefix:
+            return self._words[:]
+        lo = bisect.bisect_left(self._words, prefix)
+        hi = bisect.bisect_left(self._words, prefix + u'\uffff', lo)
+        return self._words[lo:hi]
 
-                if len(params) >= 3:
-                    if params[2].isdigit():
-                        FORMATS[TABLE][COLUMN_WIDTHS][params[0]][COLUMN_MIN_WIDTH] = int(params[2])
-                    else:
-                        log.error('Parameter for COLUMN_MIN_WIDTH is not numeric!')
+    def __len__(self):
+        return len(self._words)
 
-                if len(params) >= 4:
-                    value = params[3].upper()
-                    if value in ('TRUE', 'YES',):
-                        FORMATS[TABLE][COLUMN_WIDTHS][params[0]][TRUNCATE_LINE] = True
-                    elif value in ('FALSE', 'NO',):
-                        FORMATS[TABLE][COLUMN_WIDTHS][params[0]][TRUNCATE_LINE] = False
-                    else:
-                        log.error("Value for TRUNCATE_LINE is not one of (TRUE|FALSE|YES|NO)! It's %s.", params[3])
+# Result of a statement that is rendered without an open cursor.
+ResultInfo = collections.namedtuple('ResultInfo', 'description')
 
-    @staticmethod
-    def help_cfg_table_column():
-        print
-        print HIGHLIGHT(">> %s [COLUMN_INDEX] [MAX_WIDTH] [MIN_WIDTH] [TRUNCATE_LINE]") % (RED("cfg_table_column"),)
-        print "   Sets formating parameter for output-mode TABLE for a single column."
-        print
-        print "   If called without parameters the actual configuration is shown."
-        print
-        print "   [TRUNCATE_LINE] True/False/Yes/No (case insensitive) "
-        print "      if True or Yes the column data will be truncated at MAX_WIDTH."
-        print "   All parameters from right to left are optional."
-        print
+def _description(column_names):
+    """ cursor.description lookalike for column_names. """
+    return tuple([ (name, None, None, None, None, None, None,) for name in column_names ])
 
-    # =========================================================================
-    def do_sys_update_table_names(self, line):
-        """ update cache for table names. """
-        self._update_cache_table_names()
+class LazyRegex(object):
+    """ Regular expression compiled on first use, keeps module import fast. """
+    def __init__(self, pattern, flags=0):
+        self.pattern  = pattern
+        self.flags    = flags
+        self.compiled = None
 
-    def do_show_column_names(self, table_name):
-        for name in self.cache_column_names[table_name]:
-            print "%s.%s" % (LIGHT_GRAY(table_name), YELLOW(name),)
+    def __getattr__(self, name):
+        if self.compiled is None:
+            self.compiled = re.compile(self.pattern, self.flags)
+        return getattr(self.compiled, name)
 
-    # =========================================================================
-    def do_loglevel(self, level):
-        """ Get/Set loglevel. """
-        if len(level) == 0:
-            log.info('Actual loglevel is %s', self.loglevel)
-        elif level in LOG_LEVELS.keys():
-            self.loglevel = level
-            self._set_loglevel()
-        else:
-            log.error('Unknown loglevel "%s"! Known levels are: %s', level, LOG_LEVELS.keys())
+# Statements run through _execute to print their result in scripts,
+# all others are grouped and run with executescript.
+SQL_QUERY           = LazyRegex(r'\s*(SELECT|WITH|PRAGMA|EXPLAIN|VALUES)\b', re.IGNORECASE)
 
-    def complete_loglevel(self, text, line, begidx, endidx):
-        return self._complete(text, LOG_LEVELS.keys())
+def statement_end(text, start):
+    """ Index behind the SQL statement starting at start, -1 if it is incomplete.
 
-    # =========================================================================
-    def do_isolation_level(self, level):
-        """ Set's or get's the database isolation level."""
-        if not self._connected():
-            return
+    The statement ends at the first ; for which sqlite3.complete_statement
+    agrees, so ; in literals, comments and trigger bodies is skipped.
+    """
+    pos = text.find(';', start)
+    while pos >= 0:
+        if DB.complete_statement(text[start:pos + 1]):
+            return pos + 1
+        pos = text.find(';', pos + 1)
+    return -1
 
-        if len(level) == 0:
-            level_description = self.isolation_level
-            if self.isolation_level is None:
-                level_description = 'Autocommit'
-            log.info("Actual isolation_level is %s" % (level_description,))
-        elif level in ISOLATION_LEVELS:
-            if level == 'Autocommit':
-                level = None
-            self.isolation_level            = level
-            self.connection.isolation_level = level
-        else:
-            log.error('Unknown/handled isolation_level: %s', level)
-    @staticmethod
-    def help_isolation_level():
-        print
-        print HIGHLIGHT(">> %s [LEVEL]") % (RED('isolation_level'),)
-        print "   Sets the Database isolation level to [LEVEL]."
-        print
-        print "   Hint:"
-        print "      isolation_level <TAB><TAB>"
-        print "   to see all available levels."
-        print
-        print "   Called without parameter the actual isolation level is shown."
-        print
+# Profiling = START ===========================================================
+SQL_COMMENT         = LazyRegex(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+SQL_LITERAL         = LazyRegex(r"'(?:[^']|'')*'|\b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b|\bx'[0-9a-fA-F]*'")
+SQL_WHITESPACE      = LazyRegex(r'\s+')
+SQL_PUNCTUATION     = LazyRegex(r'\s*([,(=<>+*/;-])\s*|\s+(?=\))')
+# EXPLAIN QUERY PLAN details of a full table scan (SCAN without an index).
+SQL_FULL_SCAN       = LazyRegex(r'^SCAN (?:TABLE )?(?!SUBQUERY|CONSTANT ROW)(\S+)(?!.*\bUSING\b)', re.IGNORECASE)
 
-    def complete_isolation_level(self, text, line, begidx, endidx):
-        return self._complete(text, ISOLATION_LEVELS)
+def normalize_sql(sql):
+    """ sql without comments, literals replaced by ? and whitespace collapsed. """
+    sql = SQL_COMMENT.sub(' ', sql)
+    sql = SQL_LITERAL.sub('?', sql)
+    sql = SQL_PUNCTUATION.sub(lambda match: match.group(1) or '', SQL_WHITESPACE.sub(' ', sql))
+    return sql.strip().rstrip(';').lower()
 
-    # =========================================================================
-    @staticmethod
-    def emptyline():
-        return
+def _percentile(values, percent):
+    """ Nearest-rank percentile of sorted values. """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1))]
 
-    # =========================================================================
-    def do_use(self, db_name):
-        """ Open a sqlite database file. """
-        self.name                   = db_name
-        self.connection             = DB.connect(db_name, isolation_level=self.isolation_level)
-        #self.connection            = DB.connect(db_name, detect_types=DB.PARSE_DECLTYPES|DB.PARSE_COLNAMES)
-        self.connection.row_factory = DB.Row
-        # .....................................................................
-        cur                         = self.connection.cursor()
-        cur.execute('SELECT SQLITE_VERSION() as version')
-        data = cur.fetchone()
-        log.debug("Connected to database '%s'.", db_name)
-        log.debug("SQLiteVersion is '%s'.", data['version'])
-        log.debug("Updateing table names cache...")
-        self._update_cache_table_names()
-        log.debug("done.")
+class StatementStats(object):
+    """ Timings (in seconds) of a single executed statement. """
+    __slots__ = ('sql', 'started', 'execute', 'first_row', 'fetch', 'total', 'rows', 'plan', 'full_scans',)
 
-    @staticmethod
-    def help_use():
-        print
-        print HIGHLIGHT(">> %s [DATABASE FILE NAME]") % (RED('use'),)
-        print "   Opens the given SQLite Database file."
-        print
-        print "   Hint:"
-        print "      use <TAB><TAB>"
-        print "   To see a list of potential database files in the actual working directory"
-        print "   with a filter of *.db, *.sqlite (Filter is configurable)."
-        print
+    def __init__(self, sql):
+        self.sql        = sql
+        self.started    = time.time()
+        self.execute    = 0.0   # prepare and first step, the sqlite3 module doesn't separate them
+        self.first_row  = 0.0
+        self.fetch      = 0.0   # time spent in fetchmany()
+        self.total      = 0.0
+        self.rows       = 0
+        self.plan       = []
+        self.full_scans = []
 
-    @staticmethod
-    def complete_use(text, line, begidx, endidx):
-        text_new    = "%s*" % (text,)
-        completions = []
-        for fn in glob.glob(text_new):
-            if os.path.isfile(fn):
-                for ending in DATABASE_FILENAME_SUFFIXES:
-                    if fn.endswith(ending):
-                        completions.append(fn)
-            else:
-                completions.append(fn)
-        return completions
+    @property
+    def render(self):
+        return max(0.0, self.total - self.execute - self.fetch)
 
-    # =========================================================================
-    def complete_load(self, text, line, begidx, endidx):
-        filenames = []
-        for entry in os.listdir('./'):
-            if os.path.isfile(entry):
-                filenames.append(entry)
-        return self._complete(text, filenames)
+    def rows_per_second(self):
+        return self.rows / max(self.total, 1e-6)
+# Profiling = END =============================================================
 
-    # =========================================================================
-    def do_quit(self, args):
-        """ Exit shell. """
-        log.info("== Exit shell ==")
-        sys.exit(0)
+# Table Statistics and Index Advisor = START ==================================
+# Rows sampled per table by analyze_table.
+ANALYZE_SAMPLE_ROWS = 10000
+# Timed runs of the query before and after "advise create".
+ADVISE_RUNS         = 3
+# Covering indexes get at most this many columns.
+ADVISE_MAX_COLUMNS  = 6
+# Plan details of tables that would profit from an index.
+SQL_AUTOMATIC_INDEX = LazyRegex(r'^SEARCH (?:TABLE )?(\S+) USING AUTOMATIC', re.IGNORECASE)
+SQL_TABLE_ALIAS     = LazyRegex(r'\b(?:FROM|JOIN)\s+([\w$]+)(?:\s+(?:AS\s+)?(?!(?:WHERE|JOIN|ON|USING|LEFT|RIGHT|'
+                                r'INNER|OUTER|CROSS|NATURAL|GROUP|ORDER|LIMIT|UNION|EXCEPT|INTERSECT)\b)([\w$]+))?',
+                                re.IGNORECASE)
+SQL_EQUALITY        = LazyRegex(r'(?:([\w$]+)\.)?([\w$]+)\s*(?:==?|\bIN\b|\bIS\b(?!\s+NOT\b))\s*(?:([\w$]+)\.([\w$]+))?',
+                                re.IGNORECASE)
+SQL_RANGE           = LazyRegex(r'(?:([\w$]+)\.)?([\w$]+)\s*(?:<=?|>=?|\bBETWEEN\b|\bLIKE\b|\bGLOB\b)', re.IGNORECASE)
+SQL_COLUMN_REF      = LazyRegex(r'(?:([\w$]+)\.)?([\w$]+)')
 
-    # =========================================================================
-    def do_shell(self, line):
-        """ Run a shell command. """
-        log.debug("running shell command: %s", line)
-        output = os.popen(line).read()
-        print output
+def estimate_distinct(sample, total):
+    """ Distinct values of a column with total rows, estimated from a sample
+    of its values (GEE estimator: sqrt(total/sampled) * singletons + others).
+    A sample without any repeated value is taken as a unique column. """
+    if not sample:
+        return 0
+    counts     = collections.Counter(sample)
+    singletons = sum([ 1 for count in counts.values() if count == 1 ])
+    if singletons == len(sample):
+        return total
+    estimate   = (float(total) / len(sample)) ** 0.5 * singletons + (len(counts) - singletons)
+    return int(round(min(max(estimate, len(counts)), total)))
 
-    # =========================================================================
-    def do_EOF(self, line):
-        return True
+def _clause(sql, start, ends):
+    """ Text of the clause after keyword start up to one of the keywords ends. """
+    match = re.search(r'\b%s\b(.*?)(?:\b(?:%s)\b|$)' % (start, '|'.join(ends),), sql, re.IGNORECASE | re.DOTALL)
+    return match.group(1) if match is not None else ''
 
-    # =========================================================================
-    def do_commit(self, line):
-        """ Commit actual transactions. """
-        if self.connection is not None:
-            self.connection.commit()
+def suggest_index(sql, alias, table_name, column_names):
+    """ Columns of an index on table_name (named alias in sql) for sql:
+    equality columns, then one range or the ORDER BY columns, then the
+    other selected columns to make it covering. Empty if nothing in sql
+    would use an index. This is a heuristic for simple statements.
+    """
+    known = dict([ (name.lower(), name,) for name in column_names ])
+    names = set([ alias.lower(), table_name.lower(), ])
+
+    def columns(matches):
+        found = []
+        for qualifier, name in matches:
+            if (not qualifier or qualifier.lower() in names) and name.lower() in known:
+                if known[name.lower()] not in found:
+                    found.append(known[name.lower()])
+        return found
+
+    predicates = ' '.join([ _clause(sql, 'WHERE', ['GROUP', 'ORDER', 'LIMIT', 'HAVING', 'UNION', 'EXCEPT', 'INTERSECT',]) ] +
+                          re.findall(r'\bON\b(.*?)(?=\b(?:JOIN|LEFT|INNER|CROSS|WHERE|GROUP|ORDER|LIMIT)\b|$)',
+                                     sql, re.IGNORECASE | re.DOTALL))
+    equal = []
+    for qualifier, name, other_qualifier, other_name in SQL_EQUALITY.findall(predicates):
+        equal.append((qualifier, name,))
+        if other_name:
+            equal.append((other_qualifier, other_name,))
+    index  = columns(equal)
+    ranges = [ column for column in columns(SQL_RANGE.findall(predicates)) if column not in index ]
+    order  = [ column for column in columns(SQL_COLUMN_REF.findall(_clause(sql, 'ORDER BY', ['LIMIT',])))
+               if column not in index ]
+    index += ranges[:1] or order
+    if not index:
+        return []
+    selected = _clause(sql, 'SELECT', ['FROM',])
+    if not re.search(r'(?:^|[\s,.])\*', selected):
+        others = [ column for column in columns(SQL_COLUMN_REF.findall(selected + ' ' + predicates)) if column not in index ]
+        if len(index) + len(others) <= ADVISE_MAX_COLUMNS:
+            index += others
+    return index
+# Table Statistics and Index Advisor = END ====================================
+
+# Stored Queries = START ======================================================
+# Parameters of a statement, literals and comments are skipped.
+SQL_PARAMETER       = LazyRegex(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|"
+                                 r"(\?\d*)|([:@$][A-Za-z_]\w*)", re.DOTALL)
+# Arguments of run, quoted parts may contain spaces.
+SQL_ARGUMENT        = LazyRegex(r"""(?:[^\s'"]+|'(?:[^']|'')*'|"(?:[^"]|"")*")+""")
+SQL_QUOTED_ARGUMENT = LazyRegex(r"""^(?:'((?:[^']|'')*)'|"((?:[^"]|"")*)")$""")
+# Literals, quoted identifiers and comments, and the writing statement of a WITH clause.
+SQL_QUOTED          = LazyRegex(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\]|--[^\n]*|/\*.*?\*/", re.DOTALL)
+SQL_WITH_WRITE      = LazyRegex(r'\b(?:INSERT|UPDATE|DELETE)\b|\bREPLACE\s+INTO\b', re.IGNORECASE)
+# Numbers with leading zeros (zip codes, ids) are text, as number the zeros get lost.
+LEADING_ZERO        = LazyRegex(r'[-+]?0\d')
+
+def _parse_value(text):
+    """ Parameter value for text given on the command line or in a file. """
+    if text is None or text == '' or text.upper() == 'NULL':
+        return None
+    if not LEADING_ZERO.match(text):
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            return float(text)
+        except ValueError:
+            pass
+    return text.decode('utf-8') if isinstance(text, str) else text
+
+def _argument_value(text):
+    """ Parameter value of a run argument, quoted arguments are always text. """
+    match = SQL_QUOTED_ARGUMENT.match(text)
+    if match is None:
+        return _parse_value(text)
+    if match.group(1) is not None:
+        text = match.group(1).replace("''", "'")
+    else:
+        text = match.group(2).replace('""', '"')
+    return text.decode('utf-8') if isinstance(text, str) else text
+
+def split_arguments(line):
+    """ Arguments of line separated by spaces, quotes are kept (see _argument_value). """
+    arguments = SQL_ARGUMENT.findall(line)
+    if re.sub(r'\s', '', ''.join(arguments)) != re.sub(r'\s', '', line):
+        raise ValueError('unbalanced quotes')
+    return arguments
+
+class SavedQuery(object):
+    """ A stored statement with its parsed parameter list. """
+    def __init__(self, name, sql):
+        self.name       = name
+        self.sql        = sql
+        self.positional = 0
+        self.named      = []
+        for match in SQL_PARAMETER.finditer(sql):
+            if match.group(1) is not None:
+                # Like SQLite: ?NNN is slot NNN, ? the slot after the highest one so far.
+                number          = int(match.group(1)[1:]) if len(match.group(1)) > 1 else self.positional + 1
+                self.positional = max(self.positional, number)
+            elif match.group(2) is not None and match.group(2)[1:] not in self.named:
+                self.named.append(match.group(2)[1:])
+        if self.positional and self.named:
+            raise ValueError('positional and named parameters can not be mixed')
+
+    def bind(self, args):
+        """ Parameters for execute() from command line arguments.
+
+        Named parameters are given as NAME=VALUE or in the order they
+        appear in the statement.
+        """
+        if self.named:
+            params = {}
+            for idx, arg in enumerate(args):
+                name, sep, value = arg.partition('=')
+                if sep and name in self.named:
+                    params[name] = _argument_value(value)
+                elif idx < len(self.named):
+                    params[self.named[idx]] = _argument_value(arg)
+                else:
+                    raise ValueError('too many arguments')
+            missing = [ name for name in self.named if name not in params ]
+            if missing:
+                raise ValueError('missing parameters: %s' % (', '.join(missing),))
+            return params
+        if len(args) != self.positional:
+            raise ValueError('%s parameters expected, got %s' % (self.positional, len(args),))
+        return tuple([ _argument_value(arg) for arg in args ])
+
+    def bind_file(self, stream):
+        """ Parameter generator for the rows of a CSV file with a header line. """
+        import csv
+        reader = csv.reader(stream, delimiter=FORMATS[CSV][SEPARATOR])
+        header = next(reader, [])
+        if self.named:
+            missing = [ name for name in self.named if name not in header ]
+            if missing:
+                raise ValueError('columns missing in file: %s' % (', '.join(missing),))
+            positions = [ (name, header.index(name),) for name in self.named ]
+            for row in reader:
+                yield dict([ (name, _parse_value(row[idx]),) for name, idx in positions ])
+        else:
+            for row in reader:
+                yield tuple([ _parse_value(value) for value in row[:self.positional] ])
+
+    def signature(self):
+        if self.named:
+            return ' '.join([ ':%s' % (name,) for name in self.named ])
+        return ' '.join([ '?' ] * self.positional)
+
+class QueryStore(object):
+    """ SavedQuery objects of a database, persisted in QUERY_STORE_DIR. """
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.queries = collections.OrderedDict()
+        filename     = self._filename()
+        if filename is not None and os.path.isfile(filename):
+            import json
+            try:
+                with open(filename, 'rb') as stream:
+                    for name, sql in json.load(stream, object_pairs_hook=collections.OrderedDict).items():
+                        self.queries[name] = SavedQuery(name, sql)
+            except (IOError, ValueError), e:
+                log.error("Can't read stored queries from %s: %s", filename, e)
+
+    def add(self, name, sql):
+        self.queries[name] = SavedQuery(name, sql)
+        self.save()
+
+    def remove(self, name):
+        if self.queries.pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        filename = self._filename()
+        if filename is None:
+            return
+        import json
+        try:
+            if not os.path.isdir(QUERY_STORE_DIR):
+                os.makedirs(QUERY_STORE_DIR)
+            with open(filename, 'wb') as stream:
+                json.dump(collections.OrderedDict([ (name, query.sql,) for name, query in self.queries.items() ]),
+                          stream, indent=2)
+        except (IOError, OSError), e:
+            log.error("Can't save stored queries to %s: %s", filename, e)
+
+    def _filename(self):
+        if self.db_name is None or self.db_name == ':memory:':
+            return None
+        return _state_filename(QUERY_STORE_DIR, self.db_name)
+# Stored Queries = END ========================================================
+
+# Result Cache = START ========================================================
+# Statements whose result can change without a change of the database.
+SQL_VOLATILE        = LazyRegex(r"\b(random|randomblob|changes|total_changes|last_insert_rowid|"
+                                 r"current_date|current_time|current_timestamp)\b|'now'", re.IGNORECASE)
+
+CacheEntry = collections.namedtuple('CacheEntry', 'validity description rows size')
+
+def _estimate_size(rows):
+    """ Rough memory use of rows in bytes. """
+    return sum([ sys.getsizeof(row) + sum([ sys.getsizeof(value) for value in row ]) for row in rows ])
+
+class ResultCache(object):
+    """ LRU cache of query results bounded by an estimated memory budget.
+
+    Every entry carries the validity token that was current when the
+    query ran, an entry with a different token is stale.
+    """
+    # Rows used to estimate the size of a whole result.
+    SIZE_SAMPLE_ROWS = 64
+
+    def __init__(self, budget=RESULT_CACHE_BUDGET):
+        self.budget     = budget
+        self.size       = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self._entries   = collections.OrderedDict()
+
+    def get(self, key, validity):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.validity != validity:
+            self.size -= entry.size
+            entry      = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits         += 1
+        return entry
+
+    def put(self, key, validity, description, rows):
+        size = _estimate_size(rows)
+        if size > self.budget:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        self._evict(size)
+        self._entries[key] = CacheEntry(validity, description, rows, size)
+        self.size         += size
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict(0)
+
+    def _evict(self, needed):
+        """ Drop least recently used entries until needed bytes fit into the budget. """
+        while self._entries and self.size + needed > self.budget:
+            evicted         = self._entries.popitem(last=False)[1]
+            self.size      -= evicted.size
+            self.evictions += 1
+
+    def collect(self, rows, holder):
+        """ Yield rows. holder[0] is the list of all rows, None if they exceed the budget. """
+        collected = []
+        row_size  = None
+        holder[:] = [collected]
+        for row in rows:
+            if collected is not None:
+                collected.append(row)
+                if len(collected) == self.SIZE_SAMPLE_ROWS:
+                    row_size = _estimate_size(collected) / float(len(collected))
+                if row_size is not None and len(collected) * row_size > self.budget:
+                    collected = holder[0] = None
+            yield row
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+# Result Cache = END ==========================================================
+
+# Columnar Results = START ====================================================
+def _import_optional(name):
+    """ Module name, None if it isn't installed. """
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+class ColumnarResult(object):
+    """ Result set stored column wise, numbers in typed array.array buffers.
+
+    Integer columns are kept as array('l'), real columns as array('d')
+    (integers of a column that also holds reals become floats). Columns
+    with text, blobs, NULLs, integers exceeding a C long or, next to reals,
+    integers a float can't hold exactly (FLOAT_EXACT_INT) are lists.
+    """
+    def __init__(self, column_names):
+        self.column_names = list(column_names)
+        self.columns      = [ array.array(COLUMN_TYPECODES[0]) for _ in self.column_names ]
+        self.rows         = 0
+
+    def extend(self, batch):
+        """ Append a fetchmany() batch of plain tuples. """
+        if not batch:
+            return
+        for idx, values in enumerate(zip(*batch)):
+            column = self.columns[idx]
+            while not isinstance(column, list):
+                try:
+                    converted = array.array(column.typecode, values)
+                except TypeError:
+                    column = self.columns[idx] = self._widen(column)
+                    continue
+                except OverflowError:
+                    column = self.columns[idx] = list(column)
+                    continue
+                if column.typecode == 'd' and not self._exact_floats(values):
+                    column = self.columns[idx] = list(column)
+                    continue
+                column.extend(converted)
+                break
+            else:
+                column.extend(values)
+        self.rows += len(batch)
+
+    @classmethod
+    def _widen(cls, column):
+        """ column converted to the next typecode, a list after the last one. """
+        position = COLUMN_TYPECODES.index(column.typecode) + 1
+        if position < len(COLUMN_TYPECODES):
+            if COLUMN_TYPECODES[position] != 'd' or cls._exact_floats(column):
+                return array.array(COLUMN_TYPECODES[position], column)
+        return list(column)
+
+    @staticmethod
+    def _exact_floats(values):
+        """ True if all integers of values are exact as float. """
+        return not any([ isinstance(value, (int, long)) and abs(value) > FLOAT_EXACT_INT for value in values ])
+
+    def type_name(self, idx):
+        column = self.columns[idx]
+        if isinstance(column, list):
+            return 'object'
+        return { 'l': 'int64' if array.array('l').itemsize == 8 else 'int32', 'd': 'float64', }[column.typecode]
+
+    def index(self, column_name):
+        """ Position of column_name, ValueError if there is no such column. """
+        return self.column_names.index(column_name)
+
+    def head(self, count=DF_HEAD_ROWS):
+        return zip(*[ column[:count] for column in self.columns ])
+
+    def describe(self):
+        """ Rows of (column, type, count, nulls, distinct, min, max, mean). """
+        numpy = _import_optional('numpy')
+        rows  = []
+        for idx, column in enumerate(self.columns):
+            if isinstance(column, list):
+                values = [ value for value in column if value is not None ]
+                count  = len(values)
+                low    = min(values) if values else None
+                high   = max(values) if values else None
+                mean   = None
+                if values and all([ isinstance(value, (int, long, float)) for value in values ]):
+                    mean = sum(values) / float(count)
+                distinct = len(set(values))
+            elif not column:
+                count, distinct, low, high, mean = 0, 0, None, None, None
+            elif numpy is not None:
+                values   = self._to_numpy(numpy, column)
+                count    = len(values)
+                low      = values.min().item()
+                high     = values.max().item()
+                mean     = values.mean().item()
+                distinct = len(numpy.unique(values))
+            else:
+                count    = len(column)
+                low      = min(column)
+                high     = max(column)
+                mean     = sum(column) / float(count)
+                distinct = len(set(column))
+            rows.append((self.column_names[idx], self.type_name(idx), count, self.rows - count,
+                         distinct, low, high, None if mean is None else round(mean, 6),))
+        return rows
+
+    def value_counts(self, column_name, count=DF_VALUE_COUNTS):
+        """ The count most frequent values of column_name as (value, count) pairs. """
+        column = self.columns[self.index(column_name)]
+        numpy  = _import_optional('numpy')
+        if numpy is not None and not isinstance(column, list):
+            values, counts = numpy.unique(self._to_numpy(numpy, column), return_counts=True)
+            order          = numpy.argsort(-counts, kind='mergesort')[:count]
+            return [ (values[idx].item(), counts[idx].item(),) for idx in order ]
+        return collections.Counter(column).most_common(count)
+
+    @staticmethod
+    def _to_numpy(numpy, column):
+        if isinstance(column, list):
+            return numpy.array(column, dtype=object)
+        if not column:
+            return numpy.empty(0, dtype=column.typecode)
+        # Copied, the array.array may be extended after the conversion.
+        return numpy.frombuffer(column, dtype=column.typecode).copy()
+
+    def to_numpy(self):
+        """ OrderedDict of column name to NumPy array, needs numpy. """
+        numpy = __import__('numpy')
+        return collections.OrderedDict([ (name, self._to_numpy(numpy, column),)
+                                         for name, column in zip(self.column_names, self.columns) ])
+
+    def to_dataframe(self):
+        """ The result as pandas DataFrame, needs numpy and pandas. """
+        numpy  = __import__('numpy')
+        pandas = __import__('pandas')
+        frame  = pandas.DataFrame(collections.OrderedDict([ (idx, self._to_numpy(numpy, column),)
+                                                            for idx, column in enumerate(self.columns) ]))
+        frame.columns = self.column_names
+        return frame
+# Columnar Results = END ======================================================
+
+# Sharded Queries = START =====================================================
+SHARD_AGGREGATES    = ('COUNT', 'SUM', 'TOTAL', 'MIN', 'MAX',)
+# Aggregates which can't be merged, MIN/MAX with more arguments are scalar functions.
+SHARD_UNMERGEABLE   = ('AVG', 'GROUP_CONCAT',)
+# Statements use_many runs in a savepoint on every shard.
+SQL_SHARD_CHANGE    = LazyRegex(r'\s*(?:INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.IGNORECASE)
+
+def _split_top_level(text, separator=','):
+    """ Split text at separator outside of brackets and quotes. """
+    parts, depth, quote, start = [], 0, None, 0
+    for idx, char in enumerate(text):
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in '\'"`[':
+            quote = ']' if char == '[' else char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:idx].strip())
+            start = idx + 1
+    parts.append(text[start:].strip())
+    return parts
+
+def _top_level(sql):
+    """ sql without literals and the content of brackets (subqueries, calls). """
+    code, previous = SQL_QUOTED.sub("''", sql), None
+    while code != previous:
+        code, previous = re.sub(r'\([^()]*\)', '()', code), code
+    return code
+
+def _call_arguments(text, start):
+    """ (arguments, rest) of the function call whose argument list starts at start. """
+    depth = 1
+    for idx in range(start, len(text)):
+        if text[idx] == '(':
+            depth += 1
+        elif text[idx] == ')':
+            depth -= 1
+            if depth == 0:
+                return text[start:idx], text[idx + 1:]
+    return text[start:], ''
+
+def _aggregate_call(text, match):
+    """ Name of the aggregate function called at match (of a "name(" pattern) or None. """
+    name = match.group(1).upper()
+    if name in ('MIN', 'MAX',) and len(_split_top_level(_call_arguments(text, match.end())[0])) > 1:
+        return None
+    return name if name in SHARD_AGGREGATES or name in SHARD_UNMERGEABLE else None
+
+def _normalized_term(term):
+    """ term lower case, without quotes and with single spaces for comparisons. """
+    return SQL_WHITESPACE.sub(' ', re.sub(r'["`\[\]]', '', term)).strip().lower()
+
+def _shard_group_by(sql):
+    """ Terms of the GROUP BY clause of sql (not of its subqueries). """
+    if not re.search(r'\sGROUP\s+BY\s', _top_level(sql), re.IGNORECASE):
+        return []
+    match = re.search(r'^.*\sGROUP\s+BY\s+(.*?)(?:\s(?:HAVING|WINDOW|ORDER\s+BY|LIMIT)\s.*)?\s*;?\s*$',
+                      SQL_COMMENT.sub(' ', sql), re.IGNORECASE | re.DOTALL)
+    return _split_top_level(match.group(1)) if match else []
+
+def _shard_aggregates(sql, column_names):
+    """ Aggregate function per result column (None for group keys).
+
+    Returns None if sql has no aggregates or ones which can't be merged:
+    AVG, GROUP_CONCAT, DISTINCT and window aggregates, aggregates inside
+    expressions, aggregates combined with HAVING or LIMIT and GROUP BY
+    terms which aren't result columns.
+    """
+    code  = SQL_QUOTED.sub("''", sql)
+    match = re.match(r'^\s*SELECT\s+(.*?)\s+FROM\s', code, re.IGNORECASE | re.DOTALL)
+    if match is None or re.match(r'DISTINCT\s', match.group(1), re.IGNORECASE):
+        return None
+    items = _split_top_level(match.group(1))
+    if len(items) != len(column_names):
+        return None
+
+    aggregates = []
+    for item in items:
+        call  = re.match(r'^(\w+)\s*\(', item)
+        name  = _aggregate_call(item, call) if call is not None else None
+        plain = name is not None and re.match(r'^(?:\s+(?:AS\s+)?\S+)?$',
+                                              _call_arguments(item, call.end())[1], re.IGNORECASE)
+        if plain and name in SHARD_AGGREGATES and \
+                not re.match(r'\s*DISTINCT\s', _call_arguments(item, call.end())[0], re.IGNORECASE):
+            aggregates.append(name)
+        elif any([ _aggregate_call(item, found) for found in re.finditer(r'\b(\w+)\s*\(', item) ]):
+            log.warning('%s can not be merged across shards, results are concatenated.', item)
+            return None
+        else:
+            aggregates.append(None)
+    if all(aggregate is None for aggregate in aggregates):
+        return None
+    for clause in ('HAVING', 'LIMIT',):
+        # Applied per shard, they drop groups before the merge.
+        if re.search(r'\s%s\s' % (clause,), _top_level(sql), re.IGNORECASE):
+            log.warning('Aggregates with %s can not be merged across shards, results are concatenated.', clause)
+            return None
+
+    # Groups are merged by the key columns, each GROUP BY term has to be one.
+    keys = set()
+    for idx, aggregate in enumerate(aggregates):
+        if aggregate is None:
+            names = [ str(idx + 1), _normalized_term(column_names[idx]),
+                      _normalized_term(re.sub(r'\s+AS\s+\S+$', '', items[idx], flags=re.IGNORECASE)), ]
+            keys.update(names + [ name.split('.')[-1] for name in names ])
+    for term in _shard_group_by(sql):
+        normalized = _normalized_term(term)
+        if normalized not in keys and normalized.split('.')[-1] not in keys:
+            log.warning('GROUP BY %s is not a result column, shard results are concatenated.', term)
+            return None
+    return aggregates
+
+def _shard_order_by(sql, column_names):
+    """ [(column index, descending), ...] of the trailing ORDER BY of sql. """
+    match = re.search(r'\sORDER\s+BY\s+(.*?)(?:\s+LIMIT\s.*)?\s*;?\s*$', sql, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        return []
+    names = [ name.lower() for name in column_names ]
+    order = []
+    for term in _split_top_level(match.group(1)):
+        parts      = term.split()
+        descending = len(parts) > 1 and parts[1].upper() == 'DESC'
+        expr       = parts[0].strip('"`[]').lower()
+        if expr.isdigit() and 0 < int(expr) <= len(names):
+            order.append((int(expr) - 1, descending,))
+        elif expr in names:
+            order.append((names.index(expr), descending,))
+        elif expr.split('.')[-1] in names:
+            order.append((names.index(expr.split('.')[-1]), descending,))
+        else:
+            log.warning('ORDER BY %s is not a result column, shard results are not merged in order.', term)
+            return []
+    return order
+
+def _shard_limit(sql):
+    match = re.search(r'\sLIMIT\s+(?:\d+\s*,\s*)?(\d+)(?:\s+OFFSET\s+\d+)?\s*;?\s*$', sql, re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+def _shard_offset(sql):
+    """ True if the LIMIT of sql has an OFFSET. """
+    return bool(re.search(r'\sLIMIT\s.*(?:\sOFFSET\s|,)', _top_level(sql), re.IGNORECASE | re.DOTALL))
+
+class _SortKey(object):
+    """ Sort key of a row for ORDER BY terms with mixed directions. """
+    __slots__ = ('row', 'order',)
+
+    def __init__(self, row, order):
+        self.row   = row
+        self.order = order
+
+    def __lt__(self, other):
+        for idx, descending in self.order:
+            mine, theirs = self.row[idx], other.row[idx]
+            if mine != theirs:
+                return theirs < mine if descending else mine < theirs
+        return False
+
+def _merge_aggregates(aggregates, results):
+    """ Combine the per shard rows of an aggregate query by their group keys. """
+    groups = collections.OrderedDict()
+    keys   = [ idx for idx, aggregate in enumerate(aggregates) if aggregate is None ]
+    for rows in results:
+        for row in rows:
+            key = tuple([ row[idx] for idx in keys ])
+            if key not in groups:
+                groups[key] = list(row)
+                continue
+            merged = groups[key]
+            for idx, aggregate in enumerate(aggregates):
+                value = row[idx]
+                if aggregate is None or value is None:
+                    continue
+                if merged[idx] is None:
+                    merged[idx] = value
+                elif aggregate in ('COUNT', 'SUM', 'TOTAL',):
+                    merged[idx] += value
+                elif aggregate == 'MIN':
+                    merged[idx] = min(merged[idx], value)
+                elif aggregate == 'MAX':
+                    merged[idx] = max(merged[idx], value)
+    return [ tuple(row) for row in groups.values() ]
+
+def merge_shard_results(sql, description, results):
+    """ Merge the per shard results of sql into one row iterator.
+
+    Aggregates (COUNT/SUM/TOTAL/MIN/MAX) are re-aggregated by the
+    non-aggregate columns, ORDER BY results are merge-sorted, all
+    others are concatenated. A trailing LIMIT is applied again.
+    results are row iterators, only aggregates are kept in memory.
+    """
+    if _shard_offset(sql):
+        log.warning('OFFSET skips rows of every shard, the merged result misses rows.')
+    column_names = [ cn[0] for cn in description ]
+    aggregates   = _shard_aggregates(sql, column_names)
+    order        = _shard_order_by(sql, column_names)
+    if aggregates is not None:
+        rows = _merge_aggregates(aggregates, results)
+        if order:
+            rows.sort(key=lambda row: _SortKey(row, order))
+        rows = iter(rows)
+    elif order:
+        decorated = [ ((_SortKey(row, order), shard, row) for row in rows)
+                      for shard, rows in enumerate(results) ]
+        rows      = ( item[2] for item in heapq.merge(*decorated) )
+    else:
+        rows = itertools.chain(*results)
+
+    limit = _shard_limit(sql)
+    if limit is not None:
+        rows = itertools.islice(rows, limit)
+    return rows
+# Sharded Queries = END =======================================================
+
+# Background Jobs = START =====================================================
+JOB_PENDING         = 'PENDING'
+JOB_RUNNING         = 'RUNNING'
+JOB_DONE            = 'DONE'
+JOB_FAILED          = 'FAILED'
+JOB_CANCELLED       = 'CANCELLED'
+
+class SpillBuffer(object):
+    """ Row buffer that keeps the first rows in memory and pickles the rest into a temporary file. """
+    def __init__(self, memory_rows=BG_SPILL_ROWS):
+        self.memory_rows = memory_rows
+        self.count       = 0
+        self._rows       = []
+        self._spill      = None
+
+    def extend(self, rows):
+        import cPickle
+        if self._spill is None and len(self._rows) + len(rows) <= self.memory_rows:
+            self._rows.extend(rows)
+        else:
+            if self._spill is None:
+                import tempfile
+                self._spill = tempfile.TemporaryFile()
+            try:
+                data = cPickle.dumps(rows, cPickle.HIGHEST_PROTOCOL)
+            except (TypeError, cPickle.PicklingError):
+                # BLOB values come as buffer objects which can't be pickled.
+                data = cPickle.dumps([ tuple([ str(value) if isinstance(value, buffer) else value
+                                               for value in row ]) for row in rows ],
+                                     cPickle.HIGHEST_PROTOCOL)
+            self._spill.write(data)
+        self.count += len(rows)
+
+    def __iter__(self):
+        import cPickle
+        for row in self._rows:
+            yield row
+        if self._spill is not None:
+            self._spill.seek(0)
+            while True:
+                try:
+                    batch = cPickle.load(self._spill)
+                except EOFError:
+                    break
+                for row in batch:
+                    yield row
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._rows = []
+
+class JobCancelled(Exception):
+    """ Raised by a runner that stopped because its job was cancelled. """
+    pass
+
+class Job(object):
+    """ A background job. runner(job) does the work in a worker thread. """
+    def __init__(self, job_id, title, runner):
+        import threading
+        self.id          = job_id
+        self.title       = title
+        self.runner      = runner
+        self.state       = JOB_PENDING
+        self.connection  = None   # set by the runner, used to interrupt it
+        self.description = None   # cursor description of the result
+        self.result      = None   # SpillBuffer with the result rows
+        self.changes     = 0
+        self.progress    = None   # progress/summary text of jobs without a result
+        self.error       = None
+        self.started     = None
+        self.finished    = None
+        self.cancelled   = False
+        self.done        = threading.Event()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def run(self):
+        if self.cancelled:
+            self.state = JOB_CANCELLED
+            self.done.set()
+            return
+        self.state   = JOB_RUNNING
+        self.started = time.time()
+        try:
+            self.runner(self)
+            # A runner may return early after a cancel, its result is incomplete.
+            self.state = JOB_CANCELLED if self.cancelled else JOB_DONE
+        except Exception, e:
+            self.state = JOB_CANCELLED if self.cancelled else JOB_FAILED
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+            self.done.set()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.state == JOB_RUNNING and self.connection is not None:
+            try:
+                self.connection.interrupt()
+            except DB.Error:
+                pass
+
+    def wait(self):
+        """ Wait for the job, Ctrl-C stops waiting but not the job. """
+        while not self.done.wait(0.1):
+            pass
+# Background Jobs = END =======================================================
+
+# Backup = START ==============================================================
+SQLITE_OK           = 0
+SQLITE_BUSY         = 5
+SQLITE_LOCKED       = 6
+SQLITE_DONE         = 101
+SQLITE_OPEN_READONLY  = 0x01
+SQLITE_OPEN_READWRITE = 0x02
+SQLITE_OPEN_CREATE    = 0x04
+
+class BackupError(Exception):
+    pass
+
+_sqlite_library = None
+def sqlite_library():
+    """ The SQLite C library (via ctypes) used by the sqlite3 module. """
+    global _sqlite_library
+    if _sqlite_library is None:
+        import ctypes, ctypes.util
+        try:
+            # Symbols of libsqlite3 resolve through the extension module,
+            # that's the same library version the shell uses.
+            import _sqlite3
+            library = ctypes.CDLL(_sqlite3.__file__)
+            library.sqlite3_backup_init
+        except (ImportError, AttributeError, OSError):
+            name = ctypes.util.find_library('sqlite3')
+            if name is None:
+                raise BackupError('SQLite library not found!')
+            library = ctypes.CDLL(name)
+        handle = ctypes.c_void_p
+        library.sqlite3_open_v2.argtypes        = [ ctypes.c_char_p, ctypes.POINTER(handle), ctypes.c_int, ctypes.c_char_p ]
+        library.sqlite3_close.argtypes          = [ handle ]
+        library.sqlite3_errmsg.argtypes         = [ handle ]
+        library.sqlite3_errmsg.restype          = ctypes.c_char_p
+        library.sqlite3_backup_init.argtypes    = [ handle, ctypes.c_char_p, handle, ctypes.c_char_p ]
+        library.sqlite3_backup_init.restype     = handle
+        library.sqlite3_backup_step.argtypes    = [ handle, ctypes.c_int ]
+        library.sqlite3_backup_remaining.argtypes = [ handle ]
+        library.sqlite3_backup_pagecount.argtypes = [ handle ]
+        library.sqlite3_backup_finish.argtypes  = [ handle ]
+        _sqlite_library = library
+    return _sqlite_library
+
+def online_backup(source_name, target_name, pages=BACKUP_PAGES_PER_STEP, sleep_ms=BACKUP_SLEEP_MS,
+                  progress=None, cancelled=None):
+    """ Copy database source_name to target_name with the online backup API.
+
+    pages are copied per step, between the steps the source is unlocked
+    for sleep_ms. progress(remaining, pagecount) is called after every
+    step, cancelled() stops the backup if it returns True. Python 2 has no
+    Connection.backup, the sqlite3_backup_* functions are called directly.
+    """
+    import ctypes
+    library = sqlite_library()
+    source  = ctypes.c_void_p()
+    target  = ctypes.c_void_p()
+    try:
+        if library.sqlite3_open_v2(source_name, ctypes.byref(source), SQLITE_OPEN_READONLY, None) != SQLITE_OK:
+            raise BackupError("Can't open '%s': %s" % (source_name, library.sqlite3_errmsg(source),))
+        if library.sqlite3_open_v2(target_name, ctypes.byref(target),
+                                   SQLITE_OPEN_READWRITE | SQLITE_OPEN_CREATE, None) != SQLITE_OK:
+            raise BackupError("Can't open '%s': %s" % (target_name, library.sqlite3_errmsg(target),))
+        backup = library.sqlite3_backup_init(target, 'main', source, 'main')
+        if not backup:
+            raise BackupError(library.sqlite3_errmsg(target))
+        try:
+            while True:
+                result = library.sqlite3_backup_step(backup, pages)
+                if progress is not None:
+                    progress(library.sqlite3_backup_remaining(backup), library.sqlite3_backup_pagecount(backup))
+                if result == SQLITE_DONE:
+                    break
+                if result not in (SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED,):
+                    raise BackupError(library.sqlite3_errmsg(target))
+                if cancelled is not None and cancelled():
+                    raise BackupError('Backup cancelled.')
+                time.sleep(sleep_ms / 1000.0)
+        finally:
+            result = library.sqlite3_backup_finish(backup)
+        if result != SQLITE_OK:
+            raise BackupError(library.sqlite3_errmsg(target))
+    finally:
+        library.sqlite3_close(target)
+        library.sqlite3_close(source)
+# Backup = END ================================================================
+
+# Query Server = START ========================================================
+# Frames are a 4 byte big endian length and a utf-8 JSON object.
+# Requests : {"sql": SQL, "params": [...] or {...}} or {"script": SQL}
+# Answers  : {"description": [NAME, ...]}, {"rows": [[...], ...]}, ...
+#            and as last frame {"done": true, "changes": N} or {"error": TEXT}
+FRAME_HEADER        = struct.Struct('>I')
+
+def _json_value(value):
+    if isinstance(value, buffer):
+        return _to_text(value)
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+def write_frame(stream, message):
+    import json
+    data = json.dumps(message, default=_json_value, separators=(',', ':',))
+    stream.write(FRAME_HEADER.pack(len(data)) + data)
+
+def read_frame(stream):
+    """ The next message of stream, None at its end. """
+    import json
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    length = FRAME_HEADER.unpack(header)[0]
+    data   = stream.read(length)
+    if len(data) < length:
+        return None
+    return json.loads(data)
+
+def _is_read_only(sql):
+    """ True for statements the query server runs on a reader connection.
+    Statements missed here fail with a read-only error on the reader and are
+    run again by the writer.
+    """
+    if not SQL_QUERY.match(sql):
+        return False
+    code = SQL_QUOTED.sub(' ', sql)
+    if re.match(r'\s*WITH\b', code, re.IGNORECASE):
+        return not SQL_WITH_WRITE.search(code)
+    match = re.match(r'\s*PRAGMA\s+(?:[\w]+\.)?(\w+)\s*([=(]?)', code, re.IGNORECASE)
+    if match is None:
+        return True
+    name, argument = match.group(1).lower(), match.group(2)
+    if argument == '(':
+        return name in SERVE_READ_PRAGMAS
+    return argument != '=' and name not in SERVE_WRITE_PRAGMAS
+
+def _is_read_only_error(error):
+    """ True for the error of a write on a query_only connection. """
+    return 'readonly' in str(error) or 'read-only' in str(error)
+
+class QueryClient(object):
+    """ Connection to a query server (serve command, sqlite_cli.py --serve). """
+
+    def __init__(self, socket_path):
+        import socket
+        self.socket_path = socket_path
+        self.socket      = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.rfile       = self.socket.makefile('rb')
+        self.wfile       = self.socket.makefile('wb')
+
+    def request(self, message):
+        """ Send message and yield the answer frames, the last one has done or error set. """
+        write_frame(self.wfile, message)
+        self.wfile.flush()
+        while True:
+            frame = read_frame(self.rfile)
+            if frame is None:
+                raise IOError('Query server %s closed the connection!' % (self.socket_path,))
+            yield frame
+            if 'done' in frame or 'error' in frame:
+                return
+
+    def close(self):
+        for stream in (self.rfile, self.wfile, self.socket,):
+            try:
+                stream.close()
+            except IOError:
+                pass
+
+def query_server_class():
+    """ Threaded unix socket server answering queries with warm connections. """
+    import SocketServer
+    import Queue
+
+    class QueryHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            while True:
+                request = read_frame(self.rfile)
+                if request is None:
+                    return
+                try:
+                    self.server.answer(request, self.wfile)
+                    self.wfile.flush()
+                except IOError:
+                    return   # client is gone
+
+    class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        """ Queries (SELECT, EXPLAIN, ...) are answered by one of readers
+        query_only connections, all other statements by the writer. The
+        database is switched to WAL, so the readers don't block the writer.
+        """
+        daemon_threads      = True
+        allow_reuse_address = True
+
+        def __init__(self, socket_path, cli, readers=SERVE_READERS):
+            import threading
+            self.cli         = cli
+            self.writer      = cli._open_connection(cli.name, check_same_thread=False)
+            self.writer.row_factory = None
+            mode = self.writer.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            if mode.lower() != 'wal':
+                log.warning('journal_mode is %s, readers and writer block each other.', mode)
+            self.writer_lock = threading.Lock()
+            self.readers     = Queue.Queue()
+            for _ in range(readers):
+                connection             = cli._open_connection(cli.name, check_same_thread=False)
+                connection.row_factory = None
+                connection.execute('PRAGMA query_only = ON')
+                self.readers.put(connection)
+            self.reader_count = readers
+            SocketServer.UnixStreamServer.__init__(self, socket_path, QueryHandler)
+
+        def answer(self, request, stream):
+            if 'script' in request:
+                with self.writer_lock:
+                    self.cli.functions.refresh(self.writer)
+                    changes = self.writer.total_changes
+                    try:
+                        self.writer.executescript(request['script'])
+                    except DB.Error, e:
+                        self._rollback(self.writer)
+                        write_frame(stream, { 'error': str(e) })
+                        return
+                    write_frame(stream, { 'done': True, 'changes': self.writer.total_changes - changes })
+                return
+
+            sql    = request.get('sql', '')
+            params = request.get('params') or ()
+            if _is_read_only(sql):
+                connection = self.readers.get()
+                try:
+                    if self._run(connection, sql, params, stream, reader=True):
+                        return
+                finally:
+                    self.readers.put(connection)
+            with self.writer_lock:
+                self._run(self.writer, sql, params, stream)
+
+        def _run(self, connection, sql, params, stream, reader=False):
+            """ Answer sql on connection, False (nothing sent) if the reader can't run it. """
+            self.cli.functions.refresh(connection)
+            changes = connection.total_changes
+            cur     = connection.cursor()
+            try:
+                try:
+                    cur.execute(sql, params)
+                except DB.OperationalError, e:
+                    if reader and _is_read_only_error(e):
+                        self._rollback(connection)
+                        return False
+                    raise
+                if cur.description is None:
+                    connection.commit()
+                    write_frame(stream, { 'done': True, 'changes': connection.total_changes - changes })
+                    return True
+                write_frame(stream, { 'description': [ cn[0] for cn in cur.description ] })
+                while True:
+                    rows = cur.fetchmany(self.cli.fetch_size)
+                    if not rows:
+                        break
+                    write_frame(stream, { 'rows': rows })
+                    stream.flush()
+                write_frame(stream, { 'done': True })
+            except (DB.Error, ValueError), e:
+                self._rollback(connection)
+                write_frame(stream, { 'error': str(e) })
+            finally:
+                cur.close()
+            return True
+
+        @staticmethod
+        def _rollback(connection):
+            try:
+                connection.execute('ROLLBACK')
+            except DB.Error:
+                pass
+
+        def server_close(self):
+            SocketServer.UnixStreamServer.server_close(self)
+            self.writer.close()
+            while not self.readers.empty():
+                self.readers.get().close()
+
+    return QueryServer
+# Query Server = END ==========================================================
+
+# Table Checksums = START =====================================================
+def _key_range(key, lo, hi):
+    """ WHERE clause and parameters of the key range lo <= key < hi (None: open). """
+    if lo is None and hi is None:
+        return '', ()
+    if lo is None:
+        return 'WHERE %s < ?' % (key,), (hi,)
+    if hi is None:
+        return 'WHERE %s >= ?' % (key,), (lo,)
+    return 'WHERE %s >= ? AND %s < ?' % (key, key,), (lo, hi,)
+
+def _row_text(key, columns):
+    """ SQL expression of a row as text, quote() keeps types apart (1 vs '1'). """
+    return "||','||".join([ 'quote(%s)' % (name,) for name in [ key ] + columns ])
+
+def key_boundaries(connection, table, key, step, lo=None, hi=None):
+    """ Keys of every step-th row of lo <= key < hi, splitting it into ranges of step rows. """
+    # OFFSET skips along the key index, that's much faster than numbering
+    # the rows with a window function.
+    boundaries = []
+    while True:
+        where, params = _key_range(key, lo, hi)
+        row = connection.execute('SELECT %s FROM %s %s ORDER BY %s LIMIT 1 OFFSET ?' % (key, table, where, key,),
+                                 params + (step,)).fetchone()
+        if row is None:
+            return boundaries
+        lo = row[0]
+        boundaries.append(lo)
+
+def key_ranges(boundaries, lo=None, hi=None):
+    edges = [ lo ] + boundaries + [ hi ]
+    return zip(edges[:-1], edges[1:])
+
+def range_checksum(connection, table, key, columns, lo, hi):
+    """ (rows, md5 hex digest) of the rows of lo <= key < hi in key order.
+
+    The rows are concatenated by SQLite and hashed as one string, so the
+    work is done without the GIL and ranges can be hashed in parallel.
+    """
+    import hashlib
+    where, params = _key_range(key, lo, hi)
+    count, text   = connection.execute(
+        "SELECT count(*), group_concat(r, char(10)) FROM (SELECT %s AS r FROM %s %s ORDER BY %s)" % (
+        _row_text(key, columns), table, where, key,), params).fetchone()
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return count, hashlib.md5(text or '').hexdigest()
+
+def diff_rows(connection, other, table, key, columns, lo, hi):
+    """ Yield (key, row text of connection, row text of other) of the
+    rows of lo <= key < hi which differ, missing rows are None. """
+    where, params = _key_range(key, lo, hi)
+    sql     = 'SELECT %s, %s FROM %s %s ORDER BY %s' % (key, _row_text(key, columns), table, where, key,)
+    mine    = connection.execute(sql, params)
+    theirs  = other.execute(sql, params)
+    left    = mine.fetchone()
+    right   = theirs.fetchone()
+    while left is not None or right is not None:
+        if right is None or (left is not None and left[0] < right[0]):
+            yield left[0], left[1], None
+            left = mine.fetchone()
+        elif left is None or right[0] < left[0]:
+            yield right[0], None, right[1]
+            right = theirs.fetchone()
+        else:
+            if left[1] != right[1]:
+                yield left[0], left[1], right[1]
+            left  = mine.fetchone()
+            right = theirs.fetchone()
+# Table Checksums = END =======================================================
+
+# User Functions = START ======================================================
+SQL_JSON_PATH       = LazyRegex(r'\.(?:"([^"]*)"|([^.\[]+))|\[(\d+)\]')
+
+def _memoize(function, size):
+    """ function with a cache of the results of (about) the last size argument tuples.
+
+    Two generations of dicts approximate an LRU cache without the cost of
+    reordering an OrderedDict on every hit: hits in the old generation move
+    to the new one, a full new generation replaces the old one.
+    """
+    generations = [ {}, {} ]
+
+    def memoized(*args):
+        recent = generations[0]
+        try:
+            return recent[args]
+        except KeyError:
+            pass
+        try:
+            result = generations[1][args]
+        except KeyError:
+            result = function(*args)
+        if len(recent) >= size // 2:
+            generations[1] = recent
+            generations[0] = recent = {}
+        recent[args] = result
+        return result
+    return memoized
+
+_compiled_regex = _memoize(re.compile, REGEX_CACHE_SIZE)
+
+def _as_text(value):
+    """ Numbers and blobs are matched as text, like SQLite compares them with LIKE. """
+    return value if isinstance(value, basestring) else unicode(value) if not isinstance(value, buffer) else str(value)
+
+def _regexp(pattern, value):
+    """ value REGEXP pattern, true if pattern matches anywhere in value. """
+    if pattern is None or value is None:
+        return None
+    return 1 if _compiled_regex(pattern).search(_as_text(value)) else 0
+
+def _regexp_replace(value, pattern, replacement):
+    if pattern is None or value is None:
+        return value
+    return _compiled_regex(pattern).sub(replacement or '', _as_text(value))
+
+def _regexp_extract(value, pattern, group=0):
+    """ group of the first match of pattern in value, NULL without a match. """
+    if pattern is None or value is None:
+        return None
+    match = _compiled_regex(pattern).search(_as_text(value))
+    return match.group(group) if match else None
+
+def _hash_function(algorithm):
+    constructor = [] # hashlib is imported by the first call
+
+    def digest(value):
+        if value is None:
+            return None
+        if not constructor:
+            import hashlib
+            constructor.append(getattr(hashlib, algorithm))
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return constructor[0](str(value)).hexdigest()
+    return digest
+
+def _date_bucket(value, seconds):
+    """ Start of the interval of seconds containing value (unix time or 'YYYY-MM-DD[ HH:MM:SS]'). """
+    if value is None or not seconds:
+        return None
+    if isinstance(value, (int, long, float,)):
+        return value - value % seconds
+    import calendar
+    fields = [ int(field) for field in re.split(r'[-T :]', value[:19]) ]
+    moment = calendar.timegm(tuple(fields + [ 0 ] * (6 - len(fields))) + (0, 0, 0,))
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(moment - moment % seconds))
+
+def _json_extract(text, path):
+    """ json_extract for SQLite builds without JSON functions ($.key, $.list[N] paths). """
+    import json
+    if text is None or path is None:
+        return None
+    value = json.loads(text)
+    for quoted, key, index in SQL_JSON_PATH.findall(path[1:]):
+        try:
+            value = value[int(index)] if index else value[quoted or key]
+        except (KeyError, IndexError, TypeError,):
+            return None
+    if isinstance(value, (dict, list,)):
+        return json.dumps(value, separators=(',', ':',))
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+class _Median(object):
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        if not self.values:
+            return None
+        self.values.sort()
+        middle = len(self.values) // 2
+        if len(self.values) % 2:
+            return self.values[middle]
+        return (self.values[middle - 1] + self.values[middle]) / 2.0
+
+class _Stdev(object):
+    """ Sample standard deviation (Welford). """
+    def __init__(self):
+        self.count = 0
+        self.mean  = 0.0
+        self.m2    = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        self.count += 1
+        delta       = value - self.mean
+        self.mean  += delta / self.count
+        self.m2    += delta * (value - self.mean)
+
+    def finalize(self):
+        if self.count < 2:
+            return None
+        return (self.m2 / (self.count - 1)) ** 0.5
+
+_native_functions = {} # function name: True if the SQLite library has it
+def _sqlite_has_function(connection, name):
+    """ True if SQLite has a function name, probed on the first connection
+    the functions are registered on (before it gets the fallbacks). """
+    if name not in _native_functions:
+        try:
+            connection.execute('SELECT %s()' % (name,))
+            _native_functions[name] = True
+        except DB.OperationalError, e:
+            _native_functions[name] = 'no such function' not in str(e)
+    return _native_functions[name]
+
+class UserFunction(object):
+    """ Python function or aggregate class callable from SQL, with its call statistics. """
+    __slots__ = ('name', 'function', 'args', 'aggregate', 'deterministic', 'memoize', 'fallback', 'calls', 'seconds',)
+
+    def __init__(self, name, function, args, aggregate=False, deterministic=True, memoize=False, fallback=False):
+        self.name          = name
+        self.function      = function
+        self.args          = args
+        self.aggregate     = aggregate
+        self.deterministic = deterministic
+        self.memoize       = memoize
+        self.fallback      = fallback
+        self.calls         = 0
+        self.seconds       = 0.0
+
+    def timed(self):
+        """ Callable (or aggregate class) for a connection, counting calls and their time. """
+        entry    = self
+        function = self.function
+        clock    = time.time
+        if self.aggregate:
+            class TimedAggregate(function):
+                def step(self, *args):
+                    started = clock()
+                    try:
+                        function.step(self, *args)
+                    finally:
+                        entry.calls   += 1
+                        entry.seconds += clock() - started
+
+                def finalize(self):
+                    started = clock()
+                    try:
+                        return function.finalize(self)
+                    finally:
+                        entry.seconds += clock() - started
+            return TimedAggregate
+
+        if self.memoize:
+            # One cache per connection, a connection is used by one thread at a time.
+            function = _memoize(function, UDF_MEMO_SIZE)
+
+        def timed(*args):
+            started = clock()
+            try:
+                return function(*args)
+            finally:
+                entry.calls   += 1
+                entry.seconds += clock() - started
+        return timed
+
+class Connection(DB.Connection):
+    """ Connection of the shell, unlike DB.Connection it can be weakly referenced. """
+
+class FunctionRegistry(object):
+    """ SQL functions and aggregates registered on every connection of the shell.
+
+    Modules add their functions with a register_functions(registry)
+    function, which calls registry.function() and registry.aggregate().
+    """
+    def __init__(self):
+        self.functions   = collections.OrderedDict()
+        self.modules     = []
+        self.version     = 0
+        self._registered = None # WeakKeyDictionary connection: version it got
+
+    def function(self, name, function, args=-1, deterministic=True, memoize=False, fallback=False):
+        """ Register function(*args) as SQL function name. Deterministic functions
+        (same result for the same arguments) can be memoized. A fallback is only
+        registered if SQLite has no function name of its own. """
+        self.functions[name.lower()] = UserFunction(name, function, args, deterministic=deterministic,
+                                                    memoize=memoize and deterministic, fallback=fallback)
+        self.version += 1
+
+    def aggregate(self, name, aggregate_class, args=-1):
+        """ Register aggregate_class (step(*args), finalize()) as SQL aggregate name. """
+        self.functions[name.lower()] = UserFunction(name, aggregate_class, args, aggregate=True, deterministic=False)
+        self.version += 1
+
+    def load(self, spec):
+        """ Import the module spec (module name or .py file) and let it register its functions. """
+        if spec.endswith('.py'):
+            import imp
+            name   = 'sqlite_cli_functions_%s' % (re.sub(r'\W', '_', os.path.basename(spec)[:-3]),)
+            module = imp.load_source(name, os.path.expanduser(spec))
+        else:
+            module = __import__(spec, fromlist=['register_functions'])
+        module.register_functions(self)
+        self.modules.append(spec)
+
+    def register(self, connection):
+        for entry in self.functions.values():
+            if entry.fallback and _sqlite_has_function(connection, entry.name.lower()):
+                continue
+            if entry.aggregate:
+                connection.create_aggregate(entry.name, entry.args, entry.timed())
+                continue
+            try:
+                # Lets SQLite factor calls out of loops and use them in indexes.
+                connection.create_function(entry.name, entry.args, entry.timed(), deterministic=entry.deterministic)
+            except (TypeError, DB.NotSupportedError):
+                # The sqlite3 module of python 2 has no deterministic flag.
+                connection.create_function(entry.name, entry.args, entry.timed())
+        if self._registered is None:
+            import weakref
+            self._registered = weakref.WeakKeyDictionary()
+        try:
+            self._registered[connection] = self.version
+        except TypeError:
+            pass   # not a Connection, refresh() registers again every time
+
+    def refresh(self, connection):
+        """ Register the functions added since connection got them (long lived
+        connections of other threads call this before they run a statement). """
+        try:
+            current = self._registered is not None and self._registered.get(connection) == self.version
+        except TypeError:
+            current = False
+        if not current:
+            self.register(connection)
+
+    def reset(self):
+        for entry in self.functions.values():
+            entry.calls   = 0
+            entry.seconds = 0.0
+
+def builtin_functions(registry):
+    """ The functions every connection of the shell gets. """
+    registry.function('regexp', _regexp, 2)
+    registry.function('regexp_replace', _regexp_replace, 3)
+    registry.function('regexp_extract', _regexp_extract)
+    for algorithm in ('md5', 'sha1', 'sha256',):
+        registry.function(algorithm, _hash_function(algorithm), 1)
+    registry.function('date_bucket', _date_bucket, 2)
+    registry.function('json_extract', _json_extract, 2, memoize=True, fallback=True)
+    registry.aggregate('median', _Median, 1)
+    registry.aggregate('stdev', _Stdev, 1)
+# User Functions = END ========================================================
+
+# Query History = START =======================================================
+HISTORY_SCHEMA      = '''
+CREATE TABLE IF NOT EXISTS history (
+    id          INTEGER PRIMARY KEY,
+    statement   TEXT NOT NULL,
+    db          TEXT,
+    started     REAL NOT NULL,
+    elapsed     REAL,
+    rows        INTEGER,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS history_elapsed ON history (elapsed);
+CREATE INDEX IF NOT EXISTS history_db ON history (db, started);
+'''
+# Full text index of the statements, kept up to date by triggers.
+HISTORY_FTS_SCHEMA  = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(statement, content='history', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts (rowid, statement) VALUES (new.id, new.statement);
+END;
+CREATE TRIGGER IF NOT EXISTS history_delete AFTER DELETE ON history BEGIN
+    INSERT INTO history_fts (history_fts, rowid, statement) VALUES ('delete', old.id, old.statement);
+END;
+'''
+
+def _fts_query(term):
+    """ FTS5 query matching all words of term, a trailing * matches word prefixes. """
+    phrases = []
+    for word in term.split():
+        prefix = word.endswith('*')
+        phrases.append('"%s"%s' % (word.rstrip('*').replace('"', '""'), '*' if prefix else '',))
+    return ' '.join(phrases)
+
+class QueryHistory(object):
+    """ Executed commands and statements of the shell in a SQLite database.
+
+    The database is opened on first use. Statements are searched with
+    FTS5 if SQLite has it, else with LIKE.
+    """
+    COLUMNS = ('id', 'started', 'db', 'elapsed_s', 'rows', 'error', 'statement',)
+
+    def __init__(self, filename=None):
+        self.filename    = filename or HISTORY_DB
+        self._connection = None
+        self.fts         = False
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._open()
+        return self._connection
+
+    def _open(self):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        new        = not os.path.exists(self.filename)
+        # Several shells share the history, WAL lets them read while one writes.
+        connection = DB.connect(self.filename, timeout=2.0, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode = WAL').fetchall()
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.executescript(HISTORY_SCHEMA)
+        try:
+            connection.executescript(HISTORY_FTS_SCHEMA)
+            self.fts = True
+        except DB.Error, e:
+            log.debug('History search without full text index: %s', e)
+        self._connection = connection
+        if new and os.path.isfile(LEGACY_HISTORY_FILE):
+            self._import_legacy(LEGACY_HISTORY_FILE)
+        connection.execute('DELETE FROM history WHERE id <= (SELECT max(id) FROM history) - ?', (HISTORY_MAX_ENTRIES,))
+
+    def _import_legacy(self, filename):
+        started = os.path.getmtime(filename)
+        with open(filename, 'rb') as stream:
+            lines = [ line.rstrip('\n').decode('utf-8', 'replace') for line in stream ]
+        with self._connection:
+            self._connection.executemany('INSERT INTO history (statement, started) VALUES (?, ?)',
+                                         [ (line, started,) for line in lines if line.strip() ])
+        log.info('%s lines of %s imported into the history.', len(lines), filename)
+
+    def record(self, statement, db, started, elapsed, rows=None, error=None):
+        self.connection.execute('INSERT INTO history (statement, db, started, elapsed, rows, error) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', (statement, db, started, elapsed, rows, error,))
+
+    def recent(self, count):
+        """ Statements of the last count entries, oldest first. """
+        rows = self.connection.execute('SELECT statement FROM history ORDER BY id DESC LIMIT ?', (count,)).fetchall()
+        return [ row[0] for row in reversed(rows) ]
+
+    def _select(self, condition, order, params, count):
+        return self.connection.execute(
+            "SELECT id, datetime(started, 'unixepoch', 'localtime'), db, round(elapsed, 4), rows, error, statement "
+            "FROM history %s ORDER BY %s LIMIT ?" % (condition, order,), params + (count,)).fetchall()
+
+    def last(self, count):
+        return list(reversed(self._select('', 'id DESC', (), count)))
+
+    def search(self, term, count):
+        """ The last count entries whose statement contains all words of term. """
+        if self.fts:
+            return self._select('WHERE id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)',
+                                'id DESC', (_fts_query(term),), count)
+        words = term.replace('*', '').split()
+        return self._select('WHERE %s' % (' AND '.join([ 'statement LIKE ?' ] * len(words)),),
+                            'id DESC', tuple([ '%%%s%%' % (word,) for word in words ]), count)
+
+    def slow(self, count, db=None):
+        """ The count slowest entries (of db). """
+        if db is None:
+            return self._select('WHERE elapsed IS NOT NULL', 'elapsed DESC', (), count)
+        return self._select('WHERE db = ? AND elapsed IS NOT NULL', 'elapsed DESC', (db,), count)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+# Query History = END =========================================================
+
+# Pager = START ===============================================================
+def _read_key():
+    """ Next key (or escape sequence) typed on the terminal. """
+    import termios, tty
+    fd  = sys.stdin.fileno()
+    old = termios.tcgetattr(fd)
+    try:
+        tty.setraw(fd)
+        return os.read(fd, 8)
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old)
+
+class Pager(object):
+    """ Shows formatted rows a page at a time.
+
+    Rows are pulled from rows (usually a fetchmany generator of an open
+    cursor) only when paging forward, and only the rows of the shown page
+    are formatted. The last PAGER_CACHED_PAGES pages are kept for paging
+    back, memory stays bounded for results of any size.
+    """
+    KEYS_NEXT   = (' ', 'f', 'j', 'n', '\r', '\n', '\x1b[B', '\x1b[6~',)
+    KEYS_BACK   = ('b', 'k', 'p', '\x1b[A', '\x1b[5~',)
+    KEYS_FIRST  = ('g', '\x1b[H',)
+    KEYS_QUIT   = ('q', 'Q', '\x1b', '\x03', '\x04',)
+
+    def __init__(self, rows, header, format_row, footer, cached_pages=PAGER_CACHED_PAGES):
+        self.rows       = iter(rows)
+        self.header     = header
+        self.format_row = format_row
+        self.footer     = footer
+        self.pages      = collections.deque(maxlen=cached_pages) # [ [ROW, ...], ... ]
+        self.first_page = 0     # page number of pages[0]
+        self.current    = 0     # page number shown
+        self.done       = False # all rows fetched
+        self.page_rows  = None
+
+    def run(self):
+        first = next(self.rows, None)
+        if first is None:
+            return
+        # Every row of a result takes the same number of lines.
+        lines          = self.format_row(first).count('\n') + 1
+        height         = terminal_size()[0]
+        self.page_rows = max((height - len(self.header) - len(self.footer) - 1) // lines, 1)
+        self.rows      = itertools.chain((first,), self.rows)
+        self._fetch_page()
+        while True:
+            self._show()
+            key = _read_key()
+            if key in self.KEYS_QUIT:
+                break
+            elif key in self.KEYS_NEXT:
+                if self.current + 1 < self.first_page + len(self.pages) or self._fetch_page():
+                    self.current += 1
+                elif key in (' ', '\r', '\n',):
+                    break
+            elif key in self.KEYS_BACK:
+                self.current = max(self.current - 1, self.first_page)
+            elif key in self.KEYS_FIRST:
+                self.current = self.first_page
+
+    def _fetch_page(self):
+        """ Append the next page, False if there are no more rows. """
+        if self.done:
+            return False
+        page = list(itertools.islice(self.rows, self.page_rows))
+        if len(page) < self.page_rows:
+            self.done = True
+        if not page:
+            return False
+        if len(self.pages) == self.pages.maxlen:
+            self.first_page += 1
+        self.pages.append(page)
+        return True
+
+    def _show(self):
+        page  = self.pages[self.current - self.first_page]
+        first = self.current * self.page_rows + 1
+        last  = self.current + 1 == self.first_page + len(self.pages) and self.done
+        sys.stdout.write('\033[H\033[2J')
+        lines = list(self.header) + [ self.format_row(row) for row in page ]
+        if last:
+            lines += self.footer
+        _write_lines(lines)
+        status = 'rows %s-%s%s  (space: next, b: back, g: first, q: quit)' % (
+                 first, first + len(page) - 1, ' (end)' if last else '',)
+        if self.current == self.first_page and self.first_page > 0:
+            status += ' older pages dropped'
+        sys.stdout.write(HIGHLIGHT(status))
+        sys.stdout.flush()
+# Pager = END =================================================================
+
+class SQLiteCli(Cmd, object):
+    # Command loop implementation, cmd2 for the interactive shell.
+    cmd_base = Cmd
+
+    def __init__(self):
+        self.cmd_base.__init__(self)
+        # FIXME: dont use color on prompt because readline gets confused with this
+        # FIXME: and \001 + \002 dont work everywere
+        self.prompt             = '==> '
+        self.ruler              = DARK_GRAY("=")
+        self.doc_header         = RED('Documented commands (type help <topic>):')
+        self.undoc_header       = RED('Undocumented commands:')
+        self.name               = None
+        self.connection         = None
+        self.mode               = LINE
+        self.isolation_level    = None # autocommit
+        self.fetch_size         = DEFAULT_FETCH_SIZE
+        self.last_error         = None
+        self.cached_statements  = DEFAULT_CACHED_STATEMENTS
+        self.pragma_profile     = DEFAULT_PROFILE
+        self.result_cache       = None
+        self.df                 = None # ColumnarResult of the last df query
+        self.timer              = False
+        self.pager              = False
+        self.profile            = False
+        self.profile_log        = collections.deque(maxlen=PROFILE_HISTORY_SIZE)
+        self.load_batch_size    = DEFAULT_LOAD_BATCH_SIZE
+        self.functions          = FunctionRegistry()
+        builtin_functions(self.functions)
+        self.loglevel           = 'DEBUG'
+        self._set_loglevel()
+
+        self.remote             = None # QueryClient of the connect command
+        self.shards             = [] # [ (FILENAME, CONNECTION), ]
+        self._shard_slots       = None # semaphore limiting the shards queried at the same time
+
+        self.jobs               = collections.OrderedDict()
+        self._job_pool          = None
+        self._job_counter       = 0
+
+        self.schema             = SchemaCache()
+        self.queries            = QueryStore(None)
+        self.query_history      = QueryHistory()
+        self._command_started   = None
+        self._command_stats     = None
+        self._completion_index  = None
+        self._indexed_version   = None
+        self._indexed_tables    = set()
+        atexit.register(self.schema.save)
+
+    # =========================================================================
+    def do_load_config(self, filename):
+        """ Read connection profiles from filename or all existing CONFIG_FILES. """
+        filenames = [ os.path.expanduser(filename) ] if filename else CONFIG_FILES
+        existing  = [ fn for fn in filenames if os.path.isfile(fn) ]
+        if filename and not existing:
+            log.error('Config file "%s" not found!', filename)
+            return
+        if not existing:
+            return
+
+        import ConfigParser
+        parser = ConfigParser.RawConfigParser()
+        try:
+            parser.read(existing)
+        except ConfigParser.Error, e:
+            log.error('Config file could not be read! %s', e)
+            return
+
+        for section in parser.sections():
+            if section.startswith('profile '):
+                name    = section[len('profile '):].strip()
+                pragmas = CONNECTION_PROFILES.setdefault(name, collections.OrderedDict())
+                for pragma, value in parser.items(section):
+                    try:
+                        if value.strip():
+                            _pragma_statement(pragma, value.strip())
+                            pragmas[pragma] = value.strip()
+                        else:
+                            pragmas.pop(pragma, None)
+                    except ValueError, e:
+                        log.error('%s in section [%s]!', e, section)
+        if parser.has_option('sqlite_cli', 'profile'):
+            self.do_pragma_profile(parser.get('sqlite_cli', 'profile'))
+        if parser.has_option('sqlite_cli', 'functions'):
+            for spec in parser.get('sqlite_cli', 'functions').split(','):
+                if spec.strip() and spec.strip() not in self.functions.modules:
+                    self.do_functions('load %s' % (spec.strip(),))
+        log.debug('Config loaded from %s.', ', '.join(existing))
+
+    @staticmethod
+    def help_load_config():
+        print
+        print HIGHLIGHT("<<< load_config [FILENAME]")
+        print "   Load configuration from FILENAME."
+        print
+        print "   Without FILENAME configfiles will be "
+        print "   searched and loaded (adaptive) from:"
+        for filename in CONFIG_FILES:
+            print "      o) %s" % (filename,)
+        print "   Later files override earlier ones."
+        print
+        print "   Example:"
+        print "      [sqlite_cli]"
+        print "      profile = read-heavy"
+        print
+        print "      functions = my_functions, ~/sql/functions.py"
+        print
+        print "      [profile read-heavy]"
+        print "      mmap_size = 1073741824"
+        print "      query_only ="
+        print
+        print "   [profile NAME] sections add or change the PRAGMAs of a connection"
+        print "   profile (see pragma_profile), an empty value removes a PRAGMA."
+        print
+
+    @staticmethod
+    def complete_load_config(text, line, begidx, endidx):
+        text_new    = "%s*" % (line[len('load_config') + 1:].strip(),)
+        completions = glob.glob(text_new)
+        # print
+        # print "text          : ", text
+        # print "text_new      : ", text_new
+        # print "line          : ", line
+        # print "begidx|endidx : %s|%s" % (begidx, endidx,)
+        # print "completitions : ", completions
+        # print
+        return completions
+
+    # =========================================================================
+    def do_mode(self, line):
+        if line.upper() in FORMATS.keys():
+            self.mode = line.upper()
+        elif len(line) == 0:
+            print "Actual mode is %s." % (HIGHLIGHT(self.mode),)
+        else:
+            log.error('Mode "%s" is unknown!', line)
+
+    @staticmethod
+    def help_mode():
+        print
+        print HIGHLIGHT(">>> mode [MODE]")
+        print "   Set output mode to MODE."
+        print "   Use "
+        print "      mode <TAB><TAB>"
+        print "   to see all available modes."
+        print
+
+    def complete_mode(self, text, line, begidx, endidx):
+        return self._complete(text, FORMATS.keys())
+
+    # =========================================================================
+    @staticmethod
+    def do_cfg_table_column(line):
+        params = line.split(' ')
+        if len(params) == 1:
+            print('Configuration for Outputformat %s:' % HIGHLIGHT('TABLE'))
+            print('Maximum Table Width: %s' % FORMATS[TABLE].get(MAX_WIDTH, 'unset'))
+            print('Width Sample Rows  : %s' % FORMATS[TABLE].get(SAMPLE_ROWS, 'unset'))
+            available_configs = FORMATS[TABLE].get(COLUMN_WIDTHS, {})
+
+            if len(available_configs) > 0:
+                print('Column Configurations:')
+                for col_idx, data in available_configs.iteritems():
+                    print('\tCol Index: %16s, max_width: %16s, min_width: %16s, truncate line: %s' % (
+                             DATA_COLOR(col_idx),
+                             DATA_COLOR(data.get(COLUMN_MAX_WIDTH, 'unset')),
+                             DATA_COLOR(data.get(COLUMN_MIN_WIDTH, 'unset')),
+                             DATA_COLOR(data.get(TRUNCATE_LINE, 'unset')),)
+                    )
+        else:
+            if FORMATS[TABLE].get(COLUMN_WIDTHS, None) is None:
+                FORMATS[TABLE][COLUMN_WIDTHS] = {}
+
+            if params[0].upper() == 'DEL':
+                if len(params) >= 2:
+                    FORMATS[TABLE][COLUMN_WIDTHS].pop(params[1], None)
+            else:
+                if params[0] not in FORMATS[TABLE][COLUMN_WIDTHS]:
+                    FORMATS[TABLE][COLUMN_WIDTHS][params[0]] = {}
+
+                if len(params) >= 2:
+                    if params[1].isdigit():
+                        FORMATS[TABLE][COLUMN_WIDTHS][params[0]][COLUMN_MAX_WIDTH] = int(params[1])
+                    else:
+                        log.error('Parameter for COLUMN_MAX_WIDTH is not numeric!')
+
+                if len(params) >= 3:
+                    if params[2].isdigit():
+                        FORMATS[TABLE][COLUMN_WIDTHS][params[0]][COLUMN_MIN_WIDTH] = int(params[2])
+                    else:
+                        log.error('Parameter for COLUMN_MIN_WIDTH is not numeric!')
+
+                if len(params) >= 4:
+                    value = params[3].upper()
+                    if value in ('TRUE', 'YES',):
+                        FORMATS[TABLE][COLUMN_WIDTHS][params[0]][TRUNCATE_LINE] = True
+                    elif value in ('FALSE', 'NO',):
+                        FORMATS[TABLE][COLUMN_WIDTHS][params[0]][TRUNCATE_LINE] = False
+                    else:
+                        log.error("Value for TRUNCATE_LINE is not one of (TRUE|FALSE|YES|NO)! It's %s.", params[3])
+
+    @staticmethod
+    def do_cfg_table(line):
+        params = line.split()
+        if len(params) == 0:
+            print('Maximum Table Width: %s' % FORMATS[TABLE].get(MAX_WIDTH, 'unset'))
+            print('Width Sample Rows  : %s' % FORMATS[TABLE].get(SAMPLE_ROWS, 'unset'))
+            return
+
+        if params[0].lstrip('-').isdigit():
+            FORMATS[TABLE][MAX_WIDTH] = int(params[0])
+        else:
+            log.error('Parameter for MAX_WIDTH is not numeric!')
+
+        if len(params) >= 2:
+            if params[1].isdigit() and int(params[1]) > 0:
+                FORMATS[TABLE][SAMPLE_ROWS] = int(params[1])
+            else:
+                log.error('Parameter for SAMPLE_ROWS is not a positive number!')
+
+    @staticmethod
+    def help_cfg_table():
+        print
+        print HIGHLIGHT(">> %s [MAX_WIDTH] [SAMPLE_ROWS]") % (RED("cfg_table"),)
+        print "   Sets formating parameter for output-mode TABLE."
+        print
+        print "   [MAX_WIDTH] maximum width of the whole table, -1 for unlimited."
+        print "      Defaults to the terminal width (unlimited if not a terminal)."
+        print "   [SAMPLE_ROWS] number of leading rows used to size the columns."
+        print "      All following rows are streamed with this layout."
+        print
+        print "   If called without parameters the actual configuration is shown."
+        print
+
+    @staticmethod
+    def help_cfg_table_column():
+        print
+        print HIGHLIGHT(">> %s [COLUMN_INDEX] [MAX_WIDTH] [MIN_WIDTH] [TRUNCATE_LINE]") % (RED("cfg_table_column"),)
+        print "   Sets formating parameter for output-mode TABLE for a single column."
+        print
+        print "   If called without parameters the actual configuration is shown."
+        print
+        print "   [COLUMN_INDEX] is the 0 based index or the name of the column."
+        print "   [TRUNCATE_LINE] True/False/Yes/No (case insensitive) "
+        print "      if True or Yes the column data will be truncated at MAX_WIDTH."
+        print "      Cells wider than the column are marked with '%s'." % (OVERFLOW_MARK,)
+        print
+        print "   %s DEL [COLUMN_INDEX]" % (RED("cfg_table_column"),)
+        print "      Removes the configuration of a single column."
+        print "   All parameters from right to left are optional."
+        print
+
+    # =========================================================================
+    def do_sys_update_table_names(self, line):
+        """ update cache for table names. """
+        self.schema.refresh()
+
+    def do_show_column_names(self, table_name):
+        for name in self.schema.column_names(table_name):
+            print "%s.%s" % (LIGHT_GRAY(table_name), YELLOW(name),)
+
+    def complete_show_column_names(self, text, line, begidx, endidx):
+        return self._complete(text, self.schema.table_names())
+
+    # =========================================================================
+    def do_loglevel(self, level):
+        """ Get/Set loglevel. """
+        if len(level) == 0:
+            log.info('Actual loglevel is %s', self.loglevel)
+        elif level in LOG_LEVELS.keys():
+            self.loglevel = level
+            self._set_loglevel()
+        else:
+            log.error('Unknown loglevel "%s"! Known levels are: %s', level, LOG_LEVELS.keys())
+
+    def complete_loglevel(self, text, line, begidx, endidx):
+        return self._complete(text, LOG_LEVELS.keys())
+
+    # =========================================================================
+    def do_fetch_size(self, size):
+        """ Get/Set number of rows fetched per batch while streaming results. """
+        if len(size) == 0:
+            log.info('Actual fetch size is %s rows.', self.fetch_size)
+        elif size.isdigit() and int(size) > 0:
+            self.fetch_size = int(size)
+        else:
+            log.error('Fetch size must be a positive number! It\'s "%s".', size)
+
+    # =========================================================================
+    def do_timer(self, state):
+        """ Get/Set (on|off) printing of statement timings. """
+        self.timer = self._switch('timer', state, self.timer)
+
+    def do_profile(self, state):
+        """ Get/Set (on|off) timings plus EXPLAIN QUERY PLAN for every statement. """
+        self.profile = self._switch('profile', state, self.profile)
+
+    def do_pager(self, state):
+        """ Get/Set (on|off) showing results of mode TABLE and LINE in the pager. """
+        self.pager = self._switch('pager', state, self.pager)
+
+    @staticmethod
+    def help_pager():
+        print
+        print HIGHLIGHT(">> %s [on|off]") % (RED('pager'),)
+        print "   Shows the results of output mode TABLE and LINE page wise"
+        print "   (only if stdout is a terminal). The cursor stays open while"
+        print "   paging, rows are fetched and formatted when their page is shown."
+        print "   The last %s pages are kept for paging back." % (PAGER_CACHED_PAGES,)
+        print
+        print "   Keys: space/enter/j/down: next page, b/k/up: previous page,"
+        print "         g: first kept page, q/esc: quit"
+        print
+
+    def complete_pager(self, text, line, begidx, endidx):
+        return self._complete(text, ['on', 'off',])
+
+    def complete_timer(self, text, line, begidx, endidx):
+        return self._complete(text, ['on', 'off',])
+
+    def complete_profile(self, text, line, begidx, endidx):
+        return self._complete(text, ['on', 'off',])
+
+    def do_stats(self, line):
+        """ Summary of the recently executed statements, "stats clear" resets it. """
+        if line.strip().lower() == 'clear':
+            self.profile_log.clear()
+            return
+        if len(self.profile_log) == 0:
+            log.info('No statements recorded.')
+            return
+
+        groups = collections.OrderedDict()
+        for stats in self.profile_log:
+            groups.setdefault(normalize_sql(stats.sql), []).append(stats)
+        rows = []
+        for sql, entries in groups.items():
+            totals = sorted([ entry.total for entry in entries ])
+            rows.append((len(entries), round(sum(totals), 4), round(_percentile(totals, 50), 4),
+                         round(_percentile(totals, 95), 4), round(totals[-1], 4),
+                         sum([ entry.rows for entry in entries ]) // len(entries),
+                         ', '.join(sorted(set(sum([ entry.full_scans for entry in entries ], [])))), sql,))
+        rows.sort(key=lambda row: row[1], reverse=True)
+        names = ('count', 'total_s', 'p50_s', 'p95_s', 'max_s', 'avg_rows', 'full_scans', 'statement',)
+        self._print_data(ResultInfo(_description(names)), self._encode_rows(rows) if self.mode in (CSV, TSV,) else rows)
+
+    @staticmethod
+    def help_stats():
+        print
+        print HIGHLIGHT(">> %s [clear]") % (RED('stats'),)
+        print "   Summary of the last %s executed statements grouped by" % (PROFILE_HISTORY_SIZE,)
+        print "   statement with literals replaced by ?, slowest first:"
+        print "   count, total/p50/p95/max time in seconds, average rows and the"
+        print "   tables read by full scans (recorded while 'profile on')."
+        print
+        print "   Related commands: timer, profile"
+        print
+
+    # =========================================================================
+    def do_functions(self, line):
+        """ List the python SQL functions with their call statistics, reset them or load a module. """
+        params = line.split(None, 1)
+        if len(params) == 2 and params[0].lower() == 'load':
+            try:
+                self.functions.load(params[1])
+            except Exception, e:
+                log.error('Functions of "%s" could not be loaded! %s', params[1], e)
+                return
+            connections = [ connection for filename, connection in self.shards ] or [ self.connection ]
+            for connection in connections:
+                if connection is not None:
+                    self.functions.register(connection)
+            self._completion_index = None
+            log.info('Functions of "%s" loaded.', params[1])
+            return
+        if len(params) == 1 and params[0].lower() == 'reset':
+            self.functions.reset()
+            return
+        if params:
+            log.error('Usage: functions [reset|load MODULE]')
+            return
+
+        rows = []
+        for entry in self.functions.functions.values():
+            if entry.fallback and _native_functions.get(entry.name.lower()):
+                continue   # SQLite's own function is used
+            rows.append((entry.name, 'aggregate' if entry.aggregate else 'function',
+                         'any' if entry.args < 0 else entry.args,
+                         'memoized' if entry.memoize else 'yes' if entry.deterministic else 'no',
+                         entry.calls, round(entry.seconds, 4),
+                         round(entry.seconds * 1e6 / entry.calls, 2) if entry.calls else None,))
+        names = ('name', 'kind', 'args', 'deterministic', 'calls', 'total_s', 'us_per_call',)
+        self._print_data(ResultInfo(_description(names)), self._encode_rows(rows) if self.mode in (CSV, TSV,) else rows)
+
+    @staticmethod
+    def help_functions():
+        print
+        print HIGHLIGHT(">> %s [reset|load MODULE]") % (RED('functions'),)
+        print "   Lists the python functions and aggregates usable in SQL with"
+        print "   their calls and time spent (reset sets them to 0). Filter with"
+        print "   them in the query instead of the fetched rows:"
+        print "      x REGEXP pattern, regexp_replace(x, pattern, replacement),"
+        print "      regexp_extract(x, pattern [, group]),"
+        print "      md5(x), sha1(x), sha256(x),"
+        print "      date_bucket(x, seconds) : start of the interval of x (unix"
+        print "                                time or 'YYYY-MM-DD HH:MM:SS'),"
+        print "      median(x), stdev(x)     : aggregates."
+        print "   Compiled patterns are cached (last %s)." % (REGEX_CACHE_SIZE,)
+        print
+        print "   load MODULE imports a module name or .py file and calls its"
+        print "   register_functions(registry), e.g."
+        print "      def register_functions(registry):"
+        print "          registry.function('slug', slug, 1, deterministic=True, memoize=True)"
+        print "          registry.aggregate('mode', Mode, 1)"
+        print "   Memoized functions keep the last %s results per connection." % (UDF_MEMO_SIZE,)
+        print "   Modules listed as 'functions' in the config are loaded on start."
+        print
+
+    # =========================================================================
+    def do_history(self, line):
+        """ Show, search or rank the history of the shell. """
+        params = line.split(None, 1)
+        try:
+            if not params or params[0].isdigit():
+                rows = self.query_history.last(int(params[0]) if params else HISTORY_SHOWN)
+            elif params[0].lower() == 'search' and len(params) == 2:
+                rows = self.query_history.search(params[1], HISTORY_SHOWN)
+            elif params[0].lower() == 'slow' and (len(params) == 1 or params[1].strip() in ('all', 'db',)):
+                here = len(params) == 2 and params[1].strip() == 'db'
+                rows = self.query_history.slow(HISTORY_SHOWN, self._history_db() if here else None)
+            else:
+                log.error('Usage: history [N] | history search TERM | history slow [db]')
+                return
+        except (DB.Error, OSError), e:
+            log.error('History not readable! %s', e)
+            return
+        if not rows:
+            log.info('No history entries found.')
+            return
+        self._print_data(ResultInfo(_description(QueryHistory.COLUMNS)),
+                         self._encode_rows(rows) if self.mode in (CSV, TSV,) else rows)
+
+    @staticmethod
+    def help_history():
+        print
+        print HIGHLIGHT(">> %s [N] | search TERM | slow [db]") % (RED('history'),)
+        print "   The commands and statements of the shell are recorded with"
+        print "   database, start, elapsed time, rows and error in %s." % (HISTORY_DB,)
+        print
+        print "   history [N]        : the last N (default %s) entries," % (HISTORY_SHOWN,)
+        print "   history search TERM: the last entries containing all words of"
+        print "                        TERM (word* matches prefixes), full text"
+        print "                        indexed if SQLite has FTS5,"
+        print "   history slow [db]  : the slowest entries (of the actual database)."
+        print
+        print "   The last %s entries are available with the cursor keys, the" % (HISTORY_READLINE_ENTRIES,)
+        print "   history keeps the last %s. Scripts are not recorded." % (HISTORY_MAX_ENTRIES,)
+        print
+
+    # =========================================================================
+    def do_cache(self, line):
+        """ Control the result cache: on, off, stats, clear, budget MB. """
+        params = line.lower().split()
+        if len(params) == 0 or params[0] == 'stats':
+            if self.result_cache is None:
+                log.info('Result cache is off.')
+                return
+            cache = self.result_cache
+            log.info('Result cache: %s entries, %.1f of %.1f MB, %s hits, %s misses, %s evictions.',
+                     len(cache), cache.size / 1048576.0, cache.budget / 1048576.0,
+                     cache.hits, cache.misses, cache.evictions)
+        elif params[0] == 'on':
+            if self.result_cache is None:
+                self.result_cache = ResultCache()
+        elif params[0] == 'off':
+            self.result_cache = None
+        elif params[0] == 'clear':
+            if self.result_cache is not None:
+                self.result_cache.clear()
+        elif params[0] == 'budget' and len(params) == 2 and params[1].isdigit():
+            if self.result_cache is None:
+                self.result_cache = ResultCache()
+            self.result_cache.set_budget(int(params[1]) * 1024 * 1024)
+        else:
+            log.error('Unknown cache command "%s"!', line)
+
+    @staticmethod
+    def help_cache():
+        print
+        print HIGHLIGHT(">> %s [on|off|stats|clear|budget MB]") % (RED('cache'),)
+        print "   Caches the results of read only statements (SELECT/WITH without"
+        print "   random(), 'now', ...) keyed by the statement and its literals."
+        print
+        print "   A cached result is used as long as neither this connection nor"
+        print "   any other process changed the database (total_changes,"
+        print "   PRAGMA data_version/schema_version, file size and mtime)."
+        print "   The least recently used results are evicted to stay within"
+        print "   the memory budget (default %s MB)." % (RESULT_CACHE_BUDGET // 1048576,)
+        print
+
+    def complete_cache(self, text, line, begidx, endidx):
+        return self._complete(text, ['on', 'off', 'stats', 'clear', 'budget',])
+
+    # =========================================================================
+    def do_df(self, line):
+        """ Fetch a query column wise or summarize the last one: describe, head, value_counts. """
+        params = line.split()
+        if len(params) == 0 or params[0].lower() in ('describe', 'head', 'value_counts',):
+            if self.df is None:
+                log.error('No df result, run "df SQL" first!')
+                return
+            command = params[0].lower() if params else None
+            if command is None:
+                self._show_columnar(self.df)
+            elif command == 'describe':
+                names = ('column', 'type', 'count', 'nulls', 'distinct', 'min', 'max', 'mean',)
+                self._print_mode_table(ResultInfo(_description(names)), self.df.describe())
+            elif command == 'head':
+                count = int(params[1]) if len(params) > 1 and params[1].isdigit() else DF_HEAD_ROWS
+                self._print_mode_table(ResultInfo(_description(self.df.column_names)), self.df.head(count))
+            elif len(params) in (2, 3,) and params[1] in self.df.column_names:
+                count = int(params[2]) if len(params) == 3 and params[2].isdigit() else DF_VALUE_COUNTS
+                self._print_mode_table(ResultInfo(_description((params[1], 'count',))),
+                                       self.df.value_counts(params[1], count))
+            else:
+                log.error('Usage: df value_counts COLUMN [COUNT], columns are %s.', ', '.join(self.df.column_names))
+            return
+
+        if self.remote is None and not self._connected():
+            return
+        mode = self.mode
+        self.mode = COLUMNAR
+        try:
+            self._execute(line)
+        finally:
+            self.mode = mode
+
+    @staticmethod
+    def help_df():
+        print
+        print HIGHLIGHT(">> %s SQL") % (RED('df'),)
+        print "   Runs SQL and keeps the result column wise: integer and real"
+        print "   columns in typed arrays, all other columns as lists."
+        print "   The result is available as 'df' in the py shell, as pandas"
+        print "   DataFrame if pandas is installed (self.df.to_numpy() for NumPy)."
+        print "   'mode columnar' does the same for every query, also for the"
+        print "   merged result of use_many and the result of a query server."
+        print
+        print HIGHLIGHT(">> %s [describe|head [N]|value_counts COLUMN [N]]") % (RED('df'),)
+        print "   Summaries of the last df result: count, nulls, distinct values,"
+        print "   min, max and mean per column, the first N rows or the N most"
+        print "   frequent values of COLUMN. Computed with NumPy if installed."
+        print
+
+    def complete_df(self, text, line, begidx, endidx):
+        params = line.split()
+        if self.df is not None and len(params) >= 2 and params[1] == 'value_counts':
+            return self._complete(text, self.df.column_names)
+        if len(params) == 1 or (len(params) == 2 and text):
+            return self._complete(text, ['describe', 'head', 'value_counts',]) + self.completedefault(text, line, begidx, endidx)
+        return self.completedefault(text, line, begidx, endidx)
+
+    # =========================================================================
+    def do_analyze_table(self, line):
+        """ Row/page counts, column statistics from a sample and the indexes of a table. """
+        if not self._connected():
+            return
+        params = line.split()
+        if len(params) not in (1, 2,) or (len(params) == 2 and not params[1].isdigit()):
+            log.error('Usage: analyze_table TABLE [SAMPLE_ROWS]')
+            return
+        table_name   = params[0]
+        sample_rows  = int(params[1]) if len(params) == 2 else ANALYZE_SAMPLE_ROWS
+        column_names = self.schema.column_names(table_name)
+        if not column_names:
+            log.error('Unknown table "%s"!', table_name)
+            return
+        quoted = _quote_identifier(table_name)
+        try:
+            count = self.connection.execute('SELECT count(*) FROM %s' % (quoted,)).fetchone()[0]
+            try:
+                pages, size = self.connection.execute('SELECT count(*), sum(pgsize) FROM dbstat WHERE name = ?',
+                                                      (table_name,)).fetchone()
+                storage = '%s pages, %.1f MB' % (pages, (size or 0) / 1048576.0,)
+            except DB.Error:
+                storage = 'unknown (no dbstat)'
+            # Each row is taken with a chance of 1/step, which spreads the
+            # sample over the table without sorting it.
+            step   = max(count // max(sample_rows, 1), 1)
+            cur    = self.connection.cursor()
+            cur.row_factory = None
+            sample = cur.execute('SELECT * FROM %s WHERE random() %% ? = 0 LIMIT ?' % (quoted,),
+                                 (step, sample_rows,)).fetchall()
+            indexes = []
+            for index in self.connection.execute('PRAGMA index_list(%s)' % (quoted,)).fetchall():
+                columns = [ row[2] for row in self.connection.execute('PRAGMA index_info(%s)' % (_quote_identifier(index[1]),)) ]
+                indexes.append('%s%s (%s)' % (index[1], ' UNIQUE' if index[2] else '', ', '.join([ _to_text(column) for column in columns ]),))
+        except DB.Error, e:
+            log.error('analyze_table failed! %s', e)
+            return
+
+        print "%s: %s rows, %s" % (HIGHLIGHT(table_name), count, storage,)
+        print "Indexes: %s" % (', '.join(indexes) or 'none',)
+        print "Column statistics of %s sampled rows:" % (len(sample),)
+        rows = []
+        for idx, column_name in enumerate(column_names):
+            values  = [ row[idx] for row in sample ]
+            # NULL is no distinct value, it's counted by null_pct.
+            present = [ value for value in values if value is not None ]
+            types   = collections.Counter([ type(value).__name__ for value in present ])
+            rows.append((column_name, ', '.join(sorted(types)) or '-', len(set(present)),
+                         estimate_distinct(present, count * len(present) // max(len(values), 1)),
+                         round(100.0 * (len(values) - len(present)) / max(len(values), 1), 1),))
+        names = ('column', 'types', 'sample_distinct', 'est_distinct', 'null_pct',)
+        self._print_data(ResultInfo(_description(names)), self._encode_rows(rows) if self.mode in (CSV, TSV,) else rows)
+
+    @staticmethod
+    def help_analyze_table():
+        print
+        print HIGHLIGHT(">> %s TABLE [SAMPLE_ROWS]") % (RED('analyze_table'),)
+        print "   Shows the row count, the pages used (if the dbstat table is"
+        print "   compiled in) and the indexes of TABLE. Value types, null"
+        print "   percentage and estimated distinct values per column are taken"
+        print "   from SAMPLE_ROWS (default %s) rows spread over the table." % (ANALYZE_SAMPLE_ROWS,)
+        print
+
+    def complete_analyze_table(self, text, line, begidx, endidx):
+        return self._complete(text, self.schema.table_names())
+
+    def do_advise(self, line):
+        """ Suggest indexes for the full scans of a query, create them with "advise create SQL". """
+        if not self._connected():
+            return
+        params = line.split(None, 1)
+        create = len(params) == 2 and params[0].lower() == 'create'
+        sql    = params[1] if create else line
+        if not SQL_QUERY.match(sql):
+            log.error('Usage: advise [create] SELECT ...')
+            return
+        try:
+            plan = [ row[3] for row in self.connection.execute('EXPLAIN QUERY PLAN %s' % (sql,)) ]
+        except DB.Error, e:
+            log.error("Can't explain statement! %s", e)
+            return
+        for detail in plan:
+            log.info('Plan: %s', detail)
+
+        aliases = {}
+        for table_name, alias in SQL_TABLE_ALIAS.findall(sql):
+            aliases[(alias or table_name).lower()] = (alias or table_name, table_name,)
+        suggestions = []
+        for detail in plan:
+            match = SQL_FULL_SCAN.match(detail) or SQL_AUTOMATIC_INDEX.match(detail)
+            if match is None:
+                continue
+            alias, table_name = aliases.get(match.group(1).lower(), (match.group(1), match.group(1),))
+            columns = suggest_index(sql, alias, table_name, self.schema.column_names(table_name))
+            if not columns:
+                log.info('%s: no column of the statement can use an index.', table_name)
+                continue
+            index_name = re.sub(r'\W', '_', 'advise_%s_%s' % (table_name, '_'.join(columns),))
+            suggestions.append('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                               _quote_identifier(index_name), _quote_identifier(table_name),
+                               ', '.join([ _quote_identifier(column) for column in columns ]),))
+        if not suggestions:
+            log.info('No index suggestions.')
+            return
+        for statement in suggestions:
+            print '%s;' % (HIGHLIGHT(statement),)
+        if not create:
+            return
+
+        try:
+            before = self._time_query(sql)
+            for statement in suggestions:
+                self.connection.execute(statement)
+            self.connection.commit()
+            self.schema.validate()
+            after  = self._time_query(sql)
+            plan   = [ row[3] for row in self.connection.execute('EXPLAIN QUERY PLAN %s' % (sql,)) ]
+        except KeyboardInterrupt:
+            print
+            log.info('advise interrupted.')
+            return
+        except DB.Error, e:
+            log.error('advise create failed! %s', e)
+            return
+        for detail in plan:
+            log.info('New plan: %s', detail)
+        log.info('Query time %.4fs -> %.4fs (%.1fx), best of %s runs.', before, after, before / max(after, 1e-6), ADVISE_RUNS)
+
+    @staticmethod
+    def help_advise():
+        print
+        print HIGHLIGHT(">> %s [create] SQL") % (RED('advise'),)
+        print "   Runs EXPLAIN QUERY PLAN for the query SQL and suggests an index"
+        print "   for every table that is scanned (or gets an automatic index):"
+        print "   equality columns of WHERE/ON first, then a range or the ORDER BY"
+        print "   columns and the other used columns to make it covering."
+        print "   The columns are found by a heuristic, check the suggestions."
+        print
+        print "   With create the indexes are created and the query is timed"
+        print "   (best of %s runs) before and after." % (ADVISE_RUNS,)
+        print
+
+    def _time_query(self, sql):
+        """ Best time of ADVISE_RUNS executions of sql including fetching all rows. """
+        best = None
+        for _ in range(ADVISE_RUNS):
+            started = time.time()
+            cur     = self.connection.cursor()
+            cur.row_factory = None
+            cur.execute(sql).fetchall()
+            cur.close()
+            elapsed = time.time() - started
+            best    = elapsed if best is None else min(best, elapsed)
+        return best
+
+    # =========================================================================
+    def do_watch(self, line):
+        """ Print the new rows of a query (ordered by its first column) until Ctrl-C. """
+        if not self._connected():
+            return
+        params = line.split(None, 1)
+        if len(params) != 2 or not _is_number(params[0]) or not SQL_QUERY.match(params[1]):
+            log.error('Usage: watch INTERVAL SELECT ...')
+            return
+        sql = params[1].strip().rstrip(';')
+        try:
+            names = [ cn[0] for cn in self.connection.execute('SELECT * FROM (%s) LIMIT 0' % (sql,)).description ]
+        except DB.Error, e:
+            log.error("Can't watch statement! %s", e)
+            return
+        # The condition on the key is pushed into the query by SQLite, with
+        # an index (or the rowid) as key a poll only reads the new rows.
+        newer = 'SELECT * FROM (%s) WHERE %s > ? ORDER BY 1' % (sql, _quote_identifier(names[0]),)
+        self._poll(float(params[0]), 'SELECT * FROM (%s) ORDER BY 1' % (sql,), (), newer)
+
+    @staticmethod
+    def help_watch():
+        print
+        print HIGHLIGHT(">> %s INTERVAL SQL") % (RED('watch'),)
+        print "   Runs the query SQL and then every INTERVAL seconds prints the"
+        print "   rows whose first column is greater than the last one printed,"
+        print "   until Ctrl-C. The result is ordered by the first column, which"
+        print "   should be a unique key growing with new rows (e.g. rowid or an"
+        print "   indexed id), then a poll only reads the new rows. New rows with"
+        print "   the last printed key or a smaller one are not shown. Polls are"
+        print "   skipped while PRAGMA data_version shows no commit of another"
+        print "   connection."
+        print
+        print "   e.g. watch 2 SELECT id, level, message FROM log WHERE level = 'ERROR'"
+        print
+        print "   Related commands: tail"
+        print
+
+    def do_tail(self, line):
+        """ Print the last rows of a table and then the new ones until Ctrl-C. """
+        if not self._connected():
+            return
+        params   = line.split()
+        interval = WATCH_INTERVAL
+        if len(params) > 1 and _is_number(params[-1]):
+            interval = float(params.pop())
+        if len(params) not in (1, 2,):
+            log.error('Usage: tail TABLE [KEY] [INTERVAL]')
+            return
+        table = _quote_identifier(params[0])
+        key   = _quote_identifier(params[1]) if len(params) == 2 else 'rowid'
+        if len(params) == 2 and not self._unique_column(params[0], params[1]):
+            log.error('%s is not a unique key of %s, rows sharing the last key would be skipped!',
+                      params[1], params[0])
+            return
+        # The key is the first column of the queries and is not printed. It has
+        # an own name, a second column of the same name would be renamed.
+        last  = 'SELECT * FROM (SELECT %s AS _tail_key, * FROM %s ORDER BY 1 DESC LIMIT %d) ORDER BY 1' % (
+                key, table, TAIL_ROWS,)
+        newer = 'SELECT %s AS _tail_key, * FROM %s WHERE %s > ? ORDER BY 1' % (key, table, key,)
+        self._poll(interval, last, (), newer, hide_key=True)
+
+    @staticmethod
+    def help_tail():
+        print
+        print HIGHLIGHT(">> %s TABLE [KEY] [INTERVAL]") % (RED('tail'),)
+        print "   Prints the last %s rows of TABLE and then every INTERVAL seconds" % (TAIL_ROWS,)
+        print "   (default %s) the rows appended since, until Ctrl-C. Rows are" % (WATCH_INTERVAL,)
+        print "   ordered by KEY (default rowid), which has to be unique (primary"
+        print "   key or UNIQUE index). Indexed, a poll costs only the new rows."
+        print
+        print "   Related commands: watch"
+        print
+
+    def complete_tail(self, text, line, begidx, endidx):
+        return self._complete(text, self.schema.table_names())
+
+    def _unique_column(self, table_name, column_name):
+        """ True if column_name alone is the primary key or has a UNIQUE index. """
+        table   = _quote_identifier(table_name)
+        name    = column_name.lower()
+        if name in ('rowid', 'oid', '_rowid_',):
+            return True
+        primary = [ info[1].lower() for info in self.connection.execute('PRAGMA table_info(%s)' % (table,))
+                    if info[5] ]
+        if primary == [ name ]:
+            return True
+        for index in self.connection.execute('PRAGMA index_list(%s)' % (table,)).fetchall():
+            if not index[2] or (len(index) > 4 and index[4]):   # not unique or partial
+                continue
+            columns = [ info[2] for info in self.connection.execute(
+                        'PRAGMA index_info(%s)' % (_quote_identifier(index[1]),)) ]
+            if [ (column or '').lower() for column in columns ] == [ name ]:
+                return True
+        return False
+
+    def _poll(self, interval, sql, params, newer, hide_key=False):
+        """ Print the result of sql, then the rows of newer (the key of the
+        last row as parameter) after every commit, until Ctrl-C. """
+        version = None
+        key     = None
+        try:
+            while True:
+                # data_version changes with every commit of other connections.
+                current = self.connection.execute('PRAGMA data_version').fetchone()[0]
+                if current != version:
+                    key     = self._print_increment(sql, params, hide_key, key, version is None)
+                    version = current
+                    if key is not None:
+                        sql, params = newer, (key,)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print
+        except DB.Error, e:
+            log.error('Poll failed! %s', e)
+
+    def _print_increment(self, sql, params, hide_key, key, header):
+        """ Print the result of sql, returns the key (first column) of its last row or key.
+
+        Appended CSV/TSV rows get no header again.
+        """
+        cur             = self.connection.cursor()
+        cur.row_factory = None
+        if self.mode in (CSV, TSV,):
+            self.connection.text_factory = str
+        last = [ key ]
+
+        def rows():
+            for row in cur:
+                # The highest key, not the one of the last row.
+                if row[0] is not None and (last[0] is None or row[0] > last[0]):
+                    last[0] = row[0]
+                yield row[1:] if hide_key else row
+
+        try:
+            cur.execute(sql, params)
+            description = cur.description[1:] if hide_key else cur.description
+            result      = rows()
+            first       = next(result, None)
+            if first is None:
+                pass
+            elif self.mode in (CSV, TSV,) and not header:
+                self._write_csv(ResultInfo(description), itertools.chain((first,), result),
+                                sys.stdout, FORMATS[self.mode][SEPARATOR], header=False)
+            else:
+                self._print_data(ResultInfo(description), itertools.chain((first,), result))
+        finally:
+            cur.close()
+            self.connection.text_factory = unicode
+        return last[0]
+
+    # =========================================================================
+    def do_checksum(self, line):
+        """ Checksum of a table, its key ranges are hashed in parallel. """
+        import hashlib
+        params = line.split()
+        if len(params) not in (1, 2,):
+            log.error('Usage: checksum TABLE [KEY]')
+            return
+        setup = self._checksum_setup(params[0], params[1] if len(params) == 2 else None)
+        if setup is None:
+            return
+        table, key, columns = setup
+        workers = [ (connection,) for connection in self._checksum_connections(self.name) ]
+        started = time.time()
+        try:
+            ranges  = key_ranges(key_boundaries(workers[0][0], table, key, CHECKSUM_CHUNK_ROWS))
+            results = self._map_ranges(lambda connections, lo, hi: range_checksum(connections[0], table, key, columns, lo, hi),
+                                       ranges, workers)
+        except KeyboardInterrupt:
+            print
+            log.info('checksum interrupted.')
+            return
+        except DB.Error, e:
+            log.error('checksum failed! %s', e)
+            return
+        finally:
+            for connections in workers:
+                connections[0].close()
+        digest = hashlib.md5(''.join([ result[1] for result in results ])).hexdigest()
+        print '%s  %s' % (HIGHLIGHT(digest), params[0],)
+        log.info('%s rows in %s ranges hashed in %.2fs.', sum([ result[0] for result in results ]),
+                 len(ranges), time.time() - started)
+
+    @staticmethod
+    def help_checksum():
+        print
+        print HIGHLIGHT(">> %s TABLE [KEY]") % (RED('checksum'),)
+        print "   Prints a checksum of the rows of TABLE. The table is split into"
+        print "   ranges of %s rows of KEY (default rowid), which are hashed by" % (CHECKSUM_CHUNK_ROWS,)
+        print "   %s worker connections in parallel. Equal tables (same rows, keys" % (CHECKSUM_WORKERS,)
+        print "   and column order) have equal checksums."
+        print
+        print "   Related commands: diff"
+        print
+
+    def complete_checksum(self, text, line, begidx, endidx):
+        return self._complete(text, self.schema.table_names())
+
+    def do_diff(self, line):
+        """ Differing rows of a table in the actual database and another one. """
+        params = line.split()
+        if len(params) not in (2, 3,):
+            log.error('Usage: diff TABLE OTHER_DB [KEY]')
+            return
+        other_name = os.path.expanduser(params[1])
+        if not os.path.isfile(other_name):
+            log.error('Database file "%s" not found!', other_name)
+            return
+        setup = self._checksum_setup(params[0], params[2] if len(params) == 3 else None)
+        if setup is None:
+            return
+        table, key, columns = setup
+
+        def checksums(connections, lo, hi):
+            return tuple([ range_checksum(connection, table, key, columns, lo, hi) for connection in connections ])
+
+        workers = zip(self._checksum_connections(self.name), self._checksum_connections(other_name))
+        mine, theirs = workers[0]
+        started = time.time()
+        counts  = [ 0, 0, 0, ]   # only here, only in other, differing
+        hashed  = 0
+        try:
+            # Mismatching ranges are split until they are small enough to
+            # compare their rows, equal ranges are never read again.
+            pending = key_ranges(key_boundaries(mine, table, key, CHECKSUM_CHUNK_ROWS))
+            step    = CHECKSUM_CHUNK_ROWS
+            leaves  = []
+            while pending:
+                results = self._map_ranges(checksums, pending, workers)
+                hashed += len(pending)
+                step    = max(step // CHECKSUM_SPLIT, 1)
+                split   = []
+                for key_range, (here, there) in zip(pending, results):
+                    if here == there:
+                        continue
+                    if max(here[0], there[0]) <= CHECKSUM_LEAF_ROWS:
+                        leaves.append(key_range)
+                        continue
+                    source = mine if here[0] >= there[0] else theirs
+                    ranges = key_ranges(key_boundaries(source, table, key, step, *key_range), *key_range)
+                    if len(ranges) < 2:
+                        leaves.append(key_range)
+                    else:
+                        split.extend(ranges)
+                pending = split
+
+            for lo, hi in leaves:
+                for row_key, here, there in diff_rows(mine, theirs, table, key, columns, lo, hi):
+                    kind = 0 if there is None else 1 if here is None else 2
+                    counts[kind] += 1
+                    if sum(counts) > DIFF_SHOWN_ROWS:
+                        continue
+                    lines = []
+                    if here is not None:
+                        lines.append(RED(u'- %s' % (here.decode('utf-8', 'replace'),)))
+                    if there is not None:
+                        lines.append(GREEN(u'+ %s' % (there.decode('utf-8', 'replace'),)))
+                    _write_lines(lines)
+        except KeyboardInterrupt:
+            print
+            log.info('diff interrupted.')
+            return
+        except DB.Error, e:
+            log.error('diff failed! %s', e)
+            return
+        finally:
+            for connections in workers:
+                for connection in connections:
+                    connection.close()
+
+        elapsed = time.time() - started
+        if not any(counts):
+            log.info('%s is equal in %s and %s (%s ranges hashed in %.2fs).',
+                     params[0], self.name, other_name, hashed, elapsed)
+            return
+        if sum(counts) > DIFF_SHOWN_ROWS:
+            log.info('First %s differences shown.', DIFF_SHOWN_ROWS)
+        log.info('%s: %s rows only in %s, %s rows only in %s, %s rows differ (%s ranges hashed in %.2fs).',
+                 params[0], counts[0], self.name, counts[1], other_name, counts[2], hashed, elapsed)
+
+    @staticmethod
+    def help_diff():
+        print
+        print HIGHLIGHT(">> %s TABLE OTHER_DB [KEY]") % (RED('diff'),)
+        print "   Compares TABLE of the actual database with TABLE of the database"
+        print "   file OTHER_DB (e.g. a replica or backup). Both are split into"
+        print "   ranges of %s rows of KEY (default rowid, use the primary key" % (CHECKSUM_CHUNK_ROWS,)
+        print "   of WITHOUT ROWID tables), which are hashed in parallel. Only"
+        print "   ranges with different hashes are split further and finally"
+        print "   compared row by row, equal parts of the tables are read once."
+        print
+        print "   Rows are printed quoted, - for the actual database, + for"
+        print "   OTHER_DB (the first %s differences)." % (DIFF_SHOWN_ROWS,)
+        print
+        print "   Related commands: checksum"
+        print
+
+    def complete_diff(self, text, line, begidx, endidx):
+        if len(line[:begidx].split()) == 2:
+            return self.complete_use(text, line, begidx, endidx)
+        return self._complete(text, self.schema.table_names())
+
+    def _checksum_setup(self, table_name, key):
+        """ (table, key, columns) quoted for the checksum queries, None if table_name is unknown. """
+        if not self._connected():
+            return None
+        if not os.path.isfile(self.name or ''):
+            log.error('Only database files can be compared!')
+            return None
+        column_names = self.schema.column_names(table_name)
+        if not column_names:
+            log.error('Unknown table "%s"!', table_name)
+            return None
+        return (_quote_identifier(table_name), _quote_identifier(key) if key else 'rowid',
+                [ _quote_identifier(name) for name in column_names ],)
+
+    @staticmethod
+    def _checksum_connections(db_name):
+        """ CHECKSUM_WORKERS read only connections to db_name, rows as byte strings. """
+        connections = []
+        for _ in range(CHECKSUM_WORKERS):
+            connection              = DB.connect(db_name, check_same_thread=False)
+            connection.text_factory = str
+            connection.execute('PRAGMA query_only = ON')
+            connections.append(connection)
+        return connections
+
+    @staticmethod
+    def _map_ranges(function, ranges, workers):
+        """ [ function(connections, lo, hi) for every range ], run by one thread per workers item. """
+        import Queue
+        from multiprocessing.pool import ThreadPool
+        idle = Queue.Queue()
+        for connections in workers:
+            idle.put(connections)
+
+        def run(key_range):
+            connections = idle.get()
+            try:
+                return function(connections, *key_range)
+            finally:
+                idle.put(connections)
+
+        pool = ThreadPool(len(workers))
+        try:
+            pending = pool.map_async(run, ranges)
+            while not pending.ready():
+                pending.wait(0.1)
+            return pending.get()
+        except KeyboardInterrupt:
+            for connections in workers:
+                for connection in connections:
+                    connection.interrupt()
+            raise
+        finally:
+            pool.terminate()
+
+    # =========================================================================
+    def do_backup(self, line):
+        """ Copy the actual database with the online backup API. """
+        if not self._connected():
+            return
+        params     = line.split()
+        background = len(params) > 0 and params[-1] == '&'
+        if background:
+            params.pop()
+        if len(params) not in (1, 2, 3,) or not all([ param.isdigit() for param in params[1:] ]):
+            log.error('Usage: backup DEST [PAGES_PER_STEP [SLEEP_MS]] [&]')
+            return
+        target   = os.path.expanduser(params[0])
+        pages    = int(params[1]) if len(params) > 1 else BACKUP_PAGES_PER_STEP
+        sleep_ms = int(params[2]) if len(params) > 2 else BACKUP_SLEEP_MS
+        if not self._copy_allowed(target):
+            return
+        page_size = self.connection.execute('PRAGMA page_size').fetchone()[0]
+        source    = self.name
+
+        def runner(job):
+            def progress(remaining, pagecount):
+                done         = pagecount - remaining
+                job.progress = '%s/%s pages (%.0f%%), %.1f MB/s' % (
+                               done, pagecount, 100.0 * done / max(pagecount, 1),
+                               done * page_size / 1048576.0 / max(time.time() - job.started, 1e-6),)
+                if not background and sys.stdout.isatty():
+                    sys.stdout.write('\r%s ' % (job.progress,))
+                    sys.stdout.flush()
+            online_backup(source, target, pages, sleep_ms, progress, lambda: job.cancelled)
+            job.progress = "Backup '%s' written, %s" % (target, job.progress,)
+
+        self._run_copy('backup %s' % (target,), runner, background)
+
+    @staticmethod
+    def help_backup():
+        print
+        print HIGHLIGHT(">> %s DEST [PAGES_PER_STEP [SLEEP_MS]] [&]") % (RED('backup'),)
+        print "   Copies the actual database to DEST with the SQLite online backup"
+        print "   API while other connections keep on using it. PAGES_PER_STEP"
+        print "   pages (default %s) are copied at a time, between two steps the" % (BACKUP_PAGES_PER_STEP,)
+        print "   database is unlocked for SLEEP_MS ms (default %s) so writers" % (BACKUP_SLEEP_MS,)
+        print "   aren't starved. A write by another process restarts the copy."
+        print "   DEST is overwritten."
+        print
+        print "   With & the backup runs as background job (see jobs, fg, cancel)."
+        print
+        print "   Related commands: snapshot"
+        print
+
+    def do_snapshot(self, line):
+        """ Compacted copy of the actual database with VACUUM INTO. """
+        if not self._connected():
+            return
+        params     = line.split()
+        background = len(params) > 0 and params[-1] == '&'
+        if background:
+            params.pop()
+        if len(params) != 1:
+            log.error('Usage: snapshot DEST [&]')
+            return
+        if DB.sqlite_version_info < (3, 27, 0):
+            log.error('snapshot needs SQLite 3.27 (VACUUM INTO), this is %s!', DB.sqlite_version)
+            return
+        target = os.path.expanduser(params[0])
+        if os.path.exists(target):
+            log.error("'%s' exists, VACUUM INTO doesn't overwrite files!", target)
+            return
+        if not self._copy_allowed(target):
+            return
+        source = self.name
+
+        def runner(job):
+            job.connection = DB.connect(source, isolation_level=None, check_same_thread=False)
+            try:
+                job.connection.set_progress_handler(self._progress_tick, PROGRESS_HANDLER_OPCODES)
+                job.connection.execute('VACUUM INTO ?', (target,))
+            finally:
+                job.connection.close()
+            size         = os.path.getsize(target)
+            job.progress = "Snapshot '%s' written, %.1f MB, %.1f MB/s" % (
+                           target, size / 1048576.0, size / 1048576.0 / max(time.time() - job.started, 1e-6),)
+
+        self._run_copy('snapshot %s' % (target,), runner, background)
+
+    @staticmethod
+    def help_snapshot():
+        print
+        print HIGHLIGHT(">> %s DEST [&]") % (RED('snapshot'),)
+        print "   Writes a compacted (vacuumed) copy of the actual database to"
+        print "   the new file DEST with VACUUM INTO. The copy is made within one"
+        print "   read transaction, it's consistent and doesn't block readers"
+        print "   (writers neither in WAL mode)."
+        print
+        print "   With & the snapshot runs as background job (see jobs, fg, cancel)."
+        print
+        print "   Related commands: backup"
+        print
+
+    def _copy_allowed(self, target):
+        if self.name == ':memory:':
+            log.error('backup and snapshot need a database file, not an in-memory database!')
+            return False
+        if os.path.abspath(target) == os.path.abspath(self.name):
+            log.error("Can't copy the database onto itself!")
+            return False
+        return True
+
+    def _run_copy(self, title, runner, background):
+        """ Run a backup/snapshot runner as job, in the foreground unless background. """
+        if background:
+            self._submit_job(title, runner)
+            return
+        job = Job(0, title, runner)
+        try:
+            job.run()
+        except KeyboardInterrupt:
+            job.state = JOB_CANCELLED
+            job.error = 'interrupted'
+        if sys.stdout.isatty():
+            print
+        if job.state == JOB_DONE:
+            log.info('%s in %.2fs.', job.progress, job.elapsed())
+        else:
+            log.error('%s failed! %s', title, job.error)
+
+    # =========================================================================
+    def do_pragma_profile(self, name):
+        """ Show the connection profiles or select the one used by use. """
+        name = name.strip()
+        if len(name) == 0:
+            for profile in sorted(CONNECTION_PROFILES.keys()):
+                pragmas = CONNECTION_PROFILES[profile]
+                marker  = '*' if profile == self.pragma_profile else ' '
+                print "%s %s %s" % (marker, HIGHLIGHT('%-12s' % (profile,)),
+                                       ', '.join([ '%s=%s' % item for item in pragmas.items() ]) or '-',)
+            return
+        if name not in CONNECTION_PROFILES:
+            log.error('Unknown connection profile "%s"!', name)
+            return
+        self.pragma_profile = name
+        if self.connection is not None:
+            self._apply_pragmas(self.connection, CONNECTION_PROFILES[name])
+
+    @staticmethod
+    def help_pragma_profile():
+        print
+        print HIGHLIGHT(">> %s [PROFILE]") % (RED('pragma_profile'),)
+        print "   Without PROFILE the connection profiles are listed, the"
+        print "   actual one marked with *."
+        print
+        print "   With PROFILE its PRAGMAs are applied to the open connection"
+        print "   and to all connections opened later (use, use_many, bg):"
+        print "      read-heavy : mmap, 64 MB page cache, temp tables in memory,"
+        print "                   query_only"
+        print "      bulk-load  : WAL, synchronous OFF, 256 MB page cache"
+        print "      safe       : WAL, synchronous FULL, foreign keys"
+        print "   PRAGMAs of a profile not set by the next one stay in effect"
+        print "   until the database is opened again, profiles are editable"
+        print "   in the config files (see load_config)."
+        print
+
+    def complete_pragma_profile(self, text, line, begidx, endidx):
+        return self._complete(text, sorted(CONNECTION_PROFILES.keys()))
+
+    # =========================================================================
+    def do_pragma_bench(self, line):
+        """ Time a query on fresh connections with each connection profile. """
+        if not self._connected():
+            return
+        params = line.rsplit(None, 1)
+        runs   = PRAGMA_BENCH_RUNS
+        if len(params) == 2 and params[1].isdigit():
+            line, runs = params[0], max(int(params[1]), 1)
+        if not SQL_QUERY.match(line):
+            log.error('pragma_bench needs a query (SELECT, WITH, ...)!')
+            return
+
+        rows = []
+        for profile in sorted(CONNECTION_PROFILES.keys()):
+            pragmas    = CONNECTION_PROFILES[profile]
+            connection = DB.connect(self.name, cached_statements=self.cached_statements, factory=Connection)
+            self.functions.register(connection)
+            try:
+                # journal_mode would be changed in the database file and
+                # query_only keeps the benchmark from writing anything.
+                self._apply_pragmas(connection, pragmas, skip=PERSISTENT_PRAGMAS)
+                self._apply_pragmas(connection, { 'query_only': 'ON', })
+                timings = []
+                count   = 0
+                for run in range(runs + 1):
+                    started = time.time()
+                    count   = len(connection.execute(line).fetchall())
+                    if run > 0: # the first run warms up the caches
+                        timings.append(time.time() - started)
+            except DB.Error, e:
+                log.error('Profile %s failed! %s', profile, e)
+                continue
+            finally:
+                connection.close()
+            timings.sort()
+            rows.append((profile, round(timings[0], 4), round(_percentile(timings, 50), 4), count,
+                         ', '.join([ '%s=%s' % item for item in pragmas.items() ]),))
+        rows.sort(key=lambda row: row[2])
+        names = ('profile', 'min_s', 'median_s', 'rows', 'pragmas',)
+        self._print_data(ResultInfo(_description(names)), self._encode_rows(rows) if self.mode in (CSV, TSV,) else rows)
+
+    @staticmethod
+    def help_pragma_bench():
+        print
+        print HIGHLIGHT(">> %s SQL [RUNS]") % (RED('pragma_bench'),)
+        print "   Runs the query SQL %s times (RUNS) after a warm up run on a" % (PRAGMA_BENCH_RUNS,)
+        print "   new connection per connection profile and shows min and median"
+        print "   time per profile, fastest first."
+        print
+        print "   The connections are query_only and skip the PRAGMAs stored in"
+        print "   the database file (%s)." % (', '.join(PERSISTENT_PRAGMAS),)
+        print
+
+    # =========================================================================
+    def do_isolation_level(self, level):
+        """ Set's or get's the database isolation level."""
+        if not self._connected():
+            return
+
+        if len(level) == 0:
+            level_description = self.isolation_level
+            if self.isolation_level is None:
+                level_description = 'Autocommit'
+            log.info("Actual isolation_level is %s" % (level_description,))
+        elif level in ISOLATION_LEVELS:
+            if level == 'Autocommit':
+                level = None
+            self.isolation_level            = level
+            self.connection.isolation_level = level
+        else:
+            log.error('Unknown/handled isolation_level: %s', level)
+    @staticmethod
+    def help_isolation_level():
+        print
+        print HIGHLIGHT(">> %s [LEVEL]") % (RED('isolation_level'),)
+        print "   Sets the Database isolation level to [LEVEL]."
+        print
+        print "   Hint:"
+        print "      isolation_level <TAB><TAB>"
+        print "   to see all available levels."
+        print
+        print "   Called without parameter the actual isolation level is shown."
+        print
+
+    def complete_isolation_level(self, text, line, begidx, endidx):
+        return self._complete(text, ISOLATION_LEVELS)
+
+    # =========================================================================
+    @staticmethod
+    def emptyline():
+        return
+
+    # =========================================================================
+    def do_use(self, db_name):
+        """ Open a sqlite database file. """
+        params = db_name.rsplit(None, 1)
+        if len(params) == 2 and params[1].isdigit():
+            db_name                 = params[0]
+            self.cached_statements  = int(params[1])
+        params = db_name.rsplit(None, 1)
+        if len(params) == 2 and params[1] in CONNECTION_PROFILES:
+            db_name                 = params[0]
+            self.pragma_profile     = params[1]
+        self._disconnect()
+        self._close_shards()
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        self.name                   = db_name
+        self.connection             = self._open_connection(db_name)
+        # .....................................................................
+        cur                         = self.connection.cursor()
+        cur.execute('SELECT SQLITE_VERSION() as version')
+        data = cur.fetchone()
+        log.debug("Connected to database '%s'.", db_name)
+        log.debug("SQLiteVersion is '%s'.", data['version'])
+        log.debug("Updateing table names cache...")
+        self._update_cache_table_names()
+        log.debug("done.")
+        self.queries                = QueryStore(db_name)
+
+    @staticmethod
+    def help_use():
+        print
+        print HIGHLIGHT(">> %s [DATABASE FILE NAME] [PROFILE] [STATEMENT_CACHE_SIZE]") % (RED('use'),)
+        print "   Opens the given SQLite Database file."
+        print
+        print "   [PROFILE] connection profile (PRAGMAs) of the connection, see"
+        print "      pragma_profile. It's kept for following 'use'."
+        print
+        print "   [STATEMENT_CACHE_SIZE] number of prepared statements the connection"
+        print "      keeps for reuse (default %s). It's kept for following 'use'." % (DEFAULT_CACHED_STATEMENTS,)
+        print
+        print "   Hint:"
+        print "      use <TAB><TAB>"
+        print "   To see a list of potential database files in the actual working directory"
+        print "   with a filter of *.db, *.sqlite (Filter is configurable)."
+        print
+
+    @staticmethod
+    def complete_use(text, line, begidx, endidx):
+        text_new    = "%s*" % (text,)
+        completions = []
+        for fn in glob.glob(text_new):
+            if os.path.isfile(fn):
+                for ending in DATABASE_FILENAME_SUFFIXES:
+                    if fn.endswith(ending):
+                        completions.append(fn)
+            else:
+                completions.append(fn)
+        return completions
+
+    # =========================================================================
+    def do_use_many(self, pattern):
+        """ Open all database files matching a glob pattern as shards. """
+        filenames = sorted([ fn for fn in glob.glob(os.path.expanduser(pattern)) if os.path.isfile(fn) ])
+        if len(filenames) == 0:
+            log.error('No database files match "%s"!', pattern)
+            return
+
+        self._close_shards()
+        for filename in filenames:
+            # Shards are queried from the worker threads of the shard pool.
+            self.shards.append((filename, self._open_connection(filename, check_same_thread=False),))
+        self.name       = filenames[0]
+        self.connection = self.shards[0][1]
+        log.info('Using %s shards matching "%s".', len(self.shards), pattern)
+        self._update_cache_table_names()
+
+    @staticmethod
+    def help_use_many():
+        print
+        print HIGHLIGHT(">> %s [GLOB PATTERN]") % (RED('use_many'),)
+        print "   Opens every database file matching GLOB PATTERN as a shard."
+        print "   Statements run in parallel on all shards (%s at a time)." % (SHARD_WORKERS or 'one per CPU',)
+        print "   Every shard fetches up to %s batches of rows ahead of the merge." % (SHARD_QUEUE_BATCHES,)
+        print
+        print "   The results are merged:"
+        print "      o) COUNT/SUM/TOTAL/MIN/MAX are re-aggregated per GROUP BY key,"
+        print "      o) ORDER BY results are merge-sorted,"
+        print "      o) all other results are concatenated in file name order."
+        print "   A trailing LIMIT is applied to the merged result again."
+        print "   AVG, GROUP_CONCAT, DISTINCT and window aggregates, aggregates"
+        print "   inside expressions, aggregates with HAVING or LIMIT and GROUP BY"
+        print "   terms which aren't result columns can't be merged, their per"
+        print "   shard results are concatenated."
+        print "   OFFSET is applied per shard, the merged result misses rows."
+        print
+        print "   INSERT, UPDATE, DELETE and DDL statements are committed after"
+        print "   all shards ran them, if one fails all are rolled back. Shards are"
+        print "   separate files though: when a COMMIT fails, the shards committed"
+        print "   before keep the changes."
+        print
+        print "   'use' switches back to a single database."
+        print
+
+    def complete_use_many(self, text, line, begidx, endidx):
+        return self.complete_use(text, line, begidx, endidx)
+
+    # =========================================================================
+    def do_serve(self, line):
+        """ Answer queries on a unix socket until Ctrl-C. """
+        self.last_error = None
+        if not self._connected():
+            self.last_error = 'not connected'
+            return
+        params = line.split()
+        if len(params) not in (1, 2,) or not all([ param.isdigit() for param in params[1:] ]):
+            log.error('Usage: serve SOCKET [READERS]')
+            self.last_error = 'usage'
+            return
+        socket_path = os.path.expanduser(params[0])
+        readers     = int(params[1]) if len(params) > 1 else SERVE_READERS
+        if os.path.exists(socket_path):
+            try:
+                QueryClient(socket_path).close()
+                log.error('%s is in use by another query server!', socket_path)
+                self.last_error = 'in use'
+                return
+            except IOError:
+                os.unlink(socket_path)   # left over by a killed server
+
+        try:
+            server = query_server_class()(socket_path, self, readers)
+        except (IOError, DB.Error), e:
+            log.error("Can't serve on %s! %s", socket_path, e)
+            self.last_error = e
+            return
+        log.info('Serving %s on %s (1 writer, %s readers), Ctrl-C stops.', self.name, socket_path, readers)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+        log.info('Query server on %s stopped.', socket_path)
+
+    @staticmethod
+    def help_serve():
+        print
+        print HIGHLIGHT(">> %s SOCKET [READERS]") % (RED('serve'),)
+        print "   Answers the statements of clients (connect, --connect) on the"
+        print "   unix socket SOCKET with the actual database until Ctrl-C."
+        print "   The server keeps one writer and READERS (default %s) query_only" % (SERVE_READERS,)
+        print "   connections open, queries are run by the readers in parallel,"
+        print "   all other statements (also WITH ... INSERT, PRAGMA optimize,"
+        print "   ...) by the writer one after the other. A statement failing"
+        print "   as read-only on a reader is run again by the writer. The"
+        print "   database is switched to WAL mode."
+        print
+        print "   Clients skip interpreter startup, connecting and schema loading,"
+        print "   many short queries are answered from warm caches."
+        print
+        print "   Related commands: connect"
+        print
+
+    def do_connect(self, line):
+        """ Send the statements to a query server. """
+        socket_path = line.strip()
+        if not socket_path:
+            if self.remote is None:
+                log.info('Not connected to a query server.')
+            else:
+                log.info('Connected to the query server on %s.', self.remote.socket_path)
+            return
+        self._disconnect()
+        if socket_path.lower() == 'off':
+            return
+        try:
+            self.remote = QueryClient(os.path.expanduser(socket_path))
+        except IOError, e:
+            log.error("Can't connect to the query server on %s! %s", socket_path, e)
+            return
+        log.info('Statements are run by the query server on %s.', socket_path)
+
+    @staticmethod
+    def help_connect():
+        print
+        print HIGHLIGHT(">> %s [SOCKET|off]") % (RED('connect'),)
+        print "   Runs statements on the query server listening on SOCKET (see"
+        print "   serve) instead of the actual database, results are streamed"
+        print "   back and printed in the actual mode. Blobs arrive as x'HEX'."
+        print "   Shell commands (schema, export, ...) still use the actual"
+        print "   database. 'connect off' or 'use' switch back, without"
+        print "   parameters the actual server is shown."
+        print
+        print "   sqlite_cli.py --connect SOCKET runs a script on the server."
+        print
+
+    def _disconnect(self):
+        if self.remote is not None:
+            self.remote.close()
+            self.remote = None
+
+    def _reconnect(self):
+        socket_path = self.remote.socket_path
+        self._disconnect()
+        try:
+            self.remote = QueryClient(socket_path)
+        except IOError, e:
+            log.error("Can't reconnect to the query server on %s! %s", socket_path, e)
+
+    # =========================================================================
+    def do_load(self, line):
+        """ Bulk load a CSV/TSV/JSONL file into a table. """
+        if not self._connected():
+            return
+
+        match = re.match(r'^\s*(\S+)\s+INTO\s+(\S+)(?:\s+(\d+))?\s*$', line, re.IGNORECASE)
+        if match is None:
+            log.error('Usage: load FILENAME INTO TABLE [BATCH_SIZE]')
+            return
+        filename, table_name, batch_size = match.groups()
+        batch_size = int(batch_size) if batch_size else self.load_batch_size
+
+        try:
+            stream = open(filename, 'rb')
+        except IOError, e:
+            log.error("Can't open '%s'! %s", filename, e)
+            return
+
+        with stream:
+            if os.path.splitext(filename)[1].lower() in JSONL_FILENAME_SUFFIXES:
+                column_names, rows = self._read_jsonl(stream)
+            else:
+                separator = FORMATS[TSV if filename.lower().endswith('.tsv') else CSV][SEPARATOR]
+                column_names, rows = self._read_csv(stream, separator)
+            if not column_names:
+                log.error("No columns found in '%s'!", filename)
+                return
+            self._load_rows(table_name, column_names, rows, batch_size)
+
+    @staticmethod
+    def help_load():
+        print
+        print HIGHLIGHT(">> %s [FILENAME] INTO [TABLE] [BATCH_SIZE]") % (RED('load'),)
+        print "   Bulk loads FILENAME into TABLE."
+        print
+        print "   Files ending with %s are read as JSON lines," % (', '.join(JSONL_FILENAME_SUFFIXES),)
+        print "   .tsv files as tab separated, all others as CSV with the separator"
+        print "   of output-mode CSV. The first CSV line holds the column names."
+        print "   Empty CSV fields are loaded as NULL."
+        print
+        print "   A missing TABLE is created with column types inferred from the"
+        print "   first %s rows, numbers with leading zeros (0123) make a column" % (LOAD_INFER_ROWS,)
+        print "   TEXT. Rows are inserted in transactions of BATCH_SIZE"
+        print "   rows (see load_batch_size) with synchronous=OFF, journal_mode=MEMORY"
+        print "   and the indexes of TABLE dropped until the load is done."
+        print
+
+    def do_load_batch_size(self, size):
+        """ Get/Set number of rows inserted per transaction by load. """
+        if len(size) == 0:
+            log.info('Actual load batch size is %s rows.', self.load_batch_size)
+        elif size.isdigit() and int(size) > 0:
+            self.load_batch_size = int(size)
+        else:
+            log.error('Load batch size must be a positive number! It\'s "%s".', size)
+
+    def complete_load(self, text, line, begidx, endidx):
+        filenames = []
+        for entry in os.listdir('./'):
+            if os.path.isfile(entry):
+                filenames.append(entry)
+        return self._complete(text, filenames)
+
+    # =========================================================================
+    def do_export(self, line):
+        """ Export the result of a query to a CSV/TSV file. """
+        if not self._connected():
+            return
+
+        params = line.split(None, 1)
+        if len(params) < 2:
+            log.error('Usage: export FILENAME SQL')
+            return
+        filename, sql = params
+        separator     = FORMATS[TSV if filename.lower().endswith('.tsv') else CSV][SEPARATOR]
+
+        cur                          = self.connection.cursor()
+        cur.row_factory              = None
+        self.connection.text_factory = str
+        try:
+            cur.execute(sql)
+            if cur.description is None:
+                log.error('Statement returns no data to export!')
+                return
+            started = time.time()
+            with open(filename, 'wb') as stream:
+                count = self._write_csv(cur, self._iter_rows(cur), stream, separator)
+            elapsed = time.time() - started
+            log.info("%s rows exported to '%s' in %.2fs (%d rows/s).",
+                     count, filename, elapsed, count / max(elapsed, 1e-6))
+        except KeyboardInterrupt:
+            print
+            log.info('Export interrupted.')
+        except (DB.Error, IOError), e:
+            log.error("Export failed! %s", e)
+        finally:
+            cur.close()
+            self.connection.text_factory = unicode
+
+    @staticmethod
+    def help_export():
+        print
+        print HIGHLIGHT(">> %s [FILENAME] [SQL]") % (RED('export'),)
+        print "   Writes the result of SQL to FILENAME."
+        print "   Files ending with .tsv are tab separated, all others use"
+        print "   the separator of output-mode CSV (see cfg_csv)."
+        print
+        print "   Rows are streamed from the database, so exports of any size"
+        print "   run in constant memory. The throughput is reported at the end."
+        print
+
+    def complete_export(self, text, line, begidx, endidx):
+        return self.complete_load(text, line, begidx, endidx)
+
+    # =========================================================================
+    def do_save(self, line):
+        """ Store a query with ? or :name parameters for the actual database. """
+        params = line.split(None, 1)
+        if len(params) < 2:
+            log.error('Usage: save NAME SQL')
+            return
+        try:
+            self.queries.add(params[0], params[1])
+        except ValueError, e:
+            log.error('Query not saved! %s', e)
+
+    @staticmethod
+    def help_save():
+        print
+        print HIGHLIGHT(">> %s [NAME] [SQL]") % (RED('save'),)
+        print "   Stores SQL as NAME for the actual database."
+        print "   SQL may use positional (?) or named (:name, @name, $name)"
+        print "   parameters, which are bound by 'run', never interpolated."
+        print
+        print "   Related commands: run, queries, forget"
+        print
+
+    def do_run(self, line):
+        """ Run a stored query. """
+        if not self._connected():
+            return
+        try:
+            args = split_arguments(line)
+        except ValueError, e:
+            log.error('Invalid arguments! %s', e)
+            return
+        if len(args) == 0 or args[0] not in self.queries.queries:
+            log.error('Unknown query "%s"! Use "queries" to list them.', args[0] if args else '')
+            return
+        query = self.queries.queries[args[0]]
+        try:
+            if len(args) == 2 and args[1].startswith('@'):
+                with open(args[1][1:], 'rb') as stream:
+                    self._run_batch(query, query.bind_file(stream))
+            else:
+                self._execute(query.sql, query.bind(args[1:]))
+        except (ValueError, IOError), e:
+            log.error('Can\'t run "%s"! %s', query.name, e)
+
+    @staticmethod
+    def help_run():
+        print
+        print HIGHLIGHT(">> %s [NAME] [ARGUMENTS ...]") % (RED('run'),)
+        print "   Runs the stored query NAME with ARGUMENTS as parameters."
+        print "   Named parameters are given as NAME=VALUE or in the order"
+        print "   they appear in the query. NULL is passed as NULL, numbers"
+        print "   without leading zeros as numbers, quoted ('0123', \"a b\")"
+        print "   and all other arguments as text."
+        print
+        print HIGHLIGHT(">> %s [NAME] @[FILE]") % (RED('run'),)
+        print "   Runs NAME once for every line of the CSV file FILE."
+        print "   The header line names the columns of named parameters."
+        print "   Changing statements use executemany in one transaction,"
+        print "   queries reuse one prepared statement and print all results."
+        print
+
+    def complete_run(self, text, line, begidx, endidx):
+        return self._complete(text, self.queries.queries.keys())
+
+    def do_queries(self, line):
+        """ List stored queries. """
+        for name, query in self.queries.queries.items():
+            print "%s(%s): %s" % (HIGHLIGHT(name), query.signature(), DATA_COLOR(query.sql),)
+
+    def do_forget(self, name):
+        """ Remove a stored query. """
+        self.queries.remove(name.strip())
+
+    def complete_forget(self, text, line, begidx, endidx):
+        return self.complete_run(text, line, begidx, endidx)
+
+    # =========================================================================
+    def do_bg(self, sql):
+        """ Run a query in the background. """
+        if not self._connected():
+            return
+        if len(sql.strip()) == 0:
+            log.error('Usage: bg SQL')
+            return
+        if self.name == ':memory:':
+            log.error('Background jobs need a database file, not an in-memory database!')
+            return
+        self._submit_job(sql, self._query_job_runner(sql))
+
+    @staticmethod
+    def help_bg():
+        print
+        print HIGHLIGHT(">> %s [SQL]") % (RED('bg'),)
+        print "   Runs SQL in the background on an own connection to the actual"
+        print "   database, %s jobs run at the same time. The first %s result" % (BG_WORKERS, BG_SPILL_ROWS,)
+        print "   rows are kept in memory, the rest is spilled to a temporary file."
+        print
+        print "   Use a database in WAL mode (PRAGMA journal_mode=WAL) so that"
+        print "   background readers and the shell don't block each other."
+        print
+        print "   Related commands: jobs, fg, cancel, wait"
+        print
+
+    def do_jobs(self, line):
+        """ List background jobs. """
+        for job in self.jobs.values():
+            rows = job.result.count if job.result is not None else 0
+            print "[%s] %-9s %10s rows %8.2fs  %s" % (job.id, job.state, rows, job.elapsed(),
+                                                      DATA_COLOR(job.title),)
+            if job.progress is not None:
+                print "     %s" % (job.progress,)
+            if job.error is not None:
+                print "     %s" % (RED(job.error),)
+
+    def do_fg(self, job_id):
+        """ Wait for a background job (default: the latest) and print its result. """
+        job = self._get_job(job_id)
+        if job is None:
+            return
+        try:
+            job.wait()
+        except KeyboardInterrupt:
+            print
+            log.info('[%s] still %s.', job.id, job.state)
+            return
+
+        del self.jobs[job.id]
+        if job.state != JOB_DONE:
+            # Never show the partial result of a cancelled or failed job.
+            log.error('[%s] %s: %s', job.id, job.state, job.error or '')
+            if job.result is not None:
+                job.result.close()
+            return
+        log.info('[%s] finished in %.2fs.', job.id, job.elapsed())
+        try:
+            if job.progress is not None:
+                log.info('%s', job.progress)
+            elif job.description is None:
+                log.info('%s rows changed.', job.changes)
+            elif job.result.count == 0:
+                log.info('0 rows returned.')
+            elif self.mode in (CSV, TSV,):
+                self._print_data(job, self._encode_rows(job.result))
+            else:
+                self._print_data(job, job.result)
+        except KeyboardInterrupt:
+            print
+            log.info('Output interrupted.')
+        finally:
+            if job.result is not None:
+                job.result.close()
+
+    def complete_fg(self, text, line, begidx, endidx):
+        return self._complete(text, [ str(job_id) for job_id in self.jobs ])
+
+    def do_cancel(self, job_id):
+        """ Cancel a background job. """
+        job = self._get_job(job_id)
+        if job is not None:
+            job.cancel()
+            log.info('[%s] cancel requested.', job.id)
+
+    def complete_cancel(self, text, line, begidx, endidx):
+        return self.complete_fg(text, line, begidx, endidx)
+
+    def do_wait(self, line):
+        """ Wait until all background jobs are finished. """
+        try:
+            for job in self.jobs.values():
+                job.wait()
+        except KeyboardInterrupt:
+            print
+        self.do_jobs('')
+
+    # =========================================================================
+    @staticmethod
+    def do_cfg_csv(separator):
+        """ Get/Set the separator of output-mode CSV ("tab" for tabs). """
+        if len(separator) == 0:
+            print('Separator for Outputformat %s: %r' % (HIGHLIGHT('CSV'), FORMATS[CSV][SEPARATOR],))
+        elif separator.lower() in ('tab', '\\t',):
+            FORMATS[CSV][SEPARATOR] = '\t'
+        elif len(separator) == 1:
+            FORMATS[CSV][SEPARATOR] = separator
+        else:
+            log.error('Separator must be a single character! It\'s "%s".', separator)
+
+    # =========================================================================
+    def do_quit(self, args):
+        """ Exit shell. """
+        log.info("== Exit shell ==")
+        sys.exit(0)
+
+    # =========================================================================
+    def do_shell(self, line):
+        """ Run a shell command. """
+        log.debug("running shell command: %s", line)
+        output = os.popen(line).read()
+        print output
+
+    # =========================================================================
+    def do_EOF(self, line):
+        return True
+
+    # =========================================================================
+    def do_commit(self, line):
+        """ Commit actual transactions. """
+        if self.connection is not None:
+            self.connection.commit()
 
     # =========================================================================
     def do_rollback(self, line):
@@ -444,41 +4102,109 @@ class SQLiteCli(Cmd):
 
     # =========================================================================
     def default(self, line):
-        if not self._connected():
+        if self.remote is None and not self._connected():
             return
+        # cmd2 passes a parsed statement, str() of it lacks the first word.
+        if hasattr(line, 'full_parsed_statement'):
+            line = line.full_parsed_statement()
+        self._execute(line)
+
+    def _execute(self, sql, params=()):
+        """ Execute sql with params and print the result in the actual mode. """
+        self.last_error = None
+        if self.remote is not None:
+            return self._execute_remote(sql, params)
+        if self.shards:
+            return self._execute_sharded(sql, params)
+
+        stats = StatementStats(sql)
+        if self.profile:
+            self._explain_query_plan(stats, params)
+
+        # Paged results are read only as far as they are shown, they aren't cached.
+        cache_key = None
+        if self.mode != COLUMNAR and not self._paging():
+            cache_key = self._result_cache_key(sql, params)
+        if cache_key is not None:
+            validity = self._result_cache_validity()
+            entry    = self.result_cache.get(cache_key, validity)
+            if entry is not None:
+                log.debug('Result cache hit.')
+                stats.rows = len(entry.rows)
+                if entry.rows:
+                    self._print_data(ResultInfo(entry.description), entry.rows)
+                else:
+                    log.info('0 rows returned.')
+                self._record_stats(stats, stats.started)
+                return
 
         cur = self.connection.cursor()
+        if self.mode in (CSV, TSV,):
+            # The exporter takes plain tuples of utf-8 byte strings.
+            cur.row_factory              = None
+            self.connection.text_factory = str
+        elif self.mode == COLUMNAR:
+            cur.row_factory              = None
         try:
-            cur.execute(line)
-            log.debug('rowcount after executing "%s" is %s.', line, cur.rowcount)
+            started = time.time()
+            cur.execute(sql, params)
+            stats.execute = time.time() - started
+            log.debug('rowcount after executing "%s" is %s.', sql, cur.rowcount)
 
-            data = cur.fetchall()
-            log.debug('rowcount after fetchall() "%s" is %s.', line, cur.rowcount)
-            log.debug('len(data) is %s.', len(data))
-
-            if len(data) == 0: #cur.rowcount <= 0:
+            if cur.description is None:
                 cur.execute('select changes() as changes;')
                 for row in cur:
-                    log.info('%s rows changed.', row['changes'])
+                    # row_factory is None in CSV/TSV mode.
+                    stats.rows = row[0]
+                    log.info('%s rows changed.', row[0])
+                self._record_stats(stats, started)
+                return
+
+            if self.mode == COLUMNAR:
+                self._fetch_columnar(cur, stats)
+                stats.first_row = time.time() - started
+                self._show_columnar(self.df)
+                self._record_stats(stats, started)
+                return
+
+            rows  = self._iter_rows(cur, stats)
+            if cache_key is not None:
+                collected = []
+                rows      = self.result_cache.collect(rows, collected)
+            first = next(rows, None)
+            stats.first_row = time.time() - started
+            if first is None:
+                log.info('0 rows returned.')
             else:
-                log.debug("Result lines count is %s", (len(data),))
-                if len(data) > 0:
-                    self._print_data( cur, data )
+                self._print_data( cur, itertools.chain((first,), rows) )
+            self._record_stats(stats, started)
+            if cache_key is not None and collected[0] is not None:
+                self.result_cache.put(cache_key, validity, cur.description, collected[0])
+        except KeyboardInterrupt:
+            print
+            log.info('Query interrupted.')
         except DB.Error, e:
             self.connection.rollback()
-            log.error("(default cmdhandler) Command failed! %s", e)
+            if str(e) == 'interrupted':
+                print
+                log.info('Query interrupted.')
+            else:
+                log.error("(default cmdhandler) Command failed! %s", e)
+                self.last_error = e
+        finally:
+            cur.close()
+            self.connection.text_factory = unicode
 
     def completedefault(self, text, line, begidx, endidx):
         #log.debug('completedefault: %s | %s', text, line)
-        if len(self.cache_table_names) == 0:
-            self._update_cache_table_names()
-        word_list = self.cache_table_names
-        for table_name in line.split(' '):
-            if table_name in self.cache_table_names:
-                word_list += [ '%s.%s' % (table_name, col_name,) for col_name in self.cache_column_names[table_name] ]
-
-        #word_list += SQL_KEYWORDS
-        return self._complete(text, word_list)
+        index = self._get_completion_index()
+        # Columns of the tables named in the line (or in text as "table.")
+        # are added to the index once per table.
+        for table_name in re.findall(r'[\w$]+', line):
+            if table_name in self.schema.tables and table_name not in self._indexed_tables:
+                index.add([ '%s.%s' % (table_name, col_name,) for col_name in self.schema.column_names(table_name) ])
+                self._indexed_tables.add(table_name)
+        return index.complete(text)
 
     # =========================================================================
     # Helper Methods and Hook Implementations
@@ -493,104 +4219,894 @@ class SQLiteCli(Cmd):
             log.error("TODO: Implement other output formats!!")
             return
 
-        if self.mode == TABLE:
+        if self._paging():
+            self._page(cursor, rows)
+        elif self.mode in (TABLE, COLUMNAR,):
             self._print_mode_table(cursor, rows)
         elif self.mode == LINE:
             self._print_mode_line(cursor, rows)
+        elif self.mode in (CSV, TSV,):
+            self._write_csv(cursor, rows, sys.stdout, FORMATS[self.mode][SEPARATOR])
 
-    @staticmethod
-    def _print_mode_line(cursor, rows):
-        column_names = [ cn[0] for cn in cursor.description ]
+    def _write_csv(self, cursor, rows, stream, separator, header=True):
+        """ Write header and rows as CSV to stream in EXPORT_BUFFER_SIZE chunks, returns the row count. """
+        import csv
+        count   = 0
+        buf     = cStringIO.StringIO()
+        writer  = csv.writer(buf, delimiter=separator, lineterminator='\n')
+        if header:
+            writer.writerow([ cn[0] for cn in cursor.description ])
+        rows    = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.fetch_size))
+            if not batch:
+                break
+            writer.writerows(batch)
+            count += len(batch)
+            if buf.tell() >= EXPORT_BUFFER_SIZE:
+                stream.write(buf.getvalue())
+                buf.seek(0)
+                buf.truncate()
+        stream.write(buf.getvalue())
+        stream.flush()
+        return count
+
+    def _print_mode_line(self, cursor, rows):
+        format_row = self._line_formatter([ cn[0] for cn in cursor.description ])
+        self._write_rows([], format_row, rows, [])
 
+    @staticmethod
+    def _line_formatter(column_names):
+        """ Function formatting a row as text (one line per column) of output-mode LINE. """
         width = []
         for cn in column_names:
             width.append( len(cn) )
         name_max = max(width)
 
-        for row in rows:
-            for column_name in column_names:
-                print "%s: %s" % (COLUMN_NAME_COLOR("{0!s:<{width}}".format(column_name, width=name_max + 1 )),
-                                 DATA_COLOR(row[column_name]),)
-            print
+        name_on, name_off = _color_codes(COLUMN_NAME_COLOR)
+        data_on, data_off = _color_codes(DATA_COLOR)
+        lines             = []
+        for idx, column_name in enumerate(column_names):
+            label = _to_text(column_name).ljust(name_max + 1).replace('{', '{{').replace('}', '}}')
+            lines.append(u'%s%s%s: %s{%d}%s' % (name_on, label, name_off, data_on, idx, data_off,))
+        record_format = (u'\n'.join(lines) + u'\n').format
+
+        def format_row(row):
+            return record_format(*map(_to_text, row))
+        return format_row
+
+    def _page(self, cursor, rows):
+        """ Show rows in the pager, formatted for mode TABLE or LINE. """
+        column_names = [ cn[0] for cn in cursor.description ]
+        if self.mode == LINE:
+            Pager(rows, [], self._line_formatter(column_names), []).run()
+        else:
+            rows   = iter(rows)
+            sample = list(itertools.islice(rows, FORMATS[TABLE].get(SAMPLE_ROWS, DEFAULT_SAMPLE_ROWS)))
+            header, format_row, footer = self._table_formatter(column_names, sample)
+            Pager(itertools.chain(sample, rows), header, format_row, footer).run()
+        print
 
 
     def _print_mode_table(self, cursor, rows):
-        header_finished = False
-        column_names    = [ cn[0] for cn in cursor.description ]
+        column_names = [ cn[0] for cn in cursor.description ]
+        rows         = iter(rows)
         #
-        # Calculate for every column the max length.
-        # Example:
-        # data:
-        #   [
-        #       { 'a': 12,  'b': 'something' },
-        #       { 'a': 120, 'b': 'more of something' },
-        #   ]
+        # Column widths are sized from the first SAMPLE_ROWS rows only.
+        # Everything after the sample is streamed with the same layout,
+        # longer cells are truncated with an OVERFLOW_MARK.
         #
-        # ---------------------------------------------------------------------
-        # column_lengths:
-        #   [
-        #       { 'a': 2, 'b': 9 },
-        #       { 'a': 3, 'b': 17 },
-        #   ]
-        column_lengths  = []
-        for row in rows:
-            line_data = {}
-            for cn in column_names:
-                line_data[cn] = len(str(row[cn]))
-            column_lengths.append(line_data)
-        # ---------------------------------------------------------------------
+        sample       = list(itertools.islice(rows, FORMATS[TABLE].get(SAMPLE_ROWS, DEFAULT_SAMPLE_ROWS)))
+        header, format_row, footer = self._table_formatter(column_names, sample)
+        self._write_rows(header, format_row, itertools.chain(sample, rows), footer)
 
-        #
-        # column_max:
-        #   { 'a': 3, 'b': 17 }
-        #
-        column_max = {}
-        for cn in column_names:
-            column_max[cn] = max( max( [col[cn] for col in column_lengths] ), len(cn))
-        # ---------------------------------------------------------------------
+    def _write_rows(self, header, format_row, rows, footer):
+        """ Write header, the formatted rows fetch_size at a time and footer to stdout. """
+        _write_lines(header)
+        rows = iter(rows)
+        while True:
+            batch = [ format_row(row) for row in itertools.islice(rows, self.fetch_size) ]
+            if not batch:
+                break
+            _write_lines(batch)
+        _write_lines(footer)
+        sys.stdout.flush()
+
+    def _table_formatter(self, column_names, sample):
+        """ Header lines, row formatting function and footer lines of output-mode TABLE.
 
-        # Cell formating:
-        #   { 'a': "{0!s:>{width}} |", 'b': "{0!s:<{width}} |" }
+        The layout of a row is compiled into one format string, the color
+        codes are part of it and aren't counted into the column widths.
+        """
+        widths, truncate = self._table_layout(column_names, sample)
+
+        # Cell alignment:
         # Numbers align right. Strings align left. All others are centered.
         #
-        cells = {}
-        for cn in column_names:
-            if type(rows[0][cn]) in (int, float,):
-                cells[cn] = "{0!s:>{width}}"
-            elif type(rows[0][cn]) in (str, unicode,):
-                cells[cn] = "{0!s:<{width}}"
+        aligns = []
+        for idx in range(len(column_names)):
+            value = next((row[idx] for row in sample if row[idx] is not None), None)
+            if type(value) in (int, long, float,):
+                aligns.append('>')
+            elif type(value) in (str, unicode,):
+                aligns.append('<')
             else:
-                cells[cn] = "{0!s:^{width}}"
-        # ---------------------------------------------------------------------
-        # refine layout.
-        #
-        width     = sum([size for size in column_max.values()]) + (2 * len(column_max)) + 1
-        # max_width = FORMATS[TABLE][TABLE_MAX_WIDTH]
-        # if width > max_width:
-        #     diff = width - max_width
-        #     width= max_width
-
-        # ---------------------------------------------------------------------
-        # print data.
-        #
+                aligns.append('^')
+
+        frame_on, frame_off = _color_codes(FRAME_COLOR)
+        separator           = u'%s|%s' % (frame_on, frame_off,)
+
+        def row_layout(color):
+            on, off = _color_codes(color)
+            cells   = [ u' %s{%d:%s%d}%s ' % (on, idx, align, width, off,)
+                        for idx, (align, width) in enumerate(zip(aligns, widths)) ]
+            return (separator + separator.join(cells) + separator).format
+
+        # Cells longer than their limit are cut and get the OVERFLOW_MARK.
+        limits     = [ width if truncate[idx] else sys.maxint for idx, width in enumerate(widths) ]
+        keep       = [ limit - len(OVERFLOW_MARK) for limit in limits ]
+        row_format = row_layout(DATA_COLOR)
+
+        def fit(texts):
+            return [ text if len(text) <= limit else text[:cut] + OVERFLOW_MARK
+                     for text, limit, cut in zip(texts, limits, keep) ]
+
+        def format_row(row):
+            return row_format(*fit(map(_to_text, row)))
+
+        width  = sum(widths) + (3 * len(widths)) + 1
+        rule   = u'%s%s%s' % (frame_on, '=' * width, frame_off,)
+        ground = u'%s+%s+%s' % (frame_on, '+'.join([ '-' * (width + 2) for width in widths ]), frame_off,)
+        header = [ rule, row_layout(COLUMN_NAME_COLOR)(*fit(map(_to_text, column_names))), ground, ]
+        return header, format_row, [ rule, ]
+
+    @staticmethod
+    def _table_layout(column_names, sample):
+        """ Column widths and truncate flags for output-mode TABLE.
+
+        The natural width of a column is its longest value within sample.
+        COLUMN_WIDTHS (by column index or name) bound every single column,
+        MAX_WIDTH bounds the whole table by shrinking the widest columns.
+        """
+        column_configs = FORMATS[TABLE].get(COLUMN_WIDTHS, None) or {}
+        truncate_line  = FORMATS[TABLE].get(TRUNCATE_LINE, True)
+        widths         = []
+        min_widths     = []
+        truncate       = []
+        for idx, cn in enumerate(column_names):
+            config = column_configs.get(str(idx), column_configs.get(idx, column_configs.get(cn, {})))
+            width  = max([len(cn)] + [ len(_to_text(row[idx])) for row in sample ])
+            width  = min(width, config.get(COLUMN_MAX_WIDTH, width))
+            width  = max(width, config.get(COLUMN_MIN_WIDTH, 0))
+            widths.append(width)
+            min_widths.append(max(config.get(COLUMN_MIN_WIDTH, 0), len(OVERFLOW_MARK) + 1))
+            truncate.append(config.get(TRUNCATE_LINE, truncate_line))
+
+        max_width = FORMATS[TABLE].get(MAX_WIDTH, -1)
+        if max_width is None:
+            max_width = terminal_width()
+        if max_width > 0:
+            excess = sum(widths) + (3 * len(widths)) + 1 - max_width
+            while excess > 0:
+                idx = max(range(len(widths)), key=lambda i: widths[i] - min_widths[i])
+                if widths[idx] <= min_widths[idx]:
+                    break
+                widths[idx] -= 1
+                excess      -= 1
+        return widths, truncate
+
+    @staticmethod
+    def _read_csv(stream, separator):
+        """ Column names and a row generator for a CSV file. """
+        import csv
+        reader = csv.reader(stream, delimiter=separator)
+        header = next(reader, None)
+        if header is None:
+            return [], iter(())
+        header = [ name.decode('utf-8').strip() for name in header ]
+
+        def rows():
+            for row in reader:
+                yield tuple([ value.decode('utf-8') if value != '' else None for value in row ])
+        return header, rows()
+
+    @staticmethod
+    def _read_jsonl(stream):
+        """ Column names (from the first LOAD_INFER_ROWS objects) and a row generator for a JSONL file. """
+        import json
+        lines   = ( line for line in stream if line.strip() )
+        # Only the sample keeps the key order, it defines the column order.
+        sample  = [ json.loads(line, object_pairs_hook=collections.OrderedDict)
+                    for line in itertools.islice(lines, LOAD_INFER_ROWS) ]
+        objects = itertools.imap(json.loads, lines)
+        header  = []
+        for obj in sample:
+            for key in obj:
+                if key not in header:
+                    header.append(key)
+
+        def rows():
+            for obj in itertools.chain(sample, objects):
+                row = []
+                for key in header:
+                    value = obj.get(key)
+                    if isinstance(value, (dict, list,)):
+                        value = json.dumps(value)
+                    row.append(value)
+                yield tuple(row)
+        return header, rows()
+
+    def _load_rows(self, table_name, column_names, rows, batch_size):
+        """ Insert rows into table_name in transactions of batch_size rows. """
+        connection = self.connection
+        cur        = connection.cursor()
+        rows       = iter(rows)
+        sample     = list(itertools.islice(rows, LOAD_INFER_ROWS))
+        rows       = itertools.chain(sample, rows)
+        table      = _quote_identifier(table_name)
+
+        # Commit whatever is pending, the load handles its own transactions.
+        connection.commit()
+        isolation_level            = connection.isolation_level
+        connection.isolation_level = None
+        synchronous                = cur.execute('PRAGMA synchronous').fetchone()[0]
+        journal_mode               = cur.execute('PRAGMA journal_mode').fetchone()[0]
+        indexes                    = []
+        count                      = 0
+        started                    = time.time()
+        try:
+            cur.execute('PRAGMA synchronous=OFF')
+            cur.execute('PRAGMA journal_mode=MEMORY')
+
+            existing = [ info[1] for info in cur.execute('PRAGMA table_info(%s)' % (table,)) ]
+            if not existing:
+                columns = [ '%s %s' % (_quote_identifier(name),
+                                       _infer_column_type([ row[idx] for row in sample if idx < len(row) ]),)
+                            for idx, name in enumerate(column_names) ]
+                cur.execute('CREATE TABLE %s (%s)' % (table, ', '.join(columns),))
+                log.info('Created table %s (%s).', table_name, ', '.join(columns))
+            else:
+                # Plain indexes are rebuilt once at the end instead of on every
+                # insert. UNIQUE and constraint indexes stay, they reject rows.
+                plain   = [ info[1] for info in cur.execute('PRAGMA index_list(%s)' % (table,)).fetchall()
+                            if not info[2] and info[3] == 'c' ]
+                indexes = [ row for row in cur.execute("SELECT name, sql FROM sqlite_master"
+                                                       " WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                                                       (table_name,)).fetchall() if row[0] in plain ]
+                for index in indexes:
+                    cur.execute('DROP INDEX %s' % (_quote_identifier(index[0]),))
+
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join([ _quote_identifier(name) for name in column_names ]),
+                ', '.join([ '?' ] * len(column_names)),)
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                cur.execute('BEGIN')
+                cur.executemany(sql, batch)
+                cur.execute('COMMIT')
+                count += len(batch)
+                log.debug('%s rows loaded.', count)
+        except KeyboardInterrupt:
+            print
+            log.info('Load interrupted.')
+        except (DB.Error, ValueError), e:
+            log.error('Load failed after %s rows! %s', count, e)
+        finally:
+            try:
+                try:
+                    # Only an aborted batch leaves a transaction behind.
+                    cur.execute('ROLLBACK')
+                except DB.Error:
+                    pass
+                for index in indexes:
+                    self._recreate_index(cur, table, index[0], index[1])
+            finally:
+                cur.execute('PRAGMA journal_mode=%s' % (journal_mode,))
+                cur.execute('PRAGMA synchronous=%s' % (synchronous,))
+                connection.isolation_level = isolation_level
+                cur.close()
+
+        elapsed = time.time() - started
+        log.info('%s rows loaded into %s in %.2fs (%d rows/s).',
+                 count, table_name, elapsed, count / max(elapsed, 1e-6))
+
+    @staticmethod
+    def _recreate_index(cur, table, name, sql):
+        """ Create index name again after a load, errors are reported with the conflicting rows. """
+        log.debug('Recreating index %s.', name)
+        try:
+            cur.execute(sql)
+            return
+        except DB.Error, e:
+            log.error('Index %s could not be recreated! %s', name, e)
+            log.error('Recreate it with: %s;', sql)
+        if not re.match(r'\s*CREATE\s+UNIQUE\s', sql, re.IGNORECASE):
+            return
+        # Can't be read from PRAGMA index_info, the index is gone.
+        match = re.search(r'\((.*)\)', sql, re.DOTALL)
+        if match is None:
+            return
+        columns = match.group(1)
+        try:
+            for row in cur.execute('SELECT %s, count(*) FROM %s GROUP BY %s HAVING count(*) > 1 LIMIT %d'
+                                   % (columns, table, columns, DIFF_SHOWN_ROWS,)):
+                log.error('  %s: %s rows', ', '.join([ _to_text(value) for value in row[:-1] ]), row[-1])
+        except DB.Error:
+            pass
+
+    def _open_connection(self, db_name, check_same_thread=True):
+        """ Connection to db_name set up like every connection of the shell. """
+        connection             = DB.connect(db_name, isolation_level=self.isolation_level,
+                                            check_same_thread=check_same_thread,
+                                            cached_statements=self.cached_statements, factory=Connection)
+        #connection            = DB.connect(db_name, detect_types=DB.PARSE_DECLTYPES|DB.PARSE_COLNAMES)
+        connection.row_factory = DB.Row
+        self._apply_pragmas(connection, CONNECTION_PROFILES.get(self.pragma_profile, {}))
+        self.functions.register(connection)
+        # A no-op progress handler lets Ctrl-C abort a statement inside sqlite.
+        connection.set_progress_handler(self._progress_tick, PROGRESS_HANDLER_OPCODES)
+        return connection
+
+    @staticmethod
+    def _apply_pragmas(connection, pragmas, skip=()):
+        for name, value in pragmas.items():
+            if name in skip:
+                continue
+            try:
+                connection.execute(_pragma_statement(name, value)).fetchall()
+            except (ValueError, DB.Error), e:
+                log.warning('PRAGMA %s = %s failed! %s', name, value, e)
+
+    def _close_shards(self):
+        for filename, connection in self.shards:
+            connection.close()
+        if self.shards:
+            self.connection = None
+        self.shards = []
+
+    def _execute_sharded(self, sql, params=()):
+        """ Run sql on all shards in parallel and print the merged result. """
+        import threading
+        import Queue
+        if self._shard_slots is None:
+            import multiprocessing
+            self._shard_slots = threading.BoundedSemaphore(SHARD_WORKERS or multiprocessing.cpu_count())
+        slots        = self._shard_slots
+        fetch_size   = self.fetch_size
+        text_factory = str if self.mode in (CSV, TSV,) else unicode
+        # In autocommit mode changes are kept in a savepoint until all shards ran them.
+        savepoint    = self.isolation_level is None and bool(SQL_SHARD_CHANGE.match(SQL_COMMENT.sub(' ', sql)))
+        stop         = threading.Event()
+
+        def put(queue, item):
+            # Waits while the merge is behind, gives up once it stopped reading.
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def feed(connection, queue):
+            # Feeds (description, changes), then row batches up to an empty
+            # one, or an error into queue. The slots limit the shards stepping
+            # at the same time, not the ones waiting for the merge.
+            connection.text_factory = text_factory
+            changes                 = connection.total_changes
+            cur                     = connection.cursor()
+            cur.row_factory         = None
+            try:
+                with slots:
+                    if savepoint:
+                        cur.execute('SAVEPOINT use_many')
+                    cur.execute(sql, params)
+                if not put(queue, (cur.description, connection.total_changes - changes,)) or cur.description is None:
+                    return
+                while True:
+                    with slots:
+                        batch = cur.fetchmany(fetch_size)
+                    if not put(queue, batch) or not batch:
+                        return
+            except DB.Error, e:
+                put(queue, e)
+            finally:
+                cur.close()
+
+        def get(queue):
+            while True:
+                try:
+                    item = queue.get(timeout=0.1)   # a timeout keeps Ctrl-C working
+                except Queue.Empty:
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                return item
+
+        def rows(queue):
+            while True:
+                batch = get(queue)
+                if not batch:
+                    return
+                for row in batch:
+                    yield row
+
+        started = time.time()
+        queues  = [ Queue.Queue(SHARD_QUEUE_BATCHES) for _ in self.shards ]
+        threads = [ threading.Thread(target=feed, args=(connection, queue,))
+                    for (filename, connection), queue in zip(self.shards, queues) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        ok      = False
+        printed = False
+        try:
+            heads, errors = [], []
+            for queue in queues:
+                try:
+                    heads.append(get(queue))
+                except DB.Error, e:
+                    errors.append(e)
+            if errors:
+                log.error("(sharded) Command failed! %s", errors[0])
+                self.last_error = errors[0]
+                return
+            log.debug('%s shards executed in %.2fs.', len(heads), time.time() - started)
+
+            description = heads[0][0]
+            if description is None:
+                ok = True
+                log.info('%s rows changed.', sum([ head[1] for head in heads ]))
+                return
+            merged  = merge_shard_results(sql, description, [ rows(queue) for queue in queues ])
+            printed = True
+            if self.mode == COLUMNAR:
+                self._set_df(self._collect_columnar([ cn[0] for cn in description ], merged))
+                self._show_columnar(self.df)
+            else:
+                first = next(merged, None)
+                if first is None:
+                    log.info('0 rows returned.')
+                else:
+                    self._print_data(ResultInfo(description), itertools.chain((first,), merged))
+            ok = True
+        except KeyboardInterrupt:
+            print
+            log.info('Output interrupted.' if printed else 'Query interrupted.')
+        except DB.Error, e:
+            log.error("(sharded) Command failed! %s", e)
+            self.last_error = e
+        finally:
+            # Feeders still running (interrupted, LIMIT reached) stop at their next batch.
+            stop.set()
+            for thread, (filename, connection) in zip(threads, self.shards):
+                if thread.is_alive():
+                    connection.interrupt()
+            for thread in threads:
+                thread.join()
+            self._finish_shards(ok, savepoint)
+
+    def _finish_shards(self, commit, savepoint=False):
+        """ Commit or roll back all shards (and their savepoint), one after the other. """
+        committed = []
+        for filename, connection in self.shards:
+            try:
+                if savepoint and not commit:
+                    try:
+                        connection.execute('ROLLBACK TO use_many')
+                    except DB.OperationalError:
+                        continue   # the savepoint is gone with the failed statement
+                if savepoint:
+                    connection.execute('RELEASE use_many')
+                if commit:
+                    connection.commit()
+                    committed.append(filename)
+                else:
+                    connection.rollback()
+            except DB.Error, e:
+                log.error('%s failed on %s! %s', 'COMMIT' if commit else 'ROLLBACK', filename, e)
+                if committed:
+                    log.error('Already committed: %s', ', '.join(committed))
+                self.last_error = e
+                commit = False
+
+    def _submit_job(self, title, runner):
+        """ Queue runner(job) on the background worker pool. """
+        if self._job_pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._job_pool = ThreadPool(BG_WORKERS)
+        self._job_counter += 1
+        job = Job(self._job_counter, title, runner)
+        self.jobs[job.id] = job
+        self._job_pool.apply_async(job.run)
+        log.info('[%s] %s', job.id, title)
+        return job
+
+    def _query_job_runner(self, sql):
+        """ Job runner executing sql on an own connection to the actual database. """
+        db_name    = self.name
+        fetch_size = self.fetch_size
+
+        def runner(job):
+            job.connection = self._open_connection(db_name)
+            try:
+                cur             = job.connection.cursor()
+                cur.row_factory = None
+                cur.execute(sql)
+                job.description = cur.description
+                job.result      = SpillBuffer()
+                while True:
+                    if job.cancelled:
+                        job.connection.rollback()
+                        raise JobCancelled('cancelled after %s rows' % (job.result.count,))
+                    batch = cur.fetchmany(fetch_size)
+                    if not batch:
+                        break
+                    job.result.extend(batch)
+                job.changes = job.connection.total_changes
+                job.connection.commit()
+            finally:
+                job.connection.close()
+        return runner
+
+    def _get_job(self, job_id):
+        if len(job_id) == 0 and len(self.jobs) > 0:
+            return self.jobs.values()[-1]
+        if job_id.isdigit() and int(job_id) in self.jobs:
+            return self.jobs[int(job_id)]
+        log.error('Unknown job "%s"! Use "jobs" to list all jobs.', job_id)
+        return None
+
+    @staticmethod
+    def _encode_rows(rows):
+        """ Rows with unicode values encoded as utf-8 for the csv module. """
         for row in rows:
-            # header
-            if not header_finished:
-                print FRAME_COLOR("=") * width
-                print FRAME_COLOR("|"),
-                header_groundline = "+"
-                for cn in column_names:
-                    print "%s%s" % (COLUMN_NAME_COLOR(cells[cn].format(cn, width=column_max[cn])), FRAME_COLOR("|"),),
-                    header_groundline += "%s%s" % ("-" * (column_max[cn] + 1) , "+",)
-                print
-                print FRAME_COLOR(header_groundline)
-                header_finished = True
-            # body
-            print FRAME_COLOR("|"),
-            for cn in column_names:
-                print "%s%s" % (DATA_COLOR(cells[cn].format(row[cn], width=column_max[cn])), FRAME_COLOR("|"),),
+            yield tuple([ value.encode('utf-8') if isinstance(value, unicode) else value for value in row ])
+
+    def _run_batch(self, query, param_rows):
+        """ Run query once per parameter set of param_rows. """
+        cur     = self.connection.cursor()
+        started = time.time()
+        count   = 0
+        try:
+            if not re.match(r'\s*(SELECT|WITH)\b', SQL_COMMENT.sub(' ', query.sql), re.IGNORECASE):
+                # executemany() is only allowed for changing statements.
+                cur.executemany(query.sql, param_rows)
+                count = cur.rowcount
+                self.connection.commit()
+                log.info('%s rows changed in %.2fs.', count, time.time() - started)
+                return
+
+            param_rows  = iter(param_rows)
+            description = []
+
+            def rows():
+                # The statement text never changes, so sqlite3 reuses the prepared statement.
+                for params in param_rows:
+                    cur.execute(query.sql, params)
+                    description[:] = [cur.description]
+                    for row in self._iter_rows(cur):
+                        yield row
+
+            results = rows()
+            first   = next(results, None)
+            if first is None:
+                log.info('0 rows returned.')
+                return
+            if self.mode in (CSV, TSV,):
+                results = self._encode_rows(results)
+                first   = next(self._encode_rows([first]))
+            self._print_data(ResultInfo(description[0]), itertools.chain((first,), results))
+        except KeyboardInterrupt:
+            print
+            log.info('Query interrupted.')
+        except DB.Error, e:
+            self.connection.rollback()
+            log.error('Batch run of "%s" failed! %s', query.name, e)
+        finally:
+            cur.close()
+
+    def run_script(self, text, stop_on_error=True, transaction=False):
+        """ Run a script of SQL statements and shell commands. Returns False on errors.
+
+        A shell command (like "use FILE" or ".mode csv") starts where a
+        statement may start and ends at the end of the line or at ;.
+        Queries are printed in the actual mode, runs of other statements
+        are executed with one executescript (in one transaction if
+        transaction is set). With stop_on_error unset every statement
+        of a failed run is tried on its own and the script goes on.
+        """
+        commands = set([ name[3:].lower() for name in self.get_names() if name.startswith('do_') ])
+        group    = []
+        ok       = True
+        pos      = 0
+        while pos < len(text):
+            match = re.compile(r'(?:\s+|--[^\n]*)*').match(text, pos)
+            pos   = match.end()
+            if pos >= len(text):
+                break
+            word = re.match(r'\.?(\w*)', text[pos:pos + 64]).group(1).lower()
+            if text[pos] == '.' or (word in commands and not SQL_QUERY.match(word) and word not in ('commit', 'rollback',)):
+                end = min([ idx for idx in (text.find('\n', pos), text.find(';', pos), len(text),) if idx >= 0 ])
+                ok  = self._run_script_group(group, stop_on_error, transaction) and ok
+                group = []
+                if not ok and stop_on_error:
+                    return False
+                command = text[pos:end].strip().lstrip('.')
+                log.debug('script command: %s', command)
+                self.onecmd(command)
+                pos = end + 1
+                continue
+
+            end = statement_end(text, pos)
+            if end < 0:
+                end = len(text)
+            statement = text[pos:end]
+            pos       = end
+            if SQL_QUERY.match(statement):
+                ok    = self._run_script_group(group, stop_on_error, transaction) and ok
+                group = []
+                if self.remote is None and not self._connected():
+                    return False
+                if ok or not stop_on_error:
+                    self._execute(statement)
+                    ok = ok and self.last_error is None
+            else:
+                group.append(statement)
+            if not ok and stop_on_error:
+                return False
+        return self._run_script_group(group, stop_on_error, transaction) and ok
+
+    def _run_script_group(self, statements, stop_on_error, transaction):
+        """ Run statements of a script which have no result. Returns False on errors. """
+        if not statements:
+            return True
+        if self.remote is not None:
+            return self._run_remote_group(statements, stop_on_error, transaction)
+        if not self._connected():
+            return False
+        if stop_on_error:
+            script = '\n'.join(statements)
+            if transaction:
+                script = 'BEGIN;\n%s\nCOMMIT;' % (script,)
+            try:
+                self.connection.executescript(script)
+                return True
+            except DB.Error, e:
+                log.error('Script failed! %s', e)
+                self._rollback_quietly()
+                return False
+
+        ok  = True
+        cur = self.connection.cursor()
+        try:
+            if transaction:
+                self.connection.commit()
+                cur.execute('BEGIN')
+            for statement in statements:
+                try:
+                    cur.execute(statement)
+                except DB.Error, e:
+                    log.error('Statement failed! %s: %s', e, statement.strip())
+                    ok = False
+            if transaction:
+                cur.execute('COMMIT')
+            else:
+                self.connection.commit()
+        finally:
+            cur.close()
+        return ok
+
+    def _run_remote_group(self, statements, stop_on_error, transaction):
+        """ _run_script_group on the query server. """
+        if stop_on_error:
+            scripts = [ '\n'.join(statements) ]
+        else:
+            scripts = statements
+        if transaction:
+            scripts = [ 'BEGIN;\n%s\nCOMMIT;' % ('\n'.join(statements),) ]
+        ok = True
+        for script in scripts:
+            try:
+                for frame in self.remote.request({ 'script': script }):
+                    if 'error' in frame:
+                        log.error('Script failed! %s', frame['error'])
+                        ok = False
+            except IOError, e:
+                log.error('%s', e)
+                self._disconnect()
+                return False
+            if not ok and stop_on_error:
+                break
+        return ok
+
+    def _execute_remote(self, sql, params=()):
+        """ Run sql on the query server and print the streamed result. """
+        if not isinstance(params, dict):
+            params = list(params)
+        frames = self.remote.request({ 'sql': sql, 'params': params })
+        errors = []
+
+        def rows():
+            for frame in frames:
+                if 'error' in frame:
+                    errors.append(frame['error'])
+                    return
+                for row in frame.get('rows', ()):
+                    yield tuple(row)
+
+        try:
+            first = next(frames)
+            if 'error' in first:
+                errors.append(first['error'])
+            elif 'description' not in first:
+                log.info('%s rows changed.', first.get('changes', 0))
+            elif self.mode == COLUMNAR:
+                result = self._collect_columnar(first['description'], rows())
+                if not errors:
+                    self._set_df(result)
+                    self._show_columnar(result)
+            else:
+                result = rows()
+                if self.mode in (CSV, TSV,):
+                    # The exporter takes plain tuples of utf-8 byte strings.
+                    result = self._encode_rows(result)
+                head   = next(result, None)
+                if head is None and not errors:
+                    log.info('0 rows returned.')
+                elif head is not None:
+                    self._print_data(ResultInfo(_description(first['description'])),
+                                     itertools.chain((head,), result))
+        except KeyboardInterrupt:
             print
-        print FRAME_COLOR("=") * width
+            log.info('Query interrupted.')
+            # The rest of the answer is still on its way, start over.
+            self._reconnect()
+        except IOError, e:
+            log.error('%s', e)
+            self._disconnect()
+            self.last_error = e
+        if errors:
+            log.error("(remote) Command failed! %s", errors[0])
+            self.last_error = errors[0]
+
+    def _rollback_quietly(self):
+        try:
+            self.connection.execute('ROLLBACK')
+        except DB.Error:
+            pass
+
+    def _fetch_columnar(self, cursor, stats=None):
+        """ Fetch the result of cursor (row_factory None) into self.df. """
+        result = ColumnarResult([ cn[0] for cn in cursor.description ])
+        while True:
+            started = time.time()
+            batch   = cursor.fetchmany(self.fetch_size)
+            result.extend(batch)
+            if stats is not None:
+                stats.fetch += time.time() - started
+                stats.rows  += len(batch)
+            if not batch:
+                break
+        self._set_df(result)
+
+    def _collect_columnar(self, column_names, rows):
+        """ ColumnarResult of rows (plain tuples of a sharded or remote query). """
+        result = ColumnarResult(column_names)
+        while True:
+            batch = list(itertools.islice(rows, self.fetch_size))
+            if not batch:
+                break
+            result.extend(batch)
+        return result
+
+    def _set_df(self, result):
+        self.df = result
+        pystate = getattr(self, 'pystate', None) # py shell of cmd2
+        if pystate is not None:
+            pystate['df'] = result
+            if _import_optional('pandas') is not None:
+                pystate['df'] = result.to_dataframe()
+
+    def _show_columnar(self, result):
+        log.info('%s rows x %s columns: %s', result.rows, len(result.column_names),
+                 ', '.join([ '%s %s' % (name, result.type_name(idx),) for idx, name in enumerate(result.column_names) ]))
+        if result.rows:
+            self._print_mode_table(ResultInfo(_description(result.column_names)), result.head())
+
+    def _iter_rows(self, cursor, stats=None):
+        """ Yield the rows of cursor, fetched in batches of fetch_size. """
+        while True:
+            started = time.time()
+            batch   = cursor.fetchmany(self.fetch_size)
+            if stats is not None:
+                stats.fetch += time.time() - started
+                stats.rows  += len(batch)
+            if not batch:
+                return
+            for row in batch:
+                yield row
+
+    def _result_cache_key(self, sql, params=()):
+        """ Result cache key of sql, None if the cache is off or sql isn't a cacheable read. """
+        if self.result_cache is None:
+            return None
+        stripped = SQL_COMMENT.sub(' ', sql)
+        if not re.match(r'\s*(SELECT|WITH)\b', stripped, re.IGNORECASE) or SQL_VOLATILE.search(stripped):
+            return None
+        # CSV/TSV rows hold utf-8 byte strings, the other modes unicode.
+        if isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        return (normalize_sql(sql), tuple(SQL_LITERAL.findall(stripped)), tuple(params), self.mode in (CSV, TSV,),)
+
+    def _result_cache_validity(self):
+        """ Token that changes whenever cached results may be stale.
+
+        total_changes and schema_version catch writes of this connection,
+        data_version commits of other connections and processes. The
+        file stats are a second line of defense for other processes.
+        """
+        cur   = self.connection.cursor()
+        token = [ self.connection.total_changes,
+                  cur.execute('PRAGMA data_version').fetchone()[0],
+                  cur.execute('PRAGMA schema_version').fetchone()[0], ]
+        cur.close()
+        for filename in (self.name, self.name + '-wal',):
+            try:
+                stat   = os.stat(filename)
+                token += [ stat.st_mtime, stat.st_size, ]
+            except OSError:
+                token += [ None, None, ]
+        return tuple(token)
+
+    def _explain_query_plan(self, stats, params=()):
+        """ Store the query plan of stats.sql and warn about full table scans. """
+        if not re.match(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b', stats.sql, re.IGNORECASE):
+            return
+        try:
+            stats.plan = [ row[3] for row in self.connection.execute('EXPLAIN QUERY PLAN %s' % (stats.sql,), params) ]
+        except DB.Error, e:
+            log.debug("Can't explain statement: %s", e)
+            return
+        for detail in stats.plan:
+            log.info('Plan: %s', detail)
+            match = SQL_FULL_SCAN.match(detail)
+            if match is not None:
+                stats.full_scans.append(match.group(1))
+                log.warning('Full table scan of %s!', match.group(1))
+
+    def _record_stats(self, stats, started):
+        stats.total = time.time() - started
+        self.profile_log.append(stats)
+        self._command_stats = stats
+        if self.timer or self.profile:
+            log.info('Time: execute %.4fs, first row %.4fs, fetch %.4fs, render %.4fs, total %.4fs, '
+                     '%s rows (%d rows/s).', stats.execute, stats.first_row, stats.fetch, stats.render,
+                     stats.total, stats.rows, stats.rows_per_second())
+
+    @staticmethod
+    def _switch(name, state, actual):
+        """ New value of an on/off setting, actual is kept on errors. """
+        state = state.strip().lower()
+        if len(state) == 0:
+            log.info('%s is %s.', name, 'on' if actual else 'off')
+            return actual
+        if state in ('on', 'true', 'yes', '1',):
+            return True
+        if state in ('off', 'false', 'no', '0',):
+            return False
+        log.error('Unknown value "%s" for %s! Use on or off.', state, name)
+        return actual
+
+    def _paging(self):
+        """ True if results are shown in the pager. """
+        return self.pager and self.mode in (TABLE, LINE,) and sys.stdout.isatty() and sys.stdin.isatty()
+
+    @staticmethod
+    def _progress_tick():
+        return 0
 
     @staticmethod
     def _complete(text, word_list):
@@ -607,42 +5123,136 @@ class SQLiteCli(Cmd):
             return False
         return True
 
-    def _update_cache_table_names(self):
-        if self.connection is None:
-            return
-        cursor = self.connection.cursor()
-        cursor.execute(SQL_GET_TABLE_NAMES)
-        for name in cursor:
-            self.cache_table_names.append( name['name'] )
-            self._update_cache_column_names(name['name'])
+    def _get_completion_index(self):
+        """ PrefixIndex of tables, SQL keywords and functions, rebuilt if the schema changed. """
+        self.schema.validate()
+        if self._completion_index is None or self._indexed_version != (self.schema.db_name, self.schema.version):
+            words  = list(self.schema.tables)
+            words += SQL_KEYWORDS
+            words += [ keyword.lower() for keyword in SQL_KEYWORDS ]
+            words += SQL_FUNCTIONS
+            words += [ entry.name for entry in self.functions.functions.values() ]
+            self._completion_index = PrefixIndex(words)
+            self._indexed_version  = (self.schema.db_name, self.schema.version)
+            self._indexed_tables   = set()
+        return self._completion_index
 
-    def _update_cache_column_names(self, table_name):
+    def _update_cache_table_names(self):
         if self.connection is None:
             return
-        cursor = self.connection.cursor()
-        cursor.execute('PRAGMA table_info(%s)' % (table_name,))
-        if table_name not in self.cache_column_names:
-            self.cache_column_names[table_name] = []
-        for table_info_row in cursor:
-            self.cache_column_names[table_name].append( table_info_row['name'] )
+        self.schema.load(self.connection, self.name)
 
     def _set_loglevel(self):
         log.setLevel(LOG_LEVELS[self.loglevel])
 
+    def preloop(self):
+        self.cmd_base.preloop(self)
+        # Only the recent entries, the start doesn't slow down with the history.
+        try:
+            import readline
+            for statement in self.query_history.recent(HISTORY_READLINE_ENTRIES):
+                readline.add_history(statement.encode('utf-8'))
+        except (ImportError, DB.Error, OSError), e:
+            log.debug('History not loaded: %s', e)
+
+    def precmd(self, line):
+        self._command_started = time.time()
+        self._command_stats   = None
+        self.last_error       = None
+        return line
+
+    def postcmd(self, stop, line):
+        """ Record the command in the history. """
+        # cmd2 passes a parsed statement, keep the line as it was typed.
+        statement = line.parsed.raw if hasattr(line, 'parsed') else line
+        statement = statement.strip()
+        if statement and statement != 'EOF' and self._command_started is not None:
+            if isinstance(statement, str):
+                statement = statement.decode('utf-8', 'replace')
+            stats = self._command_stats
+            try:
+                self.query_history.record(statement, self._history_db(), self._command_started,
+                                          time.time() - self._command_started,
+                                          stats.rows if stats is not None else None,
+                                          str(self.last_error) if self.last_error is not None else None)
+            except (DB.Error, OSError), e:
+                log.debug('History not recorded: %s', e)
+        self._command_started = None
+        return stop
+
+    def _history_db(self):
+        return os.path.abspath(self.name) if self.name and self.name != ':memory:' else self.name
+
     def postloop(self):
         print
         log.info("== exit sqlite_cli ==")
 
+def interactive_shell_class():
+    """ SQLiteCli on top of cmd2 (python shell, output redirection, ...). """
+    from cmd2 import Cmd as Cmd2
+
+    class InteractiveSQLiteCli(SQLiteCli, Cmd2):
+        cmd_base       = Cmd2
+        # The command line is handled by main, not by cmd2.
+        allow_cli_args = False
+    return InteractiveSQLiteCli
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='A sqlite shell with heavy use of auto completion.')
+    parser.add_argument('commands', nargs='*', metavar='COMMAND',
+                        help='statements and shell commands separated by ;, run instead of the shell')
+    parser.add_argument('-d', '--db', help='database file to use')
+    parser.add_argument('-f', '--file', help='script file to run instead of the shell, - for stdin')
+    parser.add_argument('-c', '--continue-on-error', action='store_true',
+                        help='go on with the next statement if one fails')
+    parser.add_argument('-t', '--transaction', action='store_true',
+                        help='run the statements between queries and commands in one transaction')
+    parser.add_argument('-l', '--loglevel', choices=LOG_LEVELS.keys(), help='loglevel of the shell')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='answer queries on the unix socket SOCKET with the database of --db')
+    parser.add_argument('--connect', metavar='SOCKET',
+                        help='run the statements on the query server listening on SOCKET')
+    args = parser.parse_args(argv)
+    if args.serve and not args.db:
+        parser.error('--serve needs a database (--db)')
+
+    script = None
+    if args.serve:
+        pass
+    elif args.file == '-':
+        script = sys.stdin.read()
+    elif args.file:
+        with open(args.file, 'rb') as stream:
+            script = stream.read()
+    elif args.commands:
+        script = ' '.join(args.commands)
+    elif not sys.stdin.isatty():
+        script = sys.stdin.read()
+
+    cli = SQLiteCli() if script is not None or args.serve else interactive_shell_class()()
+    if args.loglevel:
+        cli.do_loglevel(args.loglevel)
+    cli.do_load_config('')
+    if args.db:
+        cli.do_use(args.db)
+    if args.serve:
+        cli.do_serve(args.serve)
+        return 0 if cli.last_error is None else 1
+    if args.connect:
+        cli.do_connect(args.connect)
+        if cli.remote is None:
+            return 1
+
+    if script is not None:
+        ok = cli.run_script(script, stop_on_error=not args.continue_on_error, transaction=args.transaction)
+        return 0 if ok else 1
+
+    setup_readline()
+    cli.intro = INTRO_TEXT
+    cli.cmdloop()
+    return 0
+
 if __name__ == '__main__':
-    cli = SQLiteCli()
-    if len(sys.argv) > 1:
-        cmd_string = ' '.join(sys.argv[1:])
-        cmd_queue  = cmd_string.split(';')
-        for cmd in cmd_queue:
-            if len(cmd) == 0:
-                continue
-            cli.onecmd(cmd)
-    else:
-        cli.intro = INTRO_TEXT
-        cli.cmdloop()
+    sys.exit(main())
 
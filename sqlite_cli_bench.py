@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# Description:
+#   Benchmarks for sqlite_cli.
+#   Results are printed as JSON, so runs of different versions can be diffed.
+#
+#   sqlite_cli_bench.py startup [-n RUNS]
+#   sqlite_cli_bench.py suite [-r ROWS] [-c COLUMNS] [-t TABLES] [-n REPEAT] [BENCHMARK ...]
+#
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import random
+import subprocess
+import sqlite3 as DB
+
+HERE                = os.path.dirname(os.path.abspath(__file__))
+# Time from process start to the first executed query we want to stay below.
+STARTUP_TARGET_MS   = 50
+# Python 2 compiles the __main__ module (python sqlite_cli.py and python -m
+# sqlite_cli) from source on every start, the sqlite-cli launcher imports
+# it and so uses sqlite_cli.pyc.
+LAUNCHER            = os.path.join(HERE, 'sqlite-cli')
+
+# Child process reporting the cumulative import time per module (like
+# python -X importtime, which python 2 doesn't have).
+IMPORT_TIMER        = r"""
+import sys, time, json, __builtin__
+_import = __builtin__.__import__
+times   = {}
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return _import(name, *args, **kwargs)
+    started = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        times[name] = times.get(name, 0.0) + time.time() - started
+__builtin__.__import__ = timed_import
+sys.path.insert(0, %r)
+started = time.time()
+import sqlite_cli
+total   = time.time() - started
+print json.dumps({ 'total_ms': total * 1000,
+                   'modules' : dict([ (name, value * 1000,) for name, value in times.items() ]), })
+"""
+
+# Defaults of the synthetic database used by the suite.
+SUITE_ROWS          = 20000
+SUITE_COLUMNS       = 8
+SUITE_TABLES        = 2000
+SUITE_REPEAT        = 5
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _timed_runs(command, runs, cwd):
+    """ Wall time in ms of runs executions of command. """
+    timings = []
+    with open(os.devnull, 'wb') as devnull:
+        for _ in range(runs):
+            started = time.time()
+            subprocess.check_call(command, cwd=cwd, stdout=devnull, stderr=devnull)
+            timings.append((time.time() - started) * 1000)
+    return { 'min_ms': min(timings), 'median_ms': _median(timings), 'runs': runs, }
+
+
+def bench_startup(runs):
+    """ Cold start to first query, as script, as module and with the launcher (byte code). """
+    workdir = tempfile.mkdtemp(prefix='sqlite_cli_bench')
+    try:
+        db_name = os.path.join(workdir, 'startup.db')
+        DB.connect(db_name).execute('CREATE TABLE t (x)')
+        query   = ['-l', 'WARNING', '-d', db_name, 'SELECT 1']
+        # Byte compile sqlite_cli (even with PYTHONDONTWRITEBYTECODE set)
+        # before timing the launcher.
+        subprocess.check_call([sys.executable, '-m', 'py_compile', 'sqlite_cli.py'], cwd=HERE)
+
+        results = {
+            'python'  : sys.version.split()[0],
+            'target_ms': STARTUP_TARGET_MS,
+            'baseline': _timed_runs([sys.executable, '-c', 'pass'], runs, HERE),
+            'launcher': _timed_runs([sys.executable, LAUNCHER] + query, runs, HERE),
+            'module'  : _timed_runs([sys.executable, '-m', 'sqlite_cli'] + query, runs, HERE),
+            'script'  : _timed_runs([sys.executable, os.path.join(HERE, 'sqlite_cli.py')] + query, runs, HERE),
+        }
+        results['launcher']['ok'] = results['launcher']['median_ms'] <= STARTUP_TARGET_MS
+
+        if sys.version_info >= (3, 7):
+            output  = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import sqlite_cli'],
+                                              cwd=HERE, stderr=subprocess.STDOUT)
+            results['importtime'] = output.decode('utf-8').splitlines()
+        else:
+            output  = subprocess.check_output([sys.executable, '-c', IMPORT_TIMER % (HERE,)], cwd=HERE)
+            imports = json.loads(output)
+            slowest = sorted(imports['modules'].items(), key=lambda item: item[1], reverse=True)[:15]
+            results['importtime'] = { 'total_ms': imports['total_ms'], 'slowest': slowest, }
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+def make_database(filename, rows, columns, tables):
+    """ Synthetic database: table data with rows x columns (integer, real,
+    text cycling) and tables empty tables t_N with columns columns each. """
+    generator   = random.Random(42)
+    types       = ('INTEGER', 'REAL', 'TEXT',)
+    connection  = DB.connect(filename)
+    definitions = ', '.join([ 'c%d %s' % (idx, types[idx % 3],) for idx in range(columns) ])
+    connection.execute('CREATE TABLE data (%s)' % (definitions,))
+
+    def cell(idx):
+        if idx % 3 == 0:
+            return generator.randint(0, 1000000)
+        if idx % 3 == 1:
+            return generator.random() * 1000
+        return u'text %d ' % (generator.randint(0, 1000),) * generator.randint(1, 4)
+
+    connection.executemany('INSERT INTO data VALUES (%s)' % (', '.join(['?'] * columns),),
+                           ( [ cell(idx) for idx in range(columns) ] for _ in xrange(rows) ))
+    for table in range(tables):
+        connection.execute('CREATE TABLE t_%d (%s)' % (table, definitions,))
+    connection.commit()
+    connection.close()
+
+
+def _timed_calls(function, repeat, rows=None):
+    """ Wall time in ms of repeat calls of function (and rows/s if rows is given). """
+    timings = []
+    for _ in range(repeat):
+        started = time.time()
+        function()
+        timings.append((time.time() - started) * 1000)
+    result = { 'min_ms': min(timings), 'median_ms': _median(timings), 'runs': repeat, }
+    if rows:
+        result['rows_per_s'] = int(rows / max(result['median_ms'] / 1000.0, 1e-9))
+    return result
+
+
+class _Silenced(object):
+    """ Redirects stdout to /dev/null, the shell prints its results there. """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout  = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def bench_suite(rows, columns, tables, repeat, only=None):
+    """ Time the hot paths of the shell in process on a synthetic database. """
+    sys.path.insert(0, HERE)
+    import sqlite_cli
+
+    workdir = tempfile.mkdtemp(prefix='sqlite_cli_bench')
+    # Keep the schema cache of the benchmark out of the users state dir.
+    sqlite_cli.SCHEMA_CACHE_DIR = os.path.join(workdir, 'schema')
+    cli     = sqlite_cli.SQLiteCli()
+    cli.do_loglevel('ERROR')
+    try:
+        db_name = os.path.join(workdir, 'suite.db')
+        make_database(db_name, rows, columns, tables)
+        cli.do_use(db_name)
+        query   = 'SELECT * FROM data'
+        results = { 'python': sys.version.split()[0],
+                    'sqlite': DB.sqlite_version,
+                    'rows'  : rows, 'columns': columns, 'tables': tables, }
+
+
+        def fetch():
+            cursor = cli.connection.cursor()
+            for _ in cli._iter_rows(cursor.execute(query)):
+                pass
+
+        def run_mode(mode):
+            def run():
+                cli.mode = mode
+                cli.default(query)
+            return lambda: run
+
+        def render(renderer, row_factory=DB.Row):
+            # The rows are fetched before, only rendering is timed.
+            def prepare():
+                cursor             = cli.connection.cursor()
+                cursor.row_factory = row_factory
+                data               = cursor.execute(query).fetchall()
+                return lambda: renderer(cursor, data)
+            return prepare
+
+        def export():
+            cli.do_export('%s %s' % (os.path.join(workdir, 'export.csv'), query,))
+
+        def load():
+            cli.connection.execute('DROP TABLE IF EXISTS loaded')
+            cli.do_load('%s INTO loaded' % (os.path.join(workdir, 'export.csv'),))
+
+        def prepare_load():
+            export()
+            return load
+
+        def complete_cold():
+            cli._completion_index = None
+            cli.completedefault('t_1', 'SELECT * FROM t_1', 14, 17)
+
+        def schema_persisted():
+            cli.schema._dirty = True
+            cli.schema.save()
+            cli._update_cache_table_names()
+
+        def complete(text, line):
+            return lambda: lambda: cli.completedefault(text, line, len(line) - len(text), len(line))
+
+        # ( NAME, FACTORY of the timed function, ROWS, )
+        benchmarks = [
+            ('fetch',               lambda: fetch,                          rows),
+            ('default_line',        run_mode(sqlite_cli.LINE),              rows),
+            ('default_table',       run_mode(sqlite_cli.TABLE),             rows),
+            ('default_csv',         run_mode(sqlite_cli.CSV),               rows),
+            ('default_columnar',    run_mode(sqlite_cli.COLUMNAR),          rows),
+            ('render_line',         render(cli._print_mode_line),           rows),
+            ('render_table',        render(cli._print_mode_table),          rows),
+            ('render_csv',          render(lambda cursor, data: cli._write_csv(cursor, data, sys.stdout, ','), None),
+                                                                            rows),
+            ('export_csv',          lambda: export,                         rows),
+            ('load_csv',            prepare_load,                           rows),
+            ('complete_cold',       lambda: complete_cold,                  None),
+            ('complete_warm',       complete('t_1', 'SELECT * FROM t_1'),   None),
+            ('complete_columns',    complete('data.c', 'SELECT data.c'),    None),
+            ('schema_refresh',      lambda: cli.schema.refresh,             None),
+            ('schema_persisted',    lambda: schema_persisted,               None),
+        ]
+        with _Silenced():
+            for name, factory, count in benchmarks:
+                if only and name not in only:
+                    continue
+                results[name] = _timed_calls(factory(), repeat, count)
+        return results
+    finally:
+        cli.schema._dirty = False
+        shutil.rmtree(workdir)
+
+
+def main(argv=None):
+    parser   = argparse.ArgumentParser(description='Benchmarks for sqlite_cli, results are printed as JSON.')
+    commands = parser.add_subparsers(dest='benchmark')
+    startup  = commands.add_parser('startup', help='cold start time to the first executed query')
+    startup.add_argument('-n', '--runs', type=int, default=20, help='number of timed starts')
+    suite    = commands.add_parser('suite', help='fetch, renderers, completion, schema loading, import/export')
+    suite.add_argument('-r', '--rows', type=int, default=SUITE_ROWS, help='rows of the data table')
+    suite.add_argument('-c', '--columns', type=int, default=SUITE_COLUMNS, help='columns of every table')
+    suite.add_argument('-t', '--tables', type=int, default=SUITE_TABLES, help='additional (empty) tables')
+    suite.add_argument('-n', '--repeat', type=int, default=SUITE_REPEAT, help='timed runs per benchmark')
+    suite.add_argument('only', nargs='*', metavar='BENCHMARK', help='run only these benchmarks')
+    args     = parser.parse_args(argv)
+
+    if args.benchmark == 'startup':
+        results = bench_startup(args.runs)
+    elif args.benchmark == 'suite':
+        results = bench_suite(args.rows, args.columns, args.tables, args.repeat, args.only)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Description:
+#   Tests of sqlite_cli, run with: python -m unittest test_sqlite_cli
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlite_cli
+
+
+class InferColumnTypeTest(unittest.TestCase):
+
+    def test_numbers(self):
+        self.assertEqual(sqlite_cli._infer_column_type(['1', '-2', '', None]), 'INTEGER')
+        self.assertEqual(sqlite_cli._infer_column_type(['1', '0.5', '0']), 'REAL')
+
+    def test_leading_zeros_are_text(self):
+        self.assertEqual(sqlite_cli._infer_column_type(['12', '0123']), 'TEXT')
+        self.assertEqual(sqlite_cli._infer_column_type(['-007']), 'TEXT')
+        self.assertEqual(sqlite_cli._parse_value('0123'), u'0123')
+
+
+class LoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cli       = sqlite_cli.SQLiteCli()
+        self.cli.do_use(os.path.join(self.directory, 'test.db'))
+
+    def tearDown(self):
+        self.cli.connection.close()
+        shutil.rmtree(self.directory)
+
+    def test_zip_codes_keep_leading_zeros(self):
+        filename = os.path.join(self.directory, 'in.csv')
+        with open(filename, 'w') as stream:
+            stream.write('zip,count\n0123,1\n4567,2\n')
+        self.cli.do_load('%s INTO places' % (filename,))
+        columns = [ (info[1], info[2],) for info in self.cli.connection.execute('PRAGMA table_info(places)') ]
+        self.assertEqual(columns, [ ('zip', 'TEXT'), ('count', 'INTEGER'), ])
+        rows = self.cli.connection.execute('SELECT zip, count FROM places ORDER BY count').fetchall()
+        self.assertEqual([ tuple(row) for row in rows ], [ (u'0123', 1), (u'4567', 2), ])
+
+
+
+class FunctionRegistryTest(unittest.TestCase):
+
+    def test_refresh_registers_new_connection_with_reused_id(self):
+        registry = sqlite_cli.FunctionRegistry()
+        sqlite_cli.builtin_functions(registry)
+        connection = sqlite_cli.DB.connect(':memory:', factory=sqlite_cli.Connection)
+        registry.register(connection)
+        connection.close()
+        del connection
+        connection = sqlite_cli.DB.connect(':memory:', factory=sqlite_cli.Connection)
+        registry.refresh(connection)
+        self.assertEqual(connection.execute("SELECT md5('a')").fetchone()[0], u'0cc175b9c0f1b6a831c399e269772661')
+
+
+if __name__ == '__main__':
+    unittest.main()